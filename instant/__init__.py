@@ -16,6 +16,7 @@ For more examples, see the tests/ directory in the Instant distribution.
 Questions, bugs and patches should be sent to fenics-dev@googlegroups.com.
 """
 
+import sys
 import pkg_resources
 
 __authors__ = "Magne Westlie, Kent-Andre Mardal <kent-and@simula.no>, Martin Alnes <martinal@simula.no>, Ilmar M. Wilbers <ilmarw@simula.no>"
@@ -28,6 +29,9 @@ from .config import *
 from .paths import *
 from .signatures import *
 from .cache import *
+from .locking import *
 from .codegeneration import *
 from .build import *
 from .inlining import *
+if sys.version_info >= (3, 5):
+    from .asynchronous import *
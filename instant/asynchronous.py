@@ -0,0 +1,235 @@
+"""This module contains coroutine versions of the build_module, inline*
+and import_module functions, for use with asyncio.
+
+The external build commands are run with asyncio subprocesses, so an
+event loop can overlap many compilations while serving other tasks:
+
+    >>> from instant import inline_async
+    >>> add_func = await inline_async("double add(double a, double b){ return a+b; }")
+
+Requires Python 3.5 or later.
+"""
+
+# Copyright (C) 2017 Instant developers
+#
+# This file is part of Instant.
+#
+# Instant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Instant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Instant. If not, see <http://www.gnu.org/licenses/>.
+#
+# Alternatively, Instant may be distributed under the terms of the BSD license.
+
+__all__ = ["build_module_async", "inline_async", "inline_with_numpy_async",
+           "import_module_async", "recompile_async"]
+
+import asyncio
+import os
+import shutil
+import time
+import weakref
+
+from .output import instant_debug, instant_info
+from .config import get_build_jobs
+from .cache import check_memory_cache, check_disk_cache, namespace_cache_dir
+from .build import build_module, _default_arguments, _validate_build_args, \
+     _module_ids, _begin_build, _end_build, _inflight_result, \
+     _make_module_path, _generate_module_files, _load_built_module, \
+     _needs_recompile, _compile_steps, _compile_failed, _compile_succeeded
+from .inlining import get_func_name, _function_from_module, \
+     _inline_kwargs, _inline_with_numpy_kwargs
+
+
+# Semaphores limiting the build commands running at once in each event
+# loop to get_build_jobs(), shared by all concurrent builds, as
+# semaphores can not be shared between event loops before Python 3.10
+_build_jobs = weakref.WeakKeyDictionary() # loop -> (jobs, semaphore)
+
+
+def _build_jobs_semaphore(loop):
+    "Return the semaphore of the build commands running in loop."
+    jobs, semaphore = _build_jobs.get(loop, (None, None))
+    if jobs != get_build_jobs():
+        jobs = get_build_jobs()
+        semaphore = asyncio.Semaphore(jobs)
+        _build_jobs[loop] = (jobs, semaphore)
+    return semaphore
+
+
+async def _get_status_output(cmd, cwd, jobs):
+    """Coroutine version of get_status_output, for a command given as a
+    list, running once the semaphore jobs is acquired."""
+    async with jobs:
+        instant_debug("Running: " + str(cmd))
+        process = await asyncio.create_subprocess_exec(
+            *cmd, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT)
+        output, errout = await process.communicate()
+    return process.returncode, output.decode('utf-8')
+
+
+async def recompile_async(modulename, module_path, new_compilation_checksum,
+                          build_system="distutils"):
+    """Coroutine version of recompile. Commands that do not depend on
+    each other are run concurrently, at most get_build_jobs() at a time
+    in all builds of the event loop."""
+    loop = asyncio.get_event_loop()
+    if not await loop.run_in_executor(None, _needs_recompile, modulename,
+                                      module_path, new_compilation_checksum):
+        return
+
+    instant_info("--- Instant: compiling ---")
+    steps = _compile_steps(modulename, module_path, build_system)
+    jobs = _build_jobs_semaphore(loop)
+    try:
+        results = None
+        while True:
+            # The steps read and write files and the build cache
+            commands = await loop.run_in_executor(None, _next_commands,
+                                                  steps, results)
+            if commands is None:
+                break
+            results = await asyncio.gather(
+                *[_get_status_output(cmd, module_path, jobs)
+                  for cmd in commands])
+    except:
+        await _cleanup(loop, _compile_failed, modulename, module_path)
+        raise
+
+    await loop.run_in_executor(None, _compile_succeeded, modulename,
+                               module_path, new_compilation_checksum)
+
+
+async def _cleanup(loop, func, *args):
+    """Run func(*args) in an executor thread, or directly if the event
+    loop was closed before the build finished, so that cleanups in except
+    and finally clauses run even then."""
+    try:
+        future = loop.run_in_executor(None, func, *args)
+    except RuntimeError:
+        return func(*args)
+    return await future
+
+
+def _next_commands(steps, results):
+    """Send results to the compile steps and return the next commands,
+    or None when done. StopIteration can not be raised into a future."""
+    try:
+        return steps.send(results)
+    except StopIteration:
+        return None
+
+
+def _find_module(kwargs):
+    """Validate the build_module arguments kwargs and look for the module
+    in the memory cache, see _module_ids. Returns the validated arguments
+    with the result of _module_ids."""
+    defaults = _default_arguments(build_module)
+    defaults.update(kwargs)
+    args = _validate_build_args(**defaults)
+    return (args,) + tuple(_module_ids(args))
+
+
+async def _build_module_async(args, modulename, moduleids):
+    """Coroutine version of instant.build._build_module. Generating,
+    publishing and importing the module is done in executor threads."""
+    loop = asyncio.get_event_loop()
+    build_path, module_path = await loop.run_in_executor(
+        None, _make_module_path, args, modulename)
+    try:
+        new_compilation_checksum, build_system = await loop.run_in_executor(
+            None, _generate_module_files, args, modulename, module_path)
+        await recompile_async(modulename, module_path,
+                              new_compilation_checksum, build_system)
+        return await loop.run_in_executor(None, _load_built_module, args,
+                                          modulename, moduleids, module_path)
+    finally:
+        if build_path is not None:
+            await _cleanup(loop, shutil.rmtree, build_path, True)
+
+
+async def build_module_async(**kwargs):
+    """Coroutine version of build_module, taking the same keyword
+    arguments and using the same memory and disk caches.
+
+    Concurrent builds of the same module, from tasks or threads, are
+    only compiled once. Everything but running the build commands,
+    which are asyncio subprocesses, is done in executor threads, so the
+    event loop never waits for files or locks."""
+    # Look for module in memory cache, computing its name if necessary
+    loop = asyncio.get_event_loop()
+    args, module, modulename, moduleids = await loop.run_in_executor(
+        None, _find_module, kwargs)
+    if module: return module
+
+    if args["modulename"] is None:
+        key = (args["cache_dir"], modulename)
+    else:
+        key = (os.path.abspath(modulename), modulename)
+    inflight, owner = _begin_build(key)
+    if not owner:
+        # The build may be running in another thread, so wait for it
+        # without blocking the event loop. The executor thread waits a
+        # little at a time, so that it is not left waiting for a build
+        # in a task abandoned by closing its event loop.
+        t = time.time()
+        while not await loop.run_in_executor(None, inflight.done.wait, 0.1):
+            pass
+        return _inflight_result(inflight, moduleids, time.time() - t)
+
+    try:
+        # Look for module in disk cache, otherwise build it
+        module = None
+        if args["modulename"] is None:
+            module = await loop.run_in_executor(None, check_disk_cache,
+                                                modulename, args["cache_dir"],
+                                                moduleids)
+        if not module:
+            module = await _build_module_async(args, modulename, moduleids)
+        inflight.module = module
+    except BaseException as e:
+        inflight.error = e
+        raise
+    finally:
+        _end_build(key, inflight)
+    return module
+
+
+async def inline_async(c_code, **kwargs):
+    "Coroutine version of inline."
+    kwargs = _inline_kwargs(c_code, kwargs)
+    func_name = get_func_name(c_code)
+    module = await build_module_async(**kwargs)
+    return _function_from_module(module, func_name)
+
+
+async def inline_with_numpy_async(c_code, **kwargs):
+    "Coroutine version of inline_with_numpy."
+    kwargs = _inline_with_numpy_kwargs(c_code, kwargs)
+    func_name = get_func_name(c_code)
+    module = await build_module_async(**kwargs)
+    return _function_from_module(module, func_name)
+
+
+async def import_module_async(moduleid, cache_dir=None, namespace=None):
+    """Coroutine version of import_module. The disk cache is searched
+    in an executor thread."""
+    # Look for module in memory cache
+    module, moduleids = check_memory_cache(moduleid)
+    if module: return module
+
+    # Look for module in disk cache
+    modulename = moduleids[-1]
+    cache_dir = namespace_cache_dir(cache_dir, namespace)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, check_disk_cache, modulename,
+                                      cache_dir, moduleids)
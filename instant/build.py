@@ -25,15 +25,26 @@
 import six
 from six import string_types
 
-import io, os, sys, shutil, glob, errno
+import io, os, re, sys, shutil, glob, errno, tempfile, json
+import compileall
+import collections
+import multiprocessing
+import multiprocessing.pool
+import threading
+import time
 from itertools import chain
 
 # TODO: Import only the official interface
 from .output import *
 from .paths import *
+from . import paths
 from .signatures import *
 from .cache import *
+from .cache import _HashedKey
 from .codegeneration import *
+from .config import get_build_system, get_build_jobs, \
+     get_compiler_version, get_swig_version, use_precompiled_headers, \
+     get_cmake_generator, get_cmake_build_type, get_compiler_config
 from .locking import file_lock
 
 
@@ -106,136 +117,471 @@ def copy_files(source, dest, files):
 def recompile(modulename, module_path, new_compilation_checksum,
               build_system="distutils"):
     """Recompile module if the new checksum is different from
-    the one in the checksum file in the module directory."""
+    the one in the checksum file in the module directory.
+
+    All build commands are run in module_path, without changing the
+    current directory of the process. Commands that do not depend on
+    each other, like the compilation of the translation units, run in
+    parallel, at most get_build_jobs() at a time."""
+    if not _needs_recompile(modulename, module_path, new_compilation_checksum):
+        return
+
+    instant_info("--- Instant: compiling ---")
+    steps = _compile_steps(modulename, module_path, build_system)
+    pool = None
+    try:
+        results = None
+        while True:
+            try:
+                commands = steps.send(results)
+            except StopIteration:
+                break
+            if len(commands) > 1 and get_build_jobs() > 1:
+                # The threads only wait for the compiler processes
+                if pool is None:
+                    pool = multiprocessing.pool.ThreadPool(get_build_jobs())
+                results = pool.map(lambda cmd: get_status_output(cmd, cwd=module_path),
+                                   commands)
+            else:
+                results = [get_status_output(cmd, cwd=module_path)
+                           for cmd in commands]
+    except:
+        _compile_failed(modulename, module_path)
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    _compile_succeeded(modulename, module_path, new_compilation_checksum)
+
 
-    assert(build_system in ["distutils", "cmake"])
-    # Check if the old checksum matches the new one
-    compilation_checksum_filename = "%s.checksum" % modulename
+def _compilation_checksum_filename(modulename, module_path):
+    return os.path.join(module_path, "%s.checksum" % modulename)
+
+
+def _needs_recompile(modulename, module_path, new_compilation_checksum):
+    "Check if the old checksum in module_path differs from the new one."
+    compilation_checksum_filename = _compilation_checksum_filename(modulename,
+                                                                   module_path)
     if os.path.exists(compilation_checksum_filename):
         checksum_file = io.open(compilation_checksum_filename, encoding="utf8")
         old_compilation_checksum = checksum_file.readline()
         checksum_file.close()
         if old_compilation_checksum == new_compilation_checksum:
-            return
-
-    # Create log file for logging of compilation errors
+            return False
+    return True
+
+
+def _compile_steps(modulename, module_path, build_system):
+    """Generator yielding the commands compiling the module, as lists of
+    commands which can run concurrently in module_path.
+
+    The results of each list of commands, a list of (status, output)
+    tuples, must be sent back to the generator, which writes them to the
+    compile log and raises an error if any of the commands failed. This
+    lets the same steps be run both by blocking and asynchronous code."""
+    steps = {"native": _native_steps,
+             "distutils": _distutils_steps,
+             "cmake": _cmake_steps}
+    assert(build_system in steps)
+    return steps[build_system](modulename, module_path)
+
+
+def _native_steps(modulename, module_path):
+    "Run swig, the compiler and the linker directly."
+    with io.open(os.path.join(module_path, "build.json"),
+                 encoding="utf8") as f:
+        build = json.load(f)
+
+    # List the dependencies of the wrapper, while preprocessing the
+    # user sources
+    user_units = [tu for tu in build["compile"] if "preprocess" in tu]
+    commands = [build["swig_depend"]] + [tu["preprocess"] for tu in user_units]
+
+    # Reuse the precompiled header from the build cache, or build it
+    pch = build.get("pch")
+    if pch is not None:
+        pch_key = _pch_checksum(module_path, pch)
+        pch_files = {"header.pch": os.path.join(module_path, pch["output"])}
+        if fetch_build_cache("pch", pch_key, pch_files):
+            pch = None
+        else:
+            commands.append(pch["command"])
+
+    results = yield commands
+    _check_compile_results(modulename, module_path, commands, results)
+    if pch is not None:
+        store_build_cache("pch", pch_key, pch_files)
+
+    # Reuse the wrapper from the build cache, or generate it
+    key = _swig_checksum(modulename, module_path, build)
+    if not _fetch_swig_outputs(modulename, module_path, build, key):
+        commands = [build["swig"]]
+        t0 = time.time()
+        results = yield commands
+        _record_build_step("swig", time.time() - t0)
+        _check_compile_results(modulename, module_path, commands, results,
+                               mode="a")
+        _store_swig_outputs(modulename, module_path, build, key)
+
+    # Reuse objects of user sources from the build cache, compiling
+    # only the wrapper and sources not seen before
+    misses = []
+    for tu in build["compile"]:
+        key = None
+        if tu in user_units:
+            key = _object_checksum(module_path, tu)
+            objects = {"object.o": os.path.join(module_path, tu["object"])}
+            if fetch_build_cache("objects", key, objects):
+                continue
+        misses.append((tu, key))
+    commands = [tu["command"] for tu, key in misses]
+    t0 = time.time()
+    results = yield commands
+    _record_build_step("compile", time.time() - t0)
+    _check_compile_results(modulename, module_path, commands, results,
+                           mode="a")
+    for tu, key in misses:
+        if key is not None:
+            store_build_cache("objects", key,
+                {"object.o": os.path.join(module_path, tu["object"])})
+
+    commands = [build["link"]]
+    t0 = time.time()
+    results = yield commands
+    _record_build_step("link", time.time() - t0)
+    _check_compile_results(modulename, module_path, commands, results,
+                           mode="a")
+
+
+def _pch_checksum(module_path, pch):
+    """Compute the build cache key of a precompiled header, from the
+    header, the command and the compiler version."""
+    with io.open(os.path.join(module_path, pch["header"]), encoding="utf8") as f:
+        header = f.read()
+    return compute_checksum("\n".join([header, json.dumps(pch["command"]),
+                                       get_compiler_version(pch["compiler"])]))
+
+
+# Placeholder for the module name in the cached SWIG outputs, letting
+# modules differing only in their name share the generated wrapper
+_swig_modulename = "__instant_swig_module__"
+
+def _swig_checksum(modulename, module_path, build):
+    """Compute the build cache key of the SWIG outputs, from the interface
+    file and the headers it includes, the SWIG command and version."""
+    with io.open(os.path.join(module_path, build["swig_depend_file"]),
+                 encoding="utf8") as f:
+        rule = f.read()
+    # Makefile rule 'target: dep1 dep2 ...' with line continuations
+    depends = rule.split(":", 1)[1].replace("\\", " ").split()
+    text = [json.dumps(build["swig"]), get_swig_version()]
+    for filename in depends:
+        with io.open(os.path.join(module_path, filename), encoding="utf8",
+                     errors="replace") as f:
+            text += [filename, f.read()]
+    return compute_checksum("\n".join(text).replace(modulename,
+                                                   _swig_modulename))
+
+
+def _fetch_swig_outputs(modulename, module_path, build, key):
+    "Copy the SWIG outputs from the build cache, if found."
+    files = dict((os.path.basename(f).replace(modulename, _swig_modulename),
+                  os.path.join(module_path, f)) for f in build["swig_outputs"])
+    if not fetch_build_cache("swig", key, files):
+        return False
+    for filename in files.values():
+        with io.open(filename, encoding="utf8") as f:
+            text = f.read()
+        write_file(filename, text.replace(_swig_modulename, modulename))
+    return True
+
+
+def _store_swig_outputs(modulename, module_path, build, key):
+    "Store the SWIG outputs in the build cache, independent of modulename."
+    files = {}
+    for f in build["swig_outputs"]:
+        name = os.path.basename(f).replace(modulename, _swig_modulename)
+        files[name] = os.path.join(module_path, name)
+        with io.open(os.path.join(module_path, f), encoding="utf8") as g:
+            text = g.read()
+        write_file(files[name], text.replace(modulename, _swig_modulename))
+    store_build_cache("swig", key, files)
+    for filename in files.values():
+        os.remove(filename)
+
+
+_build_step_lock = threading.Lock()
+_build_step_statistics = {}
+
+def _record_build_step(step, seconds):
+    with _build_step_lock:
+        statistics = _build_step_statistics.setdefault(step,
+            {"runs": 0, "time": 0.0})
+        statistics["runs"] += 1
+        statistics["time"] += seconds
+
+
+def build_step_statistics():
+    """Return a dict with the number of runs and the total time in seconds
+    spent in each step of the native build in this process: "swig",
+    "compile" and "link". The time of SWIG runs saved by the build
+    cache shows in build_cache_statistics()["swig"]."""
+    with _build_step_lock:
+        return dict((step, dict(s))
+                    for step, s in _build_step_statistics.items())
+
+
+def _object_checksum(module_path, tu):
+    """Compute the build cache key of the object of a translation unit,
+    from its preprocessed source, the compile command and the compiler
+    version."""
+    preprocessed = os.path.join(module_path, tu["preprocessed"])
+    with io.open(preprocessed, encoding="utf8", errors="replace") as f:
+        # Line markers may refer to the (temporary) build directory
+        source = f.read().replace(module_path, "")
+    return compute_checksum("\n".join([source, json.dumps(tu["command"]),
+                             get_compiler_version(tu["compiler"])]))
+
+
+def _distutils_steps(modulename, module_path):
+    "Build extension module with distutils."
+    python_interp = sys.executable
+    build_ext = ["build_ext"]
+    if sys.version_info >= (3, 5):
+        # The generated setup.py compiles the translation units of the
+        # extension in parallel with -j
+        build_ext += ["-j", str(get_build_jobs())]
+    commands = [[python_interp, "setup.py"] + build_ext
+                + ["install", "--install-platlib=."]]
+    results = yield commands
+    _check_compile_results(modulename, module_path, commands, results)
+
+
+def _cmake_steps(modulename, module_path):
+    """Build extension module with cmake.
+
+    The configure step is skipped when module_path holds a build tree
+    configured by the same command from the same CMakeLists.txt, as for
+    modules with an explicit modulename rebuilt after their sources
+    changed. Otherwise the cache entries found by an earlier configure
+    with the same packages and toolchain are loaded from the build cache,
+    which saves searching for the packages again."""
+    configure = ["cmake", "-G", get_cmake_generator(),
+                 "-DCMAKE_BUILD_TYPE=%s" % get_cmake_build_type(), "."]
+    stamp = os.path.join(module_path, "instant_configure.stamp")
+    checksum = compute_checksum(json.dumps(configure),
+        [os.path.join(module_path, "CMakeLists.txt")])
+    configured = os.path.exists(os.path.join(module_path, "CMakeCache.txt"))
+    old_checksum = None
+    if configured and os.path.exists(stamp):
+        with io.open(stamp, encoding="utf8") as f:
+            old_checksum = f.read()
+    if old_checksum == checksum:
+        instant_debug("In instant.recompile: Reusing the configured build"\
+                      " tree in %s." % module_path)
+        mode = "w"
+    else:
+        # The generator of a configured build tree can not be changed
+        if configured:
+            os.remove(os.path.join(module_path, "CMakeCache.txt"))
+        key = _cmake_cache_checksum(module_path, configure)
+        initial_cache = {"initial_cache.cmake":
+                         os.path.join(module_path, "instant_initial_cache.cmake")}
+        found = fetch_build_cache("cmake", key, initial_cache)
+        if found:
+            commands = [configure[:1] + ["-C", "instant_initial_cache.cmake"]
+                        + configure[1:]]
+        else:
+            commands = [configure]
+        results = yield commands
+        _check_compile_results(modulename, module_path, commands, results)
+        write_file(stamp, checksum)
+        if not found and os.path.exists(os.path.join(module_path,
+                                                     "CMakeCache.txt")):
+            _write_initial_cache(module_path, initial_cache["initial_cache.cmake"])
+            store_build_cache("cmake", key, initial_cache)
+        mode = "a"
+
+    # Build extension module with the generated build files
+    if get_cmake_generator() == "Ninja":
+        commands = [["ninja", "-j%d" % get_build_jobs(), "-v"]]
+    else:
+        commands = [["make", "-j%d" % get_build_jobs(), "VERBOSE=1"]]
+    results = yield commands
+    _check_compile_results(modulename, module_path, commands, results,
+                           mode=mode)
+
+
+def _cmake_cache_checksum(module_path, configure):
+    """Compute the build cache key of the cmake cache entries of a module,
+    from the packages it finds, the configure command, the versions of
+    cmake and the compiler and the package search paths."""
+    with io.open(os.path.join(module_path, "CMakeLists.txt"),
+                 encoding="utf8") as f:
+        packages = [line.strip() for line in f
+                    if line.strip().upper().startswith("FIND_PACKAGE")]
+    compiler = get_compiler_config()
+    text = packages + [json.dumps(configure),
+                       get_compiler_version(["cmake"]),
+                       get_compiler_version(compiler["cxx"]),
+                       get_compiler_version(compiler["cc"])]
+    text += ["%s=%s" % (name, os.environ[name]) for name in sorted(os.environ)
+             if name == "CMAKE_PREFIX_PATH" or name.endswith("_DIR")]
+    return compute_checksum("\n".join(text))
+
+
+# Cache entries which depend on the module rather than on its packages
+_cmake_module_entries = re.compile(r"^(CMAKE_CACHEFILE_DIR|CMAKE_HOME_DIRECTORY"
+                                   r"|CMAKE_BUILD_TYPE|.*_(BINARY|SOURCE)_DIR)$")
+
+def _write_initial_cache(module_path, filename):
+    """Write the entries found by cmake in the cache of the build tree in
+    module_path to a script for cmake -C, leaving out internal entries
+    and the ones specific to the module."""
+    entries = []
+    with io.open(os.path.join(module_path, "CMakeCache.txt"),
+                 encoding="utf8") as f:
+        for line in f:
+            m = re.match(r"^([^#/][^:=]*):(STRING|FILEPATH|PATH|BOOL)=(.*)$",
+                         line.rstrip("\n"))
+            if m is None or _cmake_module_entries.match(m.group(1)):
+                continue
+            name, kind, value = m.groups()
+            entries.append('set(%s [==[%s]==] CACHE %s "")\n' % (name, value, kind))
+    write_file(filename, "# Cache entries found by Instant\n" + "".join(entries))
+
+
+def _check_compile_results(modulename, module_path, commands, results,
+                           mode="w"):
+    "Write output of build commands to the compile log, and check status."
+    # Log file for logging of compilation errors
     compile_log_filename = os.path.join(module_path, "compile.log")
-    compile_log_filename_dest = os.path.join(get_default_error_dir(), \
-                                             modulename, "compile.log")
+    compile_log_filename_dest = os.path.join(
+        cached_module_path(get_default_error_dir(), modulename), "compile.log")
 
-    ret = 1
-    try:
+    for cmd, (ret, output) in zip(commands, results):
+        instant_debug("cmd = %s" % cmd)
+        write_file(compile_log_filename, output, mode=mode)
+        mode = "a"
+        if ret != 0:
+            compilation_checksum_filename = \
+                _compilation_checksum_filename(modulename, module_path)
+            if os.path.exists(compilation_checksum_filename):
+                os.remove(compilation_checksum_filename)
+            msg = "In instant.recompile: The module did not compile with command '%s', see '%s'"
+            instant_error(msg % (" ".join(cmd), compile_log_filename_dest))
+
+
+def _compile_failed(modulename, module_path):
+    "Display the compile log if wanted, and copy the module to the error dir."
+    if "INSTANT_DISPLAY_COMPILE_LOG" in list(os.environ.keys()):
+        compile_log_filename = os.path.join(module_path, "compile.log")
         compile_log_contents = None
-        instant_info("--- Instant: compiling ---")
-
-        # TODO: The three blocks below can be made a function and
-        # three calls
-        if build_system == "distutils":
-            # Build extension module with distutils
-            python_interp = sys.executable
-            cmd = python_interp + " setup.py build_ext install --install-platlib=."
-            instant_debug("cmd = %s" % cmd)
-            ret, output = get_status_output(cmd)
-            write_file(compile_log_filename, output)
-            if ret != 0:
-                compile_log_contents = output
-                if os.path.exists(compilation_checksum_filename):
-                    os.remove(compilation_checksum_filename)
-                msg = "In instant.recompile: The module did not compile with command '%s', see '%s'"
-                instant_error(msg % (cmd, compile_log_filename_dest))
-        else:
-            # Build makefile for extension module with cmake
-            cmd = "cmake -DDEBUG=TRUE .";
-            #cmd = "cmake .";
-            instant_debug("cmd = %s" % cmd)
-            ret, output = get_status_output(cmd)
-            write_file(compile_log_filename, output)
-            if ret != 0:
-                compile_log_contents = output
-                if os.path.exists(compilation_checksum_filename):
-                    os.remove(compilation_checksum_filename)
-                msg = "In instant.recompile: The module did not compile with command '%s', see '%s'"
-                instant_error(msg % (cmd, compile_log_filename_dest))
-
-            # Build extension module with cmake generated makefile
-            cmd = "make VERBOSE=1"
-            instant_debug("cmd = %s" % cmd)
-            ret, output = get_status_output(cmd)
-            write_file(compile_log_filename, output, mode="a")
-            if ret != 0:
-                compile_log_contents = output
-                if os.path.exists(compilation_checksum_filename):
-                    os.remove(compilation_checksum_filename)
-                msg = "In instant.recompile: The module did not compile with command '%s', see '%s'"
-                instant_error(msg % (cmd, compile_log_filename_dest))
+        if os.path.exists(compile_log_filename):
+            with io.open(compile_log_filename, encoding="utf8") as f:
+                compile_log_contents = f.read()
+        instant_warning("")
+        instant_warning("Content of instant compile.log")
+        instant_warning("==============================")
+        instant_warning(compile_log_contents)
+        instant_warning("")
 
-    finally:
-        if ret != 0:
-            if "INSTANT_DISPLAY_COMPILE_LOG" in list(os.environ.keys()):
-                instant_warning("")
-                instant_warning("Content of instant compile.log")
-                instant_warning("==============================")
-                instant_warning(compile_log_contents)
-                instant_warning("")
-
-            # Copy module to error dir
-            module_path = copy_to_cache(module_path, get_default_error_dir(),
-                                        modulename,
-                                        check_for_existing_path=False)
+    # Copy module to error dir
+    copy_to_cache(module_path, get_default_error_dir(), modulename,
+                  check_for_existing_path=False, indexed=False)
 
+
+def _compile_succeeded(modulename, module_path, new_compilation_checksum):
     # Compilation succeeded, write new_compilation_checksum to
     # checksum_file
-    write_file(compilation_checksum_filename, new_compilation_checksum)
+    write_file(_compilation_checksum_filename(modulename, module_path),
+               new_compilation_checksum)
 
 
 def copy_to_cache(module_path, cache_dir, modulename,
-                  check_for_existing_path=True):
-    "Copy module directory to cache."
-    # Get lock, check if the module exists, _otherwise_ copy the
-    # finished compiled module from /tmp/foo to the cache directory,
-    # and then release lock
-    with file_lock(cache_dir, modulename) as lock:
-
-        # Validate the path
-        cache_module_path = os.path.join(cache_dir, modulename)
-        if check_for_existing_path and os.path.exists(os.path.join(\
-            cache_module_path, "finished_copying")):
-            # This indicates a race condition has happened (and is
-            # being avoided!).
-            instant_warning("In instant.build_module: Path '%s' already exists,"\
-                " but module wasn't found in cache previously. Not overwriting,"\
-                " assuming this module is valid." % cache_module_path)
-
-            return cache_module_path
-
-            # Not deleting anymore, relying on locking system
-            #shutil.rmtree(cache_module_path, ignore_errors=True)
-
-        # Error checks
-        instant_assert(os.path.isdir(module_path), "In instant.build_module:"\
-                       " Cannot copy non-existing directory %r!" % module_path)
-        if check_for_existing_path and os.path.isdir(cache_module_path):
-            instant_error("In instant.build_module: Cache directory %r shouldn't"\
-                          " exist at this point!" % cache_module_path)
-        instant_debug("In instant.build_module: Copying built module from %r"\
-            " to cache at %r" % (module_path, cache_module_path))
-
-        # Do the copying and mark that we are finished by creating an
-        # empty file finished_copying
-        try:
-            shutil.copytree(module_path, cache_module_path)
-            with io.open(os.path.join(cache_module_path, "finished_copying"),
-                             "w", encoding="utf8") as dummy:
-                pass            
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                raise
-        finally:
-            delete_temp_dir()
+                  check_for_existing_path=True, indexed=True):
+    """Copy module directory to cache.
+
+    The module is copied to a staging directory in cache_dir, unless it
+    was built in one, and published by renaming the staging directory,
+    which is atomic. Only the rename is done holding the lock, and other
+    processes never see a partially copied module, so they can look up
+    modules in the cache without locking. The module is then added to
+    the index of the cache, and the cache quota is enforced, unless
+    indexed is False, as for the error directory."""
+    cache_module_path = cached_module_path(cache_dir, modulename)
+    finished = os.path.join(cache_module_path, "finished_copying")
+    existing_path = find_cached_module(cache_dir, modulename)
+    if check_for_existing_path and existing_path:
+        if indexed:
+            # Lookups go through the index, add modules missing from it,
+            # such as those published by older versions of Instant
+            record_published_module(cache_dir, modulename, replace=False)
+        return _already_in_cache(existing_path)
+
+    # Error checks
+    instant_assert(os.path.isdir(module_path), "In instant.build_module:"\
+                   " Cannot copy non-existing directory %r!" % module_path)
+
+    # Copy the module next to its final place, and mark that we are
+    # finished by creating an empty file finished_copying
+    staging_path = tempfile.mkdtemp(prefix="." + modulename + ".", dir=cache_dir)
+    try:
+        if _is_staging_path(module_path, cache_dir):
+            staged_path = module_path
+        else:
+            instant_debug("In instant.build_module: Copying built module from"\
+                          " %r to cache at %r" % (module_path, staging_path))
+            staged_path = os.path.join(staging_path, modulename)
+            shutil.copytree(module_path, staged_path)
+        # Compile the Python files now, as importing the module from the
+        # cache should not write to it
+        compileall.compile_dir(staged_path, quiet=1)
+        with io.open(os.path.join(staged_path, "finished_copying"),
+                     "w", encoding="utf8") as dummy:
+            pass
+
+        shard_path = os.path.dirname(cache_module_path)
+        makedirs(shard_path)
+        with file_lock(shard_path, modulename) as lock:
+            if check_for_existing_path and os.path.exists(finished):
+                return _already_in_cache(cache_module_path)
+            if os.path.isdir(cache_module_path):
+                # Unfinished or replaced module, remove it with the
+                # staging directory
+                instant_debug("In instant.build_module: Replacing %r."\
+                              % cache_module_path)
+                os.rename(cache_module_path,
+                          os.path.join(staging_path, "replaced"))
+            instant_debug("In instant.build_module: Publishing built module"\
+                          " at %r" % cache_module_path)
+            os.rename(staged_path, cache_module_path)
+    finally:
+        shutil.rmtree(staging_path, ignore_errors=True)
 
+    if indexed:
+        record_published_module(cache_dir, modulename)
+        enforce_cache_quota(cache_dir, exclude=[modulename])
     return cache_module_path
 
 
+def _already_in_cache(cache_module_path):
+    # This indicates a race condition has happened (and is being avoided!).
+    instant_warning("In instant.build_module: Path '%s' already exists,"\
+        " but module wasn't found in cache previously. Not overwriting,"\
+        " assuming this module is valid." % cache_module_path)
+    return cache_module_path
+
+
+def _is_staging_path(path, cache_dir):
+    "Check if path is a staging directory in cache_dir, see copy_to_cache."
+    path = os.path.abspath(path)
+    return os.path.dirname(path) == os.path.abspath(cache_dir) \
+        and os.path.basename(path).startswith(".")
+
+
 def build_module(modulename=None, source_directory=".",
                  code="", init_code="",
                  additional_definitions="", additional_declarations="",
@@ -248,7 +594,7 @@ def build_module(modulename=None, source_directory=".",
                  object_files=[], arrays=[],
                  generate_interface=True, generate_setup=True,
                  cmake_packages=[],
-                 signature=None, cache_dir=None):
+                 signature=None, cache_dir=None, namespace=None):
     """Generate and compile a module from C/C++ code using SWIG.
 
     Arguments:
@@ -349,16 +695,229 @@ def build_module(modulename=None, source_directory=".",
           If missing, a default directory is used. Note that the module
           will not be cached if B{modulename} is specified.
           The cache directory should not be used for anything else.
+      - B{namespace}:
+        - The name of a namespace in the cache directory to look for
+          cached modules and place new ones, with its own quota, index
+          and statistics, see C{namespace_cache_dir}. String.
     """
 
-    # Store original directory to be able to restore later
-    original_path = os.getcwd()
+    kwargs = dict(locals())
+
+    # Return the module built before from the same arguments and files
+    fast_path_key = _fast_path_key(kwargs)
+    module = _fast_path_module(fast_path_key)
+    if module is not None:
+        return module
+
+    args = _validate_build_args(**kwargs)
+
+    # Look for module in memory cache, computing its name if necessary
+    module, modulename, moduleids = _module_ids(args)
+    if not module:
+        # Look for module in disk cache, or build it, unless another
+        # thread is already doing so
+        if args["modulename"] is None:
+            key = (args["cache_dir"], modulename)
+        else:
+            key = (os.path.abspath(modulename), modulename)
+        module = _build_once(key, moduleids, _find_or_build_module,
+                             args, modulename, moduleids)
+
+    # Only modules in the memory cache can be returned by the fast path
+    if moduleids:
+        _fast_path_store(fast_path_key, modulename)
+    return module
+    # end build_module
+
+
+# Names of the modules built from build_module arguments in this
+# process, with the arguments and the state of the files they refer to
+# as keys, see _fast_path_key
+_fast_path_lock = threading.Lock()
+_fast_path = collections.OrderedDict()
+_fast_path_size = 1024
+_fast_path_statistics = {"hits": 0, "misses": 0}
+
+def _frozen(value):
+    "Return a hashable copy of value, made of lists, tuples and dicts."
+    if isinstance(value, (list, tuple)):
+        return tuple(_frozen(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _frozen(v)) for k, v in value.items()))
+    return value
+
+
+def _fast_path_key(kwargs):
+    """Return a key of the build_module arguments kwargs and the state of
+    the files they refer to, or None if some argument is not hashable
+    or some file is missing. The key is hashed once, here, as the
+    signature among the arguments may be expensive to hash.
+
+    A signature object is keyed by its signature string, as its memory
+    cache ids are, see check_memory_cache, since the object itself may
+    hash and compare by identity."""
+    signature = kwargs.get("signature")
+    if hasattr(signature, "signature"):
+        kwargs = dict(kwargs, signature=signature.signature())
+    stats = []
+    for f in chain(kwargs["sources"], kwargs["wrap_headers"],
+                   kwargs["local_headers"]):
+        try:
+            st = os.stat(os.path.join(kwargs["source_directory"], f))
+        except (OSError, TypeError):
+            return None
+        stats.append((st.st_size, getattr(st, "st_mtime_ns", st.st_mtime),
+                      st.st_ino))
+    # The module may be found relative to the current directory, and
+    # its name depends on the hash algorithm
+    try:
+        return _HashedKey(_frozen(kwargs) + (tuple(stats), os.getcwd(),
+                          os.environ.get("INSTANT_HASH_ALGORITHM")))
+    except TypeError:
+        return None
+
+
+def _fast_path_module(key):
+    "Return the module built from the arguments of key, if still in memory."
+    modulename = _fast_path.get(key) if key is not None else None
+    module = memory_cached_module(modulename) if modulename else None
+    with _fast_path_lock:
+        _fast_path_statistics["hits" if module else "misses"] += 1
+    return module
+
+
+def _fast_path_store(key, modulename):
+    "Remember that the arguments of key build the module modulename."
+    if key is None:
+        return
+    with _fast_path_lock:
+        _fast_path[key] = modulename
+        while len(_fast_path) > _fast_path_size:
+            _fast_path.popitem(last=False)
+
+
+def fast_path_statistics():
+    """Return a dict with the number of build_module calls in this
+    process which returned a module built before from the same arguments
+    without validating them or computing checksums (hits), and the
+    number of those which did not (misses)."""
+    with _fast_path_lock:
+        return dict(_fast_path_statistics)
+
+
+# Registry of builds in progress in this process, to let concurrent
+# callers building the same module wait for the first one to finish
+_inflight_lock = threading.Lock()
+_inflight_builds = {} # (directory, modulename) -> _InflightBuild
+_inflight_statistics = {"builds": 0, "hits": 0, "wait_time": 0.0}
+
+
+class _InflightBuild(object):
+    "The outcome of a build in progress, for other threads to wait on."
+    def __init__(self):
+        self.done = threading.Event()
+        self.module = None
+        self.error = None
+
+
+def _build_once(key, moduleids, build, *args):
+    """Return build(*args), or the result of the call already in progress
+    in another thread with the same key. The module is placed in the
+    memory cache with the moduleids of the caller."""
+    inflight, owner = _begin_build(key)
+    if not owner:
+        t = time.time()
+        inflight.done.wait()
+        return _inflight_result(inflight, moduleids, time.time() - t)
+
+    try:
+        inflight.module = build(*args)
+    except BaseException as e:
+        inflight.error = e
+        raise
+    finally:
+        _end_build(key, inflight)
+    return inflight.module
+
+
+def _begin_build(key):
+    """Register a build of key. Returns a tuple (inflight, owner), where
+    owner is False if the build was already in progress."""
+    with _inflight_lock:
+        inflight = _inflight_builds.get(key)
+        if inflight is None:
+            inflight = _InflightBuild()
+            _inflight_builds[key] = inflight
+            _inflight_statistics["builds"] += 1
+            return inflight, True
+        _inflight_statistics["hits"] += 1
+    instant_debug("In instant.build_module: Waiting for build of %r in"\
+                  " progress." % (key,))
+    return inflight, False
+
+
+def _end_build(key, inflight):
+    "Unregister the finished build of key and wake up the waiters."
+    with _inflight_lock:
+        del _inflight_builds[key]
+    inflight.done.set()
+
+
+def _inflight_result(inflight, moduleids, wait_time):
+    "Return the module of a finished build waited for in wait_time seconds."
+    with _inflight_lock:
+        _inflight_statistics["wait_time"] += wait_time
+    if inflight.error is not None:
+        raise inflight.error
+    for moduleid in moduleids:
+        place_module_in_memory_cache(moduleid, inflight.module)
+    return inflight.module
+
+
+def inflight_build_statistics():
+    """Return a dict with statistics of the deduplication of concurrent
+    builds of the same module in this process:
+      - builds: The number of builds (or disk cache lookups) started.
+      - hits: The number of calls that waited for a build already in
+        progress instead of starting their own.
+      - wait_time: The total time in seconds spent waiting."""
+    with _inflight_lock:
+        return dict(_inflight_statistics)
+
+
+def _find_or_build_module(args, modulename, moduleids):
+    "Import the module from the disk cache if found there, otherwise build it."
+    if args["modulename"] is None:
+        module = check_disk_cache(modulename, args["cache_dir"], moduleids)
+        if module: return module
+
+    return _build_module(args, modulename, moduleids)
+
+
+def _default_arguments(func):
+    "Return a dict with the default values of the keyword arguments of func."
+    code = func.__code__
+    names = code.co_varnames[:code.co_argcount]
+    return dict(zip(names[-len(func.__defaults__):], func.__defaults__))
+
+
+def _validate_build_args(modulename, source_directory, code, init_code,
+                         additional_definitions, additional_declarations,
+                         sources, wrap_headers, local_headers, system_headers,
+                         include_dirs, library_dirs, libraries,
+                         swigargs, swig_include_dirs, cppargs, lddargs,
+                         object_files, arrays,
+                         generate_interface, generate_setup,
+                         cmake_packages, signature, cache_dir, namespace):
+    """Validate the arguments to build_module and return them in a dict,
+    replaced with normalized values and defaults where necessary."""
 
     # --- Validate arguments
 
     if sys.version_info[0] > 2:
         swigargs = swigargs + ['-py3']
 
+
     instant_assert(modulename is None or isinstance(modulename, string_types),
         "In instant.build_module: Expecting modulename to be string or None.")
     assert_is_str(source_directory)
@@ -392,7 +951,7 @@ def build_module(modulename=None, source_directory=".",
 
     # --- Replace arguments with defaults if necessary
 
-    cache_dir = validate_cache_dir(cache_dir)
+    cache_dir = namespace_cache_dir(cache_dir, namespace)
 
     # Split sources by file-suffix (.c or .cpp)
     csrcs = [f for f in sources if f.endswith('.c') or f.endswith('.C')]
@@ -428,201 +987,382 @@ def build_module(modulename=None, source_directory=".",
     instant_debug('    cmake_packages: %r' % cmake_packages)
     instant_debug('    signature: %r' % signature)
     instant_debug('    cache_dir: %r' % cache_dir)
+    instant_debug('    namespace: %r' % namespace)
     instant_debug('::: End Arguments :::')
 
-    # --- Setup module directory, making it and copying
-    #     files to it if necessary, and compute a modulename
-    #     if it isn't specified explicitly
-
-    if modulename is None:
-        # Compute a signature if we have none passed by the user:
-        if signature is None:
-            # Collect arguments used for checksum creation,
-            # including everything that affects the interface
-            # file generation and module compilation.
-            checksum_args = ( \
-                # We don't care about the modulename, that's what
-                # we're trying to construct!
-                #modulename,
-                # We don't care where the user code resides:
-                #source_directory,
-                code, init_code,
-                additional_definitions,
-                additional_declarations,
-                # Skipping filenames, since we use the file contents:
-                #sources, wrap_headers,
-                #local_headers,
-                system_headers,
-                include_dirs, library_dirs, libraries,
-                swig_include_dirs, swigargs, cppargs, lddargs,
-                object_files, arrays,
-                generate_interface, generate_setup, cmake_packages,
-                # The signature isn't defined, and the cache_dir
-                # doesn't affect the module:
-                #signature, cache_dir)
-                sys.version
-            )
-            allfiles = sources + wrap_headers + local_headers
-            allfiles = [os.path.join(source_directory, f) for f in allfiles]
-            text = "\n".join((str(a) for a in checksum_args))
-            signature = modulename_from_checksum(compute_checksum(text, allfiles))
-            modulename = signature
-            moduleids = [signature]
-        else:
-            module, moduleids = check_memory_cache(signature)
-            if module: return module
-            modulename = moduleids[-1]
+    # All arguments, and the values derived from them above
+    return dict(locals())
 
-        # Look for module in disk cache
-        module = check_disk_cache(modulename, cache_dir, moduleids)
-        if module: return module
 
-        # Make a temporary module path for compilation
-        module_path = os.path.join(get_temp_dir(), modulename)
-        instant_assert(not os.path.exists(module_path), "In instant.build_module: Not expecting module_path to exist: '%s'"\
-            % module_path)
-        makedirs(module_path)
-        use_cache = True
-    else:
-        use_cache = False
-        moduleids = []
-        module_path = os.path.join(original_path, modulename)
-        makedirs(module_path)
+def _module_ids(args):
+    """Compute the name and the memory cache ids of the module built from
+    the validated build_module arguments args.
+
+    Returns a tuple (module, modulename, moduleids) where module is the
+    module if it was found in the memory cache, None otherwise."""
+    modulename = args["modulename"]
+    signature = args["signature"]
+
+    # An explicitly named module is not cached
+    if modulename is not None:
+        return None, modulename, []
 
-        ## Look for module in memory cache
-        #module, moduleids = check_memory_cache(modulename)
-        #if module: return module
-        #instant_assert(modulename == moduleids[-1] and len(moduleids) == 1, "Logic breach.")
-        ## Look for module in local directory
-        #module = check_disk_cache(modulename, original_path, moduleids)
-        #if module: return module
+    # Compute a signature if we have none passed by the user:
+    if signature is None:
+        # Collect arguments used for checksum creation,
+        # including everything that affects the interface
+        # file generation and module compilation.
+        checksum_args = ( \
+            # We don't care about the modulename, that's what
+            # we're trying to construct!
+            #modulename,
+            # We don't care where the user code resides:
+            #source_directory,
+            args["code"], args["init_code"],
+            args["additional_definitions"],
+            args["additional_declarations"],
+            # Skipping filenames, since we use the file contents:
+            #sources, wrap_headers,
+            #local_headers,
+            args["system_headers"],
+            args["include_dirs"], args["library_dirs"], args["libraries"],
+            args["swig_include_dirs"], args["swigargs"], args["cppargs"],
+            args["lddargs"], args["object_files"], args["arrays"],
+            args["generate_interface"], args["generate_setup"],
+            args["cmake_packages"],
+            # The signature isn't defined, and the cache_dir
+            # and namespace don't affect the module:
+            #signature, cache_dir, namespace)
+            sys.version
+        )
+        allfiles = args["sources"] + args["wrap_headers"] + args["local_headers"]
+        allfiles = [os.path.join(args["source_directory"], f) for f in allfiles]
+        text = "\n".join((str(a) for a in checksum_args))
+        signature = modulename_from_checksum(compute_checksum(text, allfiles))
+        return memory_cached_module(signature), signature, [signature]
+
+    module, moduleids = check_memory_cache(signature)
+    return module, moduleids[-1], moduleids
+
+
+def _build_module(args, modulename, moduleids):
+    """Generate, compile and import the module modulename from the
+    validated build_module arguments args, placing it in the cache
+    unless it was given an explicit name."""
+    build_path, module_path = _make_module_path(args, modulename)
 
     # Wrapping rest of code in try-block to
     # clean up at the end if something fails.
     try:
-        # --- Copy user-supplied files to module path
-
-        module_path = os.path.abspath(module_path)
-        files_to_copy = sources + wrap_headers + local_headers + object_files
-        copy_files(source_directory, module_path, files_to_copy)
-        # At this point, all user input files should reside in module_path
-
-        # --- Generate additional files in module directory
-        os.chdir(module_path)
-
-        # Generate __init__.py which imports compiled module contents
-        write_file("__init__.py", "from __future__ import absolute_import\nfrom .%s import *" \
-                    % modulename)
-
-        # Generate SWIG interface if wanted
-        ifile_name = "%s.i" % modulename
-        if generate_interface:
-            write_interfacefile(ifile_name, modulename, code, init_code,
-                                additional_definitions,
-                                additional_declarations, system_headers,
-                                local_headers, wrap_headers, arrays)
-
-        # Generate setup.py if wanted
-        if generate_setup and not cmake_packages:
-            setup_name = "setup.py"
+        new_compilation_checksum, build_system = \
+            _generate_module_files(args, modulename, module_path)
+
+        # Recompile if necessary
+        recompile(modulename, module_path, new_compilation_checksum,
+                  build_system)
+
+        return _load_built_module(args, modulename, moduleids, module_path)
+
+    finally:
+        # Always clean up the temporary build directory
+        if build_path is not None:
+            shutil.rmtree(build_path, ignore_errors=True)
+
+
+def _make_module_path(args, modulename):
+    """Create the directory to build the module in. Returns a tuple
+    (build_path, module_path), where build_path is the same directory if
+    it is temporary and should be removed after the build, None otherwise."""
+    use_cache = args["modulename"] is None
+    if use_cache:
+        # Make a staging directory in the cache for compilation, unique
+        # to this build so concurrent builds don't interfere, which
+        # copy_to_cache publishes by renaming it
+        build_path = tempfile.mkdtemp(prefix="." + modulename + ".",
+                                      dir=args["cache_dir"])
+        module_path = build_path
+    else:
+        build_path = None
+        module_path = os.path.abspath(modulename)
+        makedirs(module_path)
+
+    return build_path, module_path
+
+
+def _generate_module_files(args, modulename, module_path):
+    """Copy user-supplied files to the module directory and generate the
+    interface and build files there. Returns a tuple
+    (new_compilation_checksum, build_system)."""
+    source_directory = args["source_directory"]
+    sources = args["sources"]
+    wrap_headers = args["wrap_headers"]
+    local_headers = args["local_headers"]
+    system_headers = args["system_headers"]
+    include_dirs = args["include_dirs"]
+    library_dirs = args["library_dirs"]
+    libraries = args["libraries"]
+    swigargs = args["swigargs"]
+    swig_include_dirs = args["swig_include_dirs"]
+    cppargs = args["cppargs"]
+    lddargs = args["lddargs"]
+    object_files = args["object_files"]
+    cmake_packages = args["cmake_packages"]
+    csrcs = args["csrcs"]
+    cppsrcs = args["cppsrcs"]
+
+    # --- Copy user-supplied files to module path
+
+    module_path = os.path.abspath(module_path)
+    files_to_copy = sources + wrap_headers + local_headers + object_files
+    copy_files(source_directory, module_path, files_to_copy)
+    # At this point, all user input files should reside in module_path
+
+    # --- Generate additional files in module directory
+
+    # Generate __init__.py which imports compiled module contents
+    write_file(os.path.join(module_path, "__init__.py"),
+               "from __future__ import absolute_import\nfrom .%s import *" \
+               % modulename)
+
+    # Generate SWIG interface if wanted
+    ifile_name = "%s.i" % modulename
+    if args["generate_interface"]:
+        write_interfacefile(os.path.join(module_path, ifile_name),
+                            modulename, args["code"],
+                            args["init_code"],
+                            args["additional_definitions"],
+                            args["additional_declarations"], system_headers,
+                            local_headers, wrap_headers, args["arrays"])
+
+    # Generate setup.py or native build commands if wanted
+    if args["generate_setup"] and not cmake_packages:
+        build_system = get_build_system()
+        if build_system == "native":
+            # Additional definitions precede and may affect the system
+            # headers, so these are not precompiled then
+            precompiled_headers = None
+            if use_precompiled_headers() and not args["additional_definitions"]:
+                precompiled_headers = args["system_headers"]
+            write_native_build(os.path.join(module_path, "build.json"),
+                               modulename, csrcs, cppsrcs, local_headers,
+                               include_dirs, library_dirs, libraries,
+                               swig_include_dirs, swigargs, cppargs, lddargs,
+                               precompiled_headers)
+        else:
+            setup_name = os.path.join(module_path, "setup.py")
             write_setup(setup_name, modulename, csrcs, cppsrcs, local_headers,
                         include_dirs, library_dirs, libraries,
                         swig_include_dirs, swigargs, cppargs, lddargs)
-            build_system = "distutils"
 
-        else:
-            write_cmakefile(modulename, cmake_packages, csrcs, cppsrcs,
-                            local_headers, include_dirs, library_dirs,
-                            libraries, swig_include_dirs, swigargs, cppargs,
-                            lddargs)
-            build_system = "cmake"
+    else:
+        write_cmakefile(modulename, cmake_packages, csrcs, cppsrcs,
+                        local_headers, include_dirs, library_dirs,
+                        libraries, swig_include_dirs, swigargs, cppargs,
+                        lddargs,
+                        os.path.join(module_path, "CMakeLists.txt"))
+        build_system = "cmake"
+
+    # --- Build module
+
+    # At this point we have all the files, and can make the total
+    # checksum from all file contents. This is used to decide
+    # whether the module needs recompilation or not.
+
+    # Compute new_compilation_checksum
+    # Collect arguments used for checksum creation,
+    # including everything that affects the module compilation.
+    # Since the interface file is included in allfiles,
+    # we don't need stuff that modifies it here.
+    checksum_args = ( \
+                     # We don't care about the modulename, that's what
+                     # we're trying to construct!
+                     #modulename,
+                     # We don't care where the user code resides:
+                     #source_directory,
+                     #code, init_code,
+                     #additional_definitions, additional_declarations,
+                     # Skipping filenames, since we use the file contents:
+                     #sources, wrap_headers,
+                     #local_headers,
+                     system_headers,
+                     include_dirs, library_dirs, libraries,
+                     swigargs, swig_include_dirs, cppargs, lddargs,
+                     object_files, #arrays,
+                     #generate_interface, generate_setup,
+                     # The signature isn't defined, and the
+                     # cache_dir doesn't affect the module:
+                     #signature, cache_dir)
+                     )
+    text = "\n".join((str(a) for a in checksum_args))
+    allfiles = sources + wrap_headers + local_headers + [ifile_name]
+    allfiles = [os.path.join(module_path, f) for f in allfiles]
+    new_compilation_checksum = compute_checksum(text, allfiles)
+
+    return new_compilation_checksum, build_system
+
+
+def _load_built_module(args, modulename, moduleids, module_path):
+    "Copy the compiled module to the cache if wanted, and import it."
+    # --- Load, cache, and return module
+
+    # Copy compiled module to cache
+    if args["modulename"] is None:
+        module_path = copy_to_cache(module_path, args["cache_dir"], modulename)
+
+    # Import module and place in memory cache
+    module = import_and_cache_module(module_path, modulename, moduleids)
 
-        # --- Build module
+    if not module:
+        instant_error("Failed to import newly compiled module!")
 
-        # At this point we have all the files, and can make the total
-        # checksum from all file contents. This is used to decide
-        # whether the module needs recompilation or not.
+    instant_debug("In instant.build_module: Returning %s from build_module."\
+        % module)
 
-        # Compute new_compilation_checksum
-        # Collect arguments used for checksum creation,
-        # including everything that affects the module compilation.
-        # Since the interface file is included in allfiles,
-        # we don't need stuff that modifies it here.
-        checksum_args = ( \
-                         # We don't care about the modulename, that's what
-                         # we're trying to construct!
-                         #modulename,
-                         # We don't care where the user code resides:
-                         #source_directory,
-                         #code, init_code,
-                         #additional_definitions, additional_declarations,
-                         # Skipping filenames, since we use the file contents:
-                         #sources, wrap_headers,
-                         #local_headers,
-                         system_headers,
-                         include_dirs, library_dirs, libraries,
-                         swigargs, swig_include_dirs, cppargs, lddargs,
-                         object_files, #arrays,
-                         #generate_interface, generate_setup,
-                         # The signature isn't defined, and the
-                         # cache_dir doesn't affect the module:
-                         #signature, cache_dir)
-                         )
-        text = "\n".join((str(a) for a in checksum_args))
-        allfiles = sources + wrap_headers + local_headers + [ifile_name]
-        new_compilation_checksum = compute_checksum(text, allfiles)
+    return module
 
-        # Recompile if necessary
-        recompile(modulename, module_path, new_compilation_checksum,
-                  build_system)
 
-        # --- Load, cache, and return module
+def _build_module_worker(spec):
+    "Build a module in a build_modules worker process."
+    # A forked worker must not share the temp directory of its parent,
+    # since it is deleted when the module is copied to the cache
+    paths._tmp_dir = None
+    try:
+        build_module(**spec)
+    finally:
+        delete_temp_dir()
 
-        # Copy compiled module to cache
-        if use_cache:
-            module_path = copy_to_cache(module_path, cache_dir, modulename)
 
-        # Import module and place in memory cache
-        module = import_and_cache_module(module_path, modulename, moduleids)
+def build_modules(specs, processes=None):
+    """Build a list of modules, compiling the ones not found in cache
+    concurrently.
 
-        if not module:
-            instant_error("Failed to import newly compiled module!")
+    Each item of B{specs} is a dict of keyword arguments to
+    C{build_module}. Identical modules are only built once, and
+    the modules found neither in the memory cache nor in the disk
+    cache are compiled in a pool of B{processes} worker processes,
+    by default one per CPU.
 
-        instant_debug("In instant.build_module: Returning %s from build_module."\
-            % module)
+    Returns a tuple C{(modules, report)}, where C{modules} is the list
+    of built modules in the same order as B{specs}, and C{report} is a
+    list with one of C{"memory"}, C{"disk"} or C{"compiled"} telling
+    where each module was found, or C{"duplicate"} if it was compiled
+    for an earlier item of B{specs}. Modules with an explicit modulename
+    are reported as C{"disk"} if their directory was up to date.
 
-        return module
-        # The end!
+    Usage:
 
-    finally:
-        # Always get back to original directory.
-        os.chdir(original_path)
+    >>> specs = [dict(code=c) for c in c_codes]
+    >>> modules, report = build_modules(specs, processes=8)
+    """
+    instant_assert(isinstance(specs, (list, tuple)),
+                   "In instant.build_modules: Expecting sequence.")
+    instant_assert(all(isinstance(spec, dict) for spec in specs),
+                   "In instant.build_modules: Expecting sequence of dicts.")
+    defaults = _default_arguments(build_module)
+
+    modules = [None]*len(specs)
+    report = [None]*len(specs)
+
+    # Look up all modules in memory and disk cache, and collect the
+    # misses, building each unique module only once. Explicitly named
+    # modules are built in place, and are up to date if their checksum
+    # file is left as it was.
+    misses = collections.OrderedDict()
+    stamps = {} # index of explicitly named miss -> (key, checksum file stamp)
+    for i, spec in enumerate(specs):
+        kwargs = dict(defaults)
+        kwargs.update(spec)
+        args = _validate_build_args(**kwargs)
+        module, modulename, moduleids = _module_ids(args)
+        if module:
+            modules[i], report[i] = module, "memory"
+            continue
+
+        if args["modulename"] is None:
+            key = (args["cache_dir"], modulename)
+            if key not in misses:
+                module = check_disk_cache(modulename, args["cache_dir"],
+                                          moduleids)
+            if module:
+                modules[i], report[i] = module, "disk"
+                continue
+            # Named after the computed module, the worker doesn't need
+            # the signature object, which may not be picklable
+            if args["signature"] is not None:
+                spec = dict(spec, signature=modulename)
+        else:
+            key = (os.path.abspath(modulename), modulename)
+            if key not in misses:
+                stamps[i] = key, _compilation_checksum_stamp(*key)
+        if key in misses:
+            report[i] = "duplicate"
+        else:
+            misses[key] = spec
+            report[i] = "compiled"
+
+    # Compile all misses
+    instant_info("--- Instant: building %d of %d modules ---" % (len(misses),
+                                                                len(specs)))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(misses))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(_build_module_worker, list(misses.values()))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for spec in misses.values():
+            build_module(**spec)
 
-    instant_error("In instant.build_module: Should never reach this point!")
-    # end build_module
+    for i, (key, stamp) in stamps.items():
+        if stamp is not None and stamp == _compilation_checksum_stamp(*key):
+            report[i] = "disk"
+
+    # Import the compiled modules, which are now found in the cache
+    for i, spec in enumerate(specs):
+        if modules[i] is None:
+            modules[i] = build_module(**spec)
+
+    return modules, report
+
+
+def _compilation_checksum_stamp(module_path, modulename):
+    """Return the modification time, size and inode of the checksum file
+    of the module in module_path, which change when it is compiled, or
+    None if it does not exist."""
+    try:
+        st = os.stat(_compilation_checksum_filename(modulename, module_path))
+    except OSError:
+        return None
+    return getattr(st, "st_mtime_ns", st.st_mtime), st.st_size, st.st_ino
 
 
 def build_module_vtk(c_code, cache_dir=None):
-    original_path = os.getcwd()
     cache_dir = validate_cache_dir(cache_dir)
     signature = modulename_from_checksum(compute_checksum(c_code))
     modulename = signature
     moduleids = [signature]
-    module_path = os.path.join(get_temp_dir(), modulename)
-
-    makedirs(module_path)
-    os.chdir(module_path)
+    build_path = tempfile.mkdtemp(prefix=modulename + ".", dir=get_temp_dir())
+    module_path = build_path
 
-    write_cmakefile(modulename)
-    s = generate_interface_file_vtk(signature, c_code)
-    write_vtk_interface_file(signature, c_code)
-
-    ret, output = get_status_output("cmake -DDEBUG=TRUE . > cmake.log ")
-    ret, output = get_status_output("make > compile.log ")
+    try:
+        write_itk_cmakefile(modulename, module_path)
+        write_vtk_interface_file(signature, c_code, module_path)
 
-    module_path = copy_to_cache(module_path, cache_dir, modulename)
+        ret, output = get_status_output("cmake -DDEBUG=TRUE .", cwd=module_path)
+        write_file(os.path.join(module_path, "cmake.log"), output)
+        ret, output = get_status_output("make", cwd=module_path)
+        write_file(os.path.join(module_path, "compile.log"), output)
 
-    os.chdir(original_path)
+        module_path = copy_to_cache(module_path, cache_dir, modulename)
+    finally:
+        shutil.rmtree(build_path, ignore_errors=True)
 
     module = import_and_cache_module(module_path, modulename, moduleids)
 
@@ -630,26 +1370,25 @@ def build_module_vtk(c_code, cache_dir=None):
 
 
 def build_module_vmtk(c_code, cache_dir=None):
-    original_path = os.getcwd()
     cache_dir = validate_cache_dir(cache_dir)
     signature = modulename_from_checksum(compute_checksum(c_code))
     modulename = signature
     moduleids = [signature]
-    module_path = os.path.join(get_temp_dir(), modulename)
-
-    makedirs(module_path)
-    os.chdir(module_path)
+    build_path = tempfile.mkdtemp(prefix=modulename + ".", dir=get_temp_dir())
+    module_path = build_path
 
-    write_vmtk_cmakefile(modulename)
-    s = generate_interface_file_vtk(signature, c_code)
-    write_vtk_interface_file(signature, c_code)
-
-    ret, output = get_status_output("cmake -DDEBUG=TRUE . > cmake.log ")
-    ret, output = get_status_output("make > compile.log ")
+    try:
+        write_vmtk_cmakefile(modulename, module_path)
+        write_vtk_interface_file(signature, c_code, module_path)
 
-    module_path = copy_to_cache(module_path, cache_dir, modulename)
+        ret, output = get_status_output("cmake -DDEBUG=TRUE .", cwd=module_path)
+        write_file(os.path.join(module_path, "cmake.log"), output)
+        ret, output = get_status_output("make", cwd=module_path)
+        write_file(os.path.join(module_path, "compile.log"), output)
 
-    os.chdir(original_path)
+        module_path = copy_to_cache(module_path, cache_dir, modulename)
+    finally:
+        shutil.rmtree(build_path, ignore_errors=True)
 
     module = import_and_cache_module(module_path, modulename, moduleids)
 
@@ -30,9 +30,26 @@ Example operations:
 #
 # Alternatively, Instant may be distributed under the terms of the BSD license.
 
+from six import string_types
 import os, sys, re
+import errno, shutil, tempfile
+import threading
+import time
+import atexit
+import hashlib
+import collections
+import weakref
 from .output import instant_warning, instant_assert, instant_debug
-from .paths import get_default_cache_dir, validate_cache_dir
+from .paths import get_default_cache_dir, validate_cache_dir, \
+     get_default_build_cache_dir, makedirs, get_cache_tiers, is_writable_tier
+from .locking import file_lock
+from .config import get_memory_cache_size, use_weak_memory_cache, \
+     get_cache_max_size, get_cache_max_modules, get_toolchain_fingerprint, \
+     get_cache_layout, use_cache_promotion, use_cache_access_tracking, \
+     get_build_cache_max_size
+from .index import index_is_new, index_set_filled, index_publish, \
+     index_remove, index_record_hits, index_entries, index_clear, \
+     index_move, index_lookup
 from .signatures import compute_checksum
 
 # TODO: We could make this an argument, but it's used indirectly
@@ -48,36 +65,168 @@ def checksum_from_modulename(modulename):
     return modulename.remove(_modulename_prefix)
 
 
+# Serializes the modification of sys.path between threads
+_import_lock = threading.RLock()
+
 def import_module_directly(path, modulename):
     "Import a module with the given module name that resides in the given path."
-    sys.path.insert(0, path)
-    er = None
-    try:
-            module = __import__(modulename)
-    except BaseException as e:
-        instant_warning("In instant.import_module_directly: Failed to import module '%s' from '%s';\n%s:%s;" % (modulename, path, type(e).__name__, e))
-        module = None
-        er = e
-    finally:
-        sys.path.pop(0)
+    with _import_lock:
+        sys.path.insert(0, path)
+        er = None
+        try:
+                module = __import__(modulename)
+        except BaseException as e:
+            instant_warning("In instant.import_module_directly: Failed to import module '%s' from '%s';\n%s:%s;" % (modulename, path, type(e).__name__, e))
+            module = None
+            er = e
+        finally:
+            sys.path.pop(0)
     return module, er
 
 
-_memory_cache = {}
+class _HashedKey(object):
+    """A dict key holding value and its hash, so that value, which may be
+    a signature object with an expensive __hash__, is hashed only once
+    however many dicts the key is looked up in."""
+    __slots__ = ("value", "hash")
+
+    def __init__(self, value):
+        self.value = value
+        self.hash = hash(value)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return isinstance(other, _HashedKey) and self.hash == other.hash \
+               and (self.value is other.value or self.value == other.value)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def _move_to_end(d, key):
+    "Move key to the end of the OrderedDict d."
+    if hasattr(d, "move_to_end"):
+        d.move_to_end(key)
+    else:
+        # Python 2
+        d[key] = d.pop(key)
+
+
+# Loaded modules by module id, in order of last use, as the modules
+# themselves or weak references to them. The ids are wrapped in
+# _HashedKey, hashing them once per lookup.
+_memory_cache_lock = threading.Lock()
+_memory_cache = collections.OrderedDict()
+_memory_cache_statistics = {"hits": 0, "misses": 0, "evictions": 0}
+
 def memory_cached_module(moduleid):
     "Returns the cached module if found."
-    import sys
-    module = _memory_cache.get(moduleid, None)
-    instant_debug("Found '%s' in memory cache with key '%r'." % (module,
-                                                                 moduleid))
+    key = _HashedKey(moduleid)
+    with _memory_cache_lock:
+        entry = _memory_cache.get(key)
+        module = entry() if isinstance(entry, weakref.ref) else entry
+        if module is not None:
+            # Most recently used last
+            _move_to_end(_memory_cache, key)
+        _memory_cache_statistics["hits" if module is not None
+                                 else "misses"] += 1
+    instant_debug("Found '%s' in memory cache with key '%r'.", module,
+                  moduleid)
     return module
 
 
 def place_module_in_memory_cache(moduleid, module):
-    "Place a compiled module in cache with given id."
-    _memory_cache[moduleid] = module
+    """Place a compiled module in cache with given id, evicting the least
+    recently used entries if the cache is full, see get_memory_cache_size."""
+    size = get_memory_cache_size()
+    entry = _memory_cache_entry(module)
+    key = _HashedKey(moduleid)
+    evicted = []
+    with _memory_cache_lock:
+        _memory_cache.pop(key, None)
+        _memory_cache[key] = entry
+        while size is not None and len(_memory_cache) > size:
+            evicted.append(_memory_cache.popitem(last=False))
+            _memory_cache_statistics["evictions"] += 1
     instant_debug("Added module '%s' to cache with key '%r'." % (module,
                                                                  moduleid))
+    for key, entry in evicted:
+        instant_debug("Evicted key '%r' from memory cache." % (key.value,))
+    _forget_modules([entry for key, entry in evicted])
+
+
+def _memory_cache_entry(module):
+    """Return the memory cache entry of module. With a weak memory cache,
+    the module is also removed from sys.modules, so it can be freed once
+    no longer used elsewhere."""
+    if not use_weak_memory_cache():
+        return module
+    _remove_from_sys_modules(module)
+    return weakref.ref(module)
+
+
+def _forget_modules(entries):
+    """Remove the modules of the memory cache entries from sys.modules,
+    with their submodules, unless still in the memory cache."""
+    with _memory_cache_lock:
+        cached = set(id(m() if isinstance(m, weakref.ref) else m)
+                     for m in _memory_cache.values())
+    for module in entries:
+        if isinstance(module, weakref.ref):
+            module = module()
+        if module is not None and id(module) not in cached:
+            _remove_from_sys_modules(module)
+
+
+def _remove_from_sys_modules(module):
+    "Remove module and its submodules from sys.modules."
+    name = getattr(module, "__name__", None)
+    if name is None:
+        return
+    with _import_lock:
+        for key in list(sys.modules):
+            if key == name or key.startswith(name + "."):
+                del sys.modules[key]
+
+
+def evict_memory_cached_module(moduleid):
+    """Remove the module with the given id from the memory cache, along
+    with its other ids. Returns True if the module was found."""
+    with _memory_cache_lock:
+        module = _memory_cache.pop(_HashedKey(moduleid), None)
+        if isinstance(module, weakref.ref):
+            module = module()
+        if module is None:
+            return False
+        aliases = [k for k, m in _memory_cache.items()
+                   if (m() if isinstance(m, weakref.ref) else m) is module]
+        for key in aliases:
+            del _memory_cache[key]
+        _memory_cache_statistics["evictions"] += 1 + len(aliases)
+    _forget_modules([module])
+    return True
+
+
+def clear_memory_cache():
+    "Remove all modules from the memory cache."
+    with _memory_cache_lock:
+        entries = list(_memory_cache.values())
+        _memory_cache_statistics["evictions"] += len(entries)
+        _memory_cache.clear()
+    _forget_modules(entries)
+
+
+def memory_cache_statistics():
+    """Return a dict with the number of lookups in the memory cache in
+    this process which found a module (hits) and which did not (misses),
+    the number of entries evicted (evictions) and the current number of
+    entries (size)."""
+    with _memory_cache_lock:
+        statistics = dict(_memory_cache_statistics)
+        statistics["size"] = len(_memory_cache)
+    return statistics
 
 
 def is_valid_module_name(name):
@@ -132,19 +281,156 @@ def check_memory_cache(moduleid):
     return None, moduleids
 
 
+# Namespaces are subdirectories of this directory in the cache directory
+_namespace_dirname = "namespaces"
+
+def namespace_cache_dir(cache_dir=None, namespace=None):
+    """Return the cache directory of the namespace in the cache directory,
+    or the cache directory itself if namespace is None.
+
+    Namespaces separate the modules of different users of one cache
+    directory, each with its own index, quota and statistics, so that
+    for example instant-clean --namespace ffc only removes the modules
+    built in the namespace ffc."""
+    cache_dir = validate_cache_dir(cache_dir)
+    if namespace is None:
+        return cache_dir
+    instant_assert(isinstance(namespace, string_types)
+                   and bool(re.search(r"^\w[\w.-]*$", namespace)),
+                   "Expecting namespace to be a name of letters, digits,"\
+                   " '_', '.' and '-', got %r." % (namespace,))
+    return validate_cache_dir(os.path.join(cache_dir, _namespace_dirname,
+                                           namespace))
+
+
+def cache_namespaces(cache_dir=None):
+    "Return a list with the names of the namespaces in the cache directory."
+    path = os.path.join(validate_cache_dir(cache_dir), _namespace_dirname)
+    if not os.path.isdir(path):
+        return []
+    return sorted(f for f in os.listdir(path)
+                  if os.path.isdir(os.path.join(path, f)))
+
+
+def _cache_namespace(cache_dir):
+    "Return the namespace of the cache directory, or None if it is not one."
+    parent, namespace = os.path.split(cache_dir)
+    if os.path.basename(parent) == _namespace_dirname:
+        return namespace
+    return None
+
+
+def cached_module_path(cache_dir, modulename):
+    """Return the path of a new module in the cache directory. With the
+    sharded layout, see get_cache_layout, this is in the directory
+    cache_dir/ab/cd where abcd are the first hex digits of the sha1 of
+    the module name, which keeps directories small in large caches."""
+    if get_cache_layout() == "flat":
+        return os.path.join(cache_dir, modulename)
+    h = hashlib.sha1(modulename.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, h[:2], h[2:4], modulename)
+
+
+def _cached_module_paths(cache_dir, modulename):
+    "Return the paths a module may have in the cache directory, see cached_module_path."
+    flat = os.path.join(cache_dir, modulename)
+    h = hashlib.sha1(modulename.encode("utf-8")).hexdigest()
+    sharded = os.path.join(cache_dir, h[:2], h[2:4], modulename)
+    if get_cache_layout() == "flat":
+        return [flat, sharded]
+    return [sharded, flat]
+
+
+def find_cached_module(cache_dir, modulename):
+    """Return the path of a finished module in the cache directory, in
+    the sharded or the flat layout, or None if not found."""
+    for path in _cached_module_paths(cache_dir, modulename):
+        if os.path.exists(os.path.join(path, "finished_copying")):
+            return path
+    return None
+
+
+def _indexed_module_paths(cache_dir, modulename):
+    """Return the paths to look for a module in the cache directory: its
+    path in the index of the cache directory, none if it is not indexed,
+    or all paths it may have if the index can not be used."""
+    paths = _cached_module_paths(cache_dir, modulename)
+    path = index_lookup(cache_dir, modulename)
+    if path == "":
+        return []
+    if path in paths:
+        return [path]
+    # No index, or one of a cache directory since moved
+    return paths
+
+
+def _tier_cache_dirs(cache_dir):
+    """Return the existing cache directories to search for modules of the
+    cache directory, in order. If it is a cache tier or the namespace of
+    one, see get_cache_tiers, these are the same directory in each tier,
+    otherwise only cache_dir itself."""
+    tiers = get_cache_tiers()
+    for tier in tiers:
+        rel = os.path.relpath(cache_dir, tier)
+        parts = rel.split(os.sep)
+        if rel == "." or (len(parts) == 2 and parts[0] == _namespace_dirname):
+            return [d for d in (os.path.normpath(os.path.join(t, rel))
+                                for t in tiers)
+                    if d == cache_dir or os.path.isdir(d)]
+    return [cache_dir]
+
+
 def check_disk_cache(modulename, cache_dir, moduleids):
+    """Import a module found in the current directory or the cache.
+
+    The cache directory is searched in each cache tier, see
+    get_cache_tiers. Modules found in a tier other than cache_dir are
+    copied to it if use_cache_promotion() is True.
+
+    This takes no locks and does not write to the cache, as modules are
+    published to the cache by an atomic rename, see copy_to_cache. Only
+    unfinished module directories are waited for with a shared lock.
+    The module is looked up in the index of each cache directory, see
+    instant.index, and only searched for in both layouts if there is no
+    usable index."""
     # Ensure a valid cache_dir
     cache_dir = validate_cache_dir(cache_dir)
 
-    # Check on disk, in current directory and cache directory
-    for path in (os.getcwd(), cache_dir):
-        if os.path.exists(os.path.join(path, modulename, "finished_copying")):
+    # Check on disk, in current directory and cache directory of each tier
+    candidates = [(None, os.path.join(os.getcwd(), modulename))]
+    for tier_dir in _tier_cache_dirs(cache_dir):
+        candidates += [(tier_dir, module_path) for module_path
+                       in _indexed_module_paths(tier_dir, modulename)]
+    for tier_dir, module_path in candidates:
+        path = os.path.dirname(module_path)
+        finished = os.path.join(module_path, "finished_copying")
+        # Read-only tiers are neither locked nor written to
+        writable = tier_dir is not None and is_writable_tier(tier_dir)
+        if writable and not os.path.exists(finished) \
+                and os.path.isdir(module_path):
+            # The module may be copied into the cache by an older Instant
+            # holding the lock, wait for it along with other readers
+            with file_lock(path, modulename, shared=True):
+                pass
+        if os.path.exists(finished):
+            if writable:
+                _record_access(tier_dir, modulename, finished)
 
             # Found existing directory, try to import and place in memory cache
-            module = import_and_cache_module(path, modulename, moduleids)
+            try:
+                module = import_and_cache_module(path, modulename, moduleids)
+            except AssertionError:
+                if os.path.exists(finished):
+                    raise
+                # Evicted while importing it, see evict_cached_module
+                module = None
             if module:
                 instant_debug("In instant.check_disk_cache: Imported module "\
                               "'%s' from '%s'." % (modulename, path))
+                if tier_dir is not None:
+                    _record_disk_cache(tier_dir, hits=1)
+                if tier_dir not in (None, cache_dir) and use_cache_promotion():
+                    _promote_module(module_path, cache_dir, modulename)
                 return module
             else:
                 instant_debug("In instant.check_disk_cache: Failed to import "\
@@ -153,10 +439,23 @@ def check_disk_cache(modulename, cache_dir, moduleids):
     # All attempts failed
     instant_debug("In instant.check_disk_cache: Can't import module with modulename "\
                   "%r using cache directory %r." % (modulename, cache_dir))
+    _record_disk_cache(cache_dir, misses=1)
     return None
 
 
-def import_module(moduleid, cache_dir=None):
+def _promote_module(module_path, cache_dir, modulename):
+    "Copy a module found in a slower cache tier to the cache directory."
+    from .build import copy_to_cache
+    try:
+        copy_to_cache(module_path, cache_dir, modulename)
+    except Exception as e:
+        instant_warning("In instant.check_disk_cache: Failed to copy module"\
+                        " '%s' to '%s': %s" % (modulename, cache_dir, e))
+        return
+    _record_disk_cache(cache_dir, promotions=1)
+
+
+def import_module(moduleid, cache_dir=None, namespace=None):
     """Import module from cache given its moduleid and an optional cache directory.
 
     The moduleid can be either
@@ -166,6 +465,8 @@ def import_module(moduleid, cache_dir=None):
       - a hashable non-string object with a function moduleid.signature() which is used to get a signature string
     The hashable object is used to look up in the memory cache before signature() is called.
     If the module is found on disk, it is placed in the memory cache.
+    The module is looked up in the given namespace of the cache directory,
+    see namespace_cache_dir.
     """
     # Look for module in memory cache
     module, moduleids = check_memory_cache(moduleid)
@@ -173,10 +474,529 @@ def import_module(moduleid, cache_dir=None):
 
     # Look for module in disk cache
     modulename = moduleids[-1]
-    return check_disk_cache(modulename, cache_dir, moduleids)
+    return check_disk_cache(modulename, namespace_cache_dir(cache_dir, namespace),
+                            moduleids)
+
+
+def cached_modules(cache_dir=None, namespace=None):
+    """Return a list with the names of all cached modules in the namespace
+    of the cache directory, from its index, see instant.index."""
+    return [entry["name"] for entry in cached_module_entries(cache_dir,
+                                                             namespace)]
+
+
+def cached_module_entries(cache_dir=None, namespace=None):
+    """Return a list of dicts describing the cached modules, in order of
+    last access, with the keys
+      - name: The module name.
+      - path: The path of the module.
+      - size: The total size of its files in bytes.
+      - build_time: The time it was published to the cache.
+      - last_access: The time of its last hit, or of its publication,
+        see use_cache_access_tracking.
+      - hits: Its number of hits recorded so far, if any.
+      - toolchain: The fingerprint of the toolchain which built it, see
+        get_toolchain_fingerprint.
+    The entries are read from the index of the namespace of the cache
+    directory, or found in it if the index is unavailable."""
+    cache_dir = namespace_cache_dir(cache_dir, namespace)
+    if index_is_new(cache_dir):
+        rebuild_cache_index(cache_dir, clear=False)
+    entries = index_entries(cache_dir)
+    if entries is None:
+        entries = sorted(_scan_cached_modules(cache_dir),
+                         key=lambda e: e["last_access"])
+    return entries
+
+
+def _scan_cached_modules(cache_dir):
+    "Return cached_module_entries of the finished modules in cache_dir."
+    entries = []
+    for name, path in _module_directories(cache_dir):
+        try:
+            atime = os.stat(os.path.join(path, "finished_copying")).st_mtime
+        except OSError:
+            # Not finished yet
+            continue
+        entries.append(dict(name=name, path=path, size=_module_size(path),
+                            build_time=atime, last_access=atime, hits=0,
+                            toolchain=None))
+    return entries
+
+
+def _is_shard(name):
+    return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+
+def _module_directories(cache_dir):
+    """Return a list of tuples (modulename, path) of the module directories
+    in cache_dir, in the flat and the sharded layout."""
+    directories = []
+    # Hidden directories are modules being built, published or evicted
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(".") or name == _namespace_dirname \
+                or not os.path.isdir(path):
+            continue
+        if not _is_shard(name) \
+                or os.path.exists(os.path.join(path, "finished_copying")):
+            directories.append((name, path))
+            continue
+        for shard in os.listdir(path):
+            if not _is_shard(shard):
+                continue
+            shard_path = os.path.join(path, shard)
+            directories.extend((f, os.path.join(shard_path, f))
+                               for f in os.listdir(shard_path)
+                               if not f.endswith(".lock"))
+    return directories
+
+
+def rebuild_cache_index(cache_dir=None, clear=True):
+    """Add the modules found in the cache directory to its index, first
+    removing all entries if clear is True. This is done automatically
+    when the index is created, and only needed if modules were added or
+    removed without Instant."""
+    cache_dir = validate_cache_dir(cache_dir)
+    if clear:
+        index_clear(cache_dir)
+    for entry in _scan_cached_modules(cache_dir):
+        index_publish(cache_dir, entry["name"], entry["path"], entry["size"],
+                      entry["build_time"], entry["toolchain"], replace=False)
+    index_set_filled(cache_dir)
 
 
-def cached_modules(cache_dir=None):
-    "Return a list with the names of all cached modules."
+def record_published_module(cache_dir, modulename, replace=True):
+    """Add a module just published to the cache directory to its index,
+    see copy_to_cache. An existing entry is kept unless replace is True."""
+    cache_dir = validate_cache_dir(cache_dir)
+    if index_is_new(cache_dir):
+        rebuild_cache_index(cache_dir, clear=False)
+    path = find_cached_module(cache_dir, modulename)
+    if path is None:
+        # Already evicted
+        return
+    build_time = os.path.getmtime(os.path.join(path, "finished_copying"))
+    index_publish(cache_dir, modulename, path, _module_size(path), build_time,
+                  get_toolchain_fingerprint(), replace)
+
+
+# The last access of a cached module is the modification time of its
+# finished_copying file. If use_cache_access_tracking() is True, it is
+# updated on hits at most this often in seconds, so that most hits do
+# not write to the cache, and the hits are added to the index at the
+# same time, or when the process exits. Otherwise hits write nothing
+# and the last access is the time the module was published.
+_access_resolution = 600.0
+_pending_hits_lock = threading.Lock()
+_pending_hits = {} # cache_dir -> {modulename: number of hits}
+_pending_hits_flushed_at_exit = False
+
+# Statistics of the disk caches in this process, by cache directory
+_disk_statistics_lock = threading.Lock()
+_disk_statistics = {} # cache_dir -> dict, see disk_cache_statistics
+
+def _empty_disk_statistics():
+    return dict(hits=0, misses=0, evictions=0, evicted_bytes=0, promotions=0)
+
+
+def _record_disk_cache(cache_dir, **counts):
+    "Add the counts to the statistics of the cache directory."
+    with _disk_statistics_lock:
+        statistics = _disk_statistics.setdefault(cache_dir,
+                                                 _empty_disk_statistics())
+        for name, n in counts.items():
+            statistics[name] += n
+
+def _record_access(cache_dir, modulename, finished):
+    """Record a hit of a module in the cache directory, with the file
+    finished in its directory, if use_cache_access_tracking() is True."""
+    global _pending_hits_flushed_at_exit
+    if not use_cache_access_tracking():
+        return
+    with _pending_hits_lock:
+        if not _pending_hits_flushed_at_exit:
+            atexit.register(_flush_all_pending_hits)
+            _pending_hits_flushed_at_exit = True
+        hits = _pending_hits.setdefault(cache_dir, {})
+        hits[modulename] = hits.get(modulename, 0) + 1
+    try:
+        t = time.time()
+        if t - os.stat(finished).st_mtime > _access_resolution:
+            os.utime(finished, (t, t))
+            _flush_pending_hits(cache_dir, t)
+    except OSError:
+        # A read-only cache, or the module was just evicted
+        pass
+
+
+def _flush_pending_hits(cache_dir, last_access):
+    "Add the hits recorded in this process to the index of cache_dir."
+    with _pending_hits_lock:
+        hits = _pending_hits.pop(cache_dir, {})
+    index_record_hits(cache_dir, hits, last_access)
+
+
+def _flush_all_pending_hits():
+    for cache_dir in list(_pending_hits):
+        _flush_pending_hits(cache_dir, None)
+
+
+def _module_size(path):
+    "Return the total size in bytes of the files in the directory path."
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def evict_cached_module(modulename, cache_dir=None, accessed_before=None):
+    """Remove a module from the cache directory. Returns its size in
+    bytes if it was removed, None otherwise.
+
+    The module is renamed to a hidden directory holding its lock, which
+    is atomic, before it is deleted, so builders and readers either see
+    the whole module or none of it. If accessed_before is given, the
+    module is only removed if it was not accessed since that time."""
+    cache_dir = validate_cache_dir(cache_dir)
+    path = find_cached_module(cache_dir, modulename)
+    if path is None:
+        # Removed without Instant
+        index_remove(cache_dir, modulename)
+        return None
+    with file_lock(os.path.dirname(path), modulename):
+        try:
+            atime = os.stat(os.path.join(path, "finished_copying")).st_mtime
+        except OSError:
+            # Evicted by another process
+            return None
+        # Allow for the resolution of file times
+        if accessed_before is not None and atime > accessed_before + 1.0:
+            return None
+        size = _module_size(path)
+        evicted_path = tempfile.mkdtemp(prefix="." + modulename + ".",
+                                        dir=cache_dir)
+        os.rename(path, os.path.join(evicted_path, modulename))
+        index_remove(cache_dir, modulename)
+    shutil.rmtree(evicted_path, ignore_errors=True)
+    instant_debug("In instant.evict_cached_module: Removed module %r of %d"\
+                  " bytes from %r." % (modulename, size, cache_dir))
+    _record_disk_cache(cache_dir, evictions=1, evicted_bytes=size)
+    return size
+
+
+# Hidden directories in a cache directory are the staging directories
+# of modules being built, published or evicted, see copy_to_cache and
+# evict_cached_module. Those not modified for this many seconds were
+# left behind by killed processes.
+_abandoned_staging_age = 24*3600.0
+
+def remove_abandoned_staging_dirs(cache_dir=None):
+    """Remove the staging directories in the cache directory which have
+    not been modified for a day, left behind by killed builds. Returns
+    the number of directories removed."""
     cache_dir = validate_cache_dir(cache_dir)
-    return os.listdir(cache_dir)
+    t = time.time()
+    removed = 0
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not name.startswith(".") or not os.path.isdir(path):
+            continue
+        try:
+            if t - os.lstat(path).st_mtime < _abandoned_staging_age:
+                continue
+        except OSError:
+            # Published or removed meanwhile
+            continue
+        instant_debug("In instant.remove_abandoned_staging_dirs: Removing"\
+                      " %r." % path)
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+    return removed
+
+
+def enforce_cache_quota(cache_dir=None, exclude=()):
+    """Remove the least recently used modules from the cache directory
+    until it is within the quota set by get_cache_max_size and
+    get_cache_max_modules, for its namespace if it is the cache directory
+    of one. Modules in exclude are kept. Returns the names of the
+    removed modules.
+
+    Only one process enforces the quota of a cache directory at a time,
+    others wait for it and then find the cache within the quota. Staging
+    directories abandoned by killed builds are removed first, see
+    remove_abandoned_staging_dirs."""
+    cache_dir = validate_cache_dir(cache_dir)
+    remove_abandoned_staging_dirs(cache_dir)
+    namespace = _cache_namespace(cache_dir)
+    max_size = get_cache_max_size(namespace)
+    max_modules = get_cache_max_modules(namespace)
+    if max_size is None and max_modules is None:
+        return []
+
+    evicted = []
+    with file_lock(cache_dir, ".quota"):
+        entries = [(e["last_access"], e["size"], e["name"])
+                   for e in cached_module_entries(cache_dir)]
+        size = sum(e[1] for e in entries)
+        count = len(entries)
+        for atime, module_size, modulename in entries:
+            if (max_size is None or size <= max_size) \
+                    and (max_modules is None or count <= max_modules):
+                break
+            if modulename in exclude:
+                continue
+            # Keep modules used since the listing
+            if evict_cached_module(modulename, cache_dir, atime) is not None:
+                size -= module_size
+                count -= 1
+                evicted.append(modulename)
+    if evicted:
+        instant_debug("In instant.enforce_cache_quota: Removed %d modules"\
+                      " from %r." % (len(evicted), cache_dir))
+    return evicted
+
+
+def migrate_cache_layout(cache_dir=None):
+    """Move the modules in the cache directory which are not placed as
+    new modules would be, see cached_module_path, to that place. Returns
+    the number of modules moved.
+
+    Each module is moved by a rename holding the locks of its old and
+    new place, so concurrent builders and readers see it in at least one
+    of them."""
+    cache_dir = validate_cache_dir(cache_dir)
+    moved = 0
+    for modulename, path in _module_directories(cache_dir):
+        new_path = cached_module_path(cache_dir, modulename)
+        if path == new_path:
+            continue
+        makedirs(os.path.dirname(new_path))
+        with file_lock(os.path.dirname(path), modulename), \
+             file_lock(os.path.dirname(new_path), modulename):
+            if not os.path.exists(os.path.join(path, "finished_copying")):
+                continue
+            if os.path.exists(os.path.join(new_path, "finished_copying")):
+                # Already in place, remove the old copy
+                old_path = tempfile.mkdtemp(prefix="." + modulename + ".",
+                                            dir=cache_dir)
+                os.rename(path, os.path.join(old_path, modulename))
+                shutil.rmtree(old_path, ignore_errors=True)
+            else:
+                os.rename(path, new_path)
+                index_move(cache_dir, modulename, new_path)
+                moved += 1
+    instant_debug("In instant.migrate_cache_layout: Moved %d modules in %r."\
+                  % (moved, cache_dir))
+    return moved
+
+
+def disk_cache_statistics(cache_dir=None, namespace=None):
+    """Return a dict with statistics of the disk cache in this process:
+      - hits: The number of modules found in the cache directory.
+      - misses: The number of modules not found.
+      - evictions: The number of modules removed from it, see
+        evict_cached_module.
+      - evicted_bytes: The total size of the removed modules in bytes.
+      - promotions: The number of modules copied to it from slower cache
+        tiers, see check_disk_cache.
+    Hits are counted in the cache tier the module was found in. The
+    statistics are those of the given cache directory and namespace,
+    or the totals of all cache directories if neither is given."""
+    with _disk_statistics_lock:
+        if cache_dir is None and namespace is None:
+            statistics = _empty_disk_statistics()
+            for s in _disk_statistics.values():
+                for name in statistics:
+                    statistics[name] += s[name]
+            return statistics
+    cache_dir = namespace_cache_dir(cache_dir, namespace)
+    with _disk_statistics_lock:
+        return dict(_disk_statistics.get(cache_dir, _empty_disk_statistics()))
+
+
+# Statistics of the build cache, kind -> {"hits": n, "misses": n}
+_build_cache_statistics_lock = threading.Lock()
+_build_cache_statistics = {}
+
+# The last use of a build cache entry is the modification time of its
+# directory. Storing an entry checks the quota of the build cache, see
+# get_build_cache_max_size, if it was not checked for this many seconds.
+_build_cache_quota_interval = 600.0
+
+def _build_cache_entry(kind, key):
+    return os.path.join(get_default_build_cache_dir(), kind, key[:2], key)
+
+
+def fetch_build_cache(kind, key, files):
+    """Copy the files cached under the given kind and key out of the
+    build cache, files being a dict mapping names in the cache entry to
+    destination paths.
+
+    The build cache holds intermediate build results, such as object
+    files, shared between all module caches. Returns True if found."""
+    entry = _build_cache_entry(kind, key)
+    if os.path.isdir(entry):
+        try:
+            for name, dest in files.items():
+                shutil.copyfile(os.path.join(entry, name), dest)
+        except (IOError, OSError):
+            if os.path.isdir(entry):
+                raise
+            # Removed by enforce_build_cache_quota meanwhile
+            _record_build_cache(kind, "misses")
+            return False
+        # Record the use of the entry for enforce_build_cache_quota
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        instant_debug("In instant.fetch_build_cache: Found %s %s." % (kind, key))
+        _record_build_cache(kind, "hits")
+        return True
+    _record_build_cache(kind, "misses")
+    return False
+
+
+def _record_build_cache(kind, outcome):
+    "Count a hit or miss of the build cache, from any compile thread."
+    with _build_cache_statistics_lock:
+        statistics = _build_cache_statistics.setdefault(kind, {"hits": 0,
+                                                               "misses": 0})
+        statistics[outcome] += 1
+
+
+def store_build_cache(kind, key, files):
+    """Store files in the build cache under the given kind and key,
+    files being a dict mapping names in the cache entry to source paths.
+
+    Entries are published atomically by renaming a complete staging
+    directory, so concurrent processes never see partial entries."""
+    entry = _build_cache_entry(kind, key)
+    if os.path.isdir(entry):
+        return
+    parent = os.path.dirname(entry)
+    try:
+        os.makedirs(parent)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    staging = tempfile.mkdtemp(prefix=".staging-", dir=parent)
+    try:
+        for name, src in files.items():
+            shutil.copyfile(src, os.path.join(staging, name))
+        os.rename(staging, entry)
+    except OSError:
+        # Another process stored the same entry first
+        if not os.path.isdir(entry):
+            raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    _check_build_cache_quota()
+
+
+def _check_build_cache_quota():
+    "Enforce the quota of the build cache if it was not checked recently."
+    checked = os.path.join(get_default_build_cache_dir(), ".quota_checked")
+    try:
+        if time.time() - os.stat(checked).st_mtime < _build_cache_quota_interval:
+            return
+    except OSError:
+        pass
+    enforce_build_cache_quota()
+
+
+def _build_cache_directories():
+    """Return a list of tuples (kind, name, path) of the directories in
+    the build cache, entries and hidden staging directories."""
+    build_cache_dir = get_default_build_cache_dir()
+    directories = []
+    for kind in os.listdir(build_cache_dir):
+        kind_path = os.path.join(build_cache_dir, kind)
+        if kind.startswith(".") or not os.path.isdir(kind_path):
+            continue
+        for shard in os.listdir(kind_path):
+            shard_path = os.path.join(kind_path, shard)
+            if not os.path.isdir(shard_path):
+                continue
+            directories.extend((kind, name, os.path.join(shard_path, name))
+                               for name in os.listdir(shard_path))
+    return directories
+
+
+def build_cache_entries():
+    """Return a list of dicts describing the entries of the build cache,
+    in order of last use, with the keys
+      - kind: The kind of build results, such as "objects".
+      - key: The key of the entry.
+      - path: The directory of the entry.
+      - size: The total size of its files in bytes.
+      - last_access: The time it was last stored or fetched."""
+    entries = []
+    for kind, key, path in _build_cache_directories():
+        if key.startswith("."):
+            continue
+        try:
+            atime = os.stat(path).st_mtime
+        except OSError:
+            # Removed meanwhile
+            continue
+        entries.append(dict(kind=kind, key=key, path=path,
+                            size=_module_size(path), last_access=atime))
+    return sorted(entries, key=lambda e: e["last_access"])
+
+
+def enforce_build_cache_quota():
+    """Remove the least recently used entries of the build cache until it
+    is within get_build_cache_max_size(), and the staging directories
+    abandoned by killed processes. Returns the number of entries removed.
+
+    Entries are renamed to a hidden directory before they are deleted,
+    so concurrent processes fetch either all files of an entry or none."""
+    build_cache_dir = get_default_build_cache_dir()
+    max_size = get_build_cache_max_size()
+    removed = 0
+    with file_lock(build_cache_dir, ".quota"):
+        t = time.time()
+        for kind, name, path in _build_cache_directories():
+            try:
+                if name.startswith(".") and \
+                        t - os.lstat(path).st_mtime > _abandoned_staging_age:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+        entries = build_cache_entries()
+        size = sum(e["size"] for e in entries)
+        for entry in entries:
+            if max_size is None or size <= max_size:
+                break
+            evicted_path = tempfile.mkdtemp(prefix=".evicted-",
+                                            dir=os.path.dirname(entry["path"]))
+            try:
+                os.rename(entry["path"], os.path.join(evicted_path, entry["key"]))
+            except OSError:
+                # Removed by hand meanwhile
+                pass
+            else:
+                size -= entry["size"]
+                removed += 1
+            shutil.rmtree(evicted_path, ignore_errors=True)
+        with open(os.path.join(build_cache_dir, ".quota_checked"), "a"):
+            pass
+        os.utime(os.path.join(build_cache_dir, ".quota_checked"), None)
+    if removed:
+        instant_debug("In instant.enforce_build_cache_quota: Removed %d"\
+                      " entries from %r." % (removed, build_cache_dir))
+    return removed
+
+
+def build_cache_statistics():
+    """Return a dict with the number of hits and misses in the build
+    cache in this process, for each kind of cached build results."""
+    with _build_cache_statistics_lock:
+        return dict((kind, dict(s))
+                    for kind, s in _build_cache_statistics.items())
@@ -23,9 +23,9 @@
 # Alternatively, Instant may be distributed under the terms of the BSD license.
 
 import sys
-import re, os, io
+import re, os, io, json
 from .output import instant_assert, instant_warning, instant_debug, write_file
-from .config import get_swig_binary
+from .config import get_swig_binary, get_compiler_config, get_compiler_version
 
 def mapstrings(format, sequence):
     return "\n".join(format % i for i in sequence)
@@ -78,8 +78,8 @@ def write_interfacefile(filename, modulename, code, init_code,
       - wrap_headers (A list of local headers that will be included in the code and wrapped by SWIG)
       - arrays (A nested list, the inner lists describing the different arrays)
 
-    The result of this function is that a SWIG interface with
-    the name modulename.i is written to the current directory.
+    The result of this function is that a SWIG interface is written
+    to the file filename, typically modulename.i in the module directory.
     """
     instant_debug("Generating SWIG interface file '%s'." % filename)
 
@@ -215,10 +215,13 @@ def write_interfacefile(filename, modulename, code, init_code,
     instant_debug("Done generating interface file.")
 
 def write_setup(filename, modulename, csrcs, cppsrcs, local_headers, include_dirs, library_dirs, libraries, swig_include_dirs, swigargs, cppargs, lddargs):
-    """Generate a setup.py file. Intended for internal library use."""
+    """Generate a setup.py file. Intended for internal library use.
+
+    The generated file refers to the sources relative to the directory
+    it is written to, and must be run from that directory."""
     instant_debug("Generating %s." % filename)
 
-    swig_include_dirs.append(os.path.join(os.path.dirname(__file__), 'swig'))
+    swig_include_dirs = swig_include_dirs + [os.path.join(os.path.dirname(__file__), 'swig')]
 
     # Handle arguments
     swigfilename = "%s.i" % modulename
@@ -248,12 +251,38 @@ def write_setup(filename, modulename, csrcs, cppsrcs, local_headers, include_dir
     # Generate code
     code = reindent("""
         import os
+        import multiprocessing.pool
         from distutils.core import setup, Extension
+        from distutils.command.build_ext import build_ext
+
+        class parallel_build_ext(build_ext):
+            "Compile the sources of an extension in parallel with -j."
+            def build_extension(self, ext):
+                jobs = int(getattr(self, "parallel", None) or 1)
+                compile = self.compiler.compile
+                def parallel_compile(sources, *args, **kwargs):
+                    pool = multiprocessing.pool.ThreadPool(jobs)
+                    try:
+                        objects = pool.map(
+                            lambda source: compile([source], *args, **kwargs),
+                            sources)
+                    finally:
+                        pool.close()
+                        pool.join()
+                    return sum(objects, [])
+                if jobs > 1 and len(ext.sources) > 1:
+                    self.compiler.compile = parallel_compile
+                try:
+                    build_ext.build_extension(self, ext)
+                finally:
+                    self.compiler.compile = compile
+
         name = '%s'
         swig_cmd =r'%s -python %s %s %s %s'
         os.system(swig_cmd)
         sources = %s
         setup(name = '%s',
+              cmdclass = {'build_ext': parallel_build_ext},
               ext_modules = [Extension('_' + '%s',
                              sources,
                              include_dirs=%s,
@@ -267,6 +296,103 @@ def write_setup(filename, modulename, csrcs, cppsrcs, local_headers, include_dir
     instant_debug("Done writing setup.py file.")
 
 
+# Header precompiled for the wrapper code, defining the same macros as the
+# SWIG runtime before it includes Python.h
+_pch_header_template = """\
+/* Precompiled header generated by Instant */
+#if !defined(PY_SSIZE_T_CLEAN) && !defined(SWIG_NO_PY_SSIZE_T_CLEAN)
+#define PY_SSIZE_T_CLEAN
+#endif
+#include <Python.h>
+#include <iostream>
+%s"""
+
+def write_native_build(filename, modulename, csrcs, cppsrcs, local_headers, include_dirs, library_dirs, libraries, swig_include_dirs, swigargs, cppargs, lddargs, precompiled_headers=None):
+    """Generate a JSON file with the commands building the module without
+    distutils. Intended for internal library use.
+
+    The file holds a dict with the keys:
+      - swig: The SWIG command generating the wrapper code.
+      - swig_depend: The SWIG command listing the files the wrapper code
+        depends on in the Makefile rule swig_depend_file.
+      - swig_outputs: The files generated by SWIG.
+      - compile: A list of dicts with the keys source, object, compiler
+        and command, one for each translation unit. The user sources
+        also have the keys preprocessed and preprocess, the command
+        preprocessing them.
+      - link: The command linking the extension module.
+      - pch: Only if precompiled_headers is a list of system headers, a
+        dict with the keys header, output, compiler and command, the
+        command precompiling Python.h and the system headers into output.
+        The wrapper code is compiled with the precompiled header.
+    All commands are lists of strings, to be run in the directory of the
+    file."""
+    instant_debug("Generating %s." % filename)
+
+    compiler = get_compiler_config()
+    swig_include_dirs = swig_include_dirs + [os.path.join(os.path.dirname(__file__), 'swig')]
+    swigfilename = "%s.i" % modulename
+    wrapperfilename = "%s_wrap.cxx" % modulename
+
+    swig_cmd = [get_swig_binary(), "-python"]
+    swig_cmd += ["-I%s" % d for d in swig_include_dirs]
+    if len(local_headers) > 0:
+        swig_cmd += ["-I.."]
+    swig_cmd += swigargs
+    swig_depend_cmd = swig_cmd + ["-MM", "-MF", "%s_wrap.d" % modulename,
+                                  "-o", wrapperfilename, swigfilename]
+    swig_cmd += ["-o", wrapperfilename, swigfilename]
+
+    compile_args = compiler["cflags"] \
+                   + ["-I%s" % d for d in include_dirs + compiler["include_dirs"]] \
+                   + cppargs
+    pch = None
+    wrapper_args = []
+    if precompiled_headers is not None:
+        header = "instant_pch.h"
+        write_file(os.path.join(os.path.dirname(filename), header),
+                   _pch_header_template % "".join("#include <%s>\n" % h
+                                                  for h in precompiled_headers))
+        # GCC and Clang use header.gch and header.pch if found next to
+        # the header in -include
+        clang = "clang" in get_compiler_version(compiler["cxx"])
+        output = header + (".pch" if clang else ".gch")
+        pch = dict(header=header, output=output, compiler=compiler["cxx"],
+                   command=compiler["cxx"] + compile_args
+                   + ["-x", "c++-header", header, "-o", output])
+        wrapper_args = ["-include", header]
+
+    translation_units = []
+    for src in cppsrcs + csrcs + [wrapperfilename]:
+        base = os.path.splitext(src)[0]
+        obj = base + ".o"
+        cc = compiler["cc"] if src in csrcs else compiler["cxx"]
+        args = compile_args + (wrapper_args if src == wrapperfilename else [])
+        tu = dict(source=src, object=obj, compiler=cc,
+                  command=cc + args + ["-c", src, "-o", obj])
+        # The wrapper is generated by swig, the user sources are
+        # preprocessed to look up their objects in the build cache
+        if src != wrapperfilename:
+            tu["preprocessed"] = base + ".pp"
+            tu["preprocess"] = cc + compile_args + ["-E", src, "-o", base + ".pp"]
+        translation_units.append(tu)
+
+    library = "_%s%s" % (modulename, compiler["ext_suffix"])
+    link_cmd = compiler["ldshared"] + [tu["object"] for tu in translation_units]
+    link_cmd += ["-L%s" % d for d in library_dirs]
+    link_cmd += ["-l%s" % l for l in libraries]
+    link_cmd += ["-o", library] + lddargs
+
+    build = dict(swig=swig_cmd, swig_depend=swig_depend_cmd,
+                 swig_depend_file="%s_wrap.d" % modulename,
+                 swig_outputs=[wrapperfilename, "%s.py" % modulename],
+                 compile=translation_units, link=link_cmd)
+    if pch is not None:
+        build["pch"] = pch
+    write_file(filename, json.dumps(build, indent=2))
+    instant_debug("Done writing %s." % filename)
+
+
 def _test_write_interfacefile():
     modulename = "testmodule"
     code = "void foo() {}"
@@ -368,7 +494,7 @@ def generate_interface_file_vtk(signature, code):
     s = interface_template % { "typemaps" : typemaps, "code" : code, "includes" : includes }
     return s
 
-def write_cmakefile(module_name, cmake_packages, csrcs, cppsrcs, local_headers, include_dirs, library_dirs, libraries, swig_include_dirs, swigargs, cppargs, lddargs):
+def write_cmakefile(module_name, cmake_packages, csrcs, cppsrcs, local_headers, include_dirs, library_dirs, libraries, swig_include_dirs, swigargs, cppargs, lddargs, filename="CMakeLists.txt"):
 
     find_package_template = """
 # Configuration for package %(package)s
@@ -430,7 +556,7 @@ endif()""" %
 endif()""" %
         dict(package=package.upper()) for package in cmake_packages)
 
-    cppsrcs.extend(csrcs)
+    cppsrcs = cppsrcs + csrcs
     if len(cppsrcs) > 0:
         cmake_form["extra_sources_files"] = "set(SOURCE_FILES %s) " %  " ".join(cppsrcs)
     else:
@@ -537,10 +663,15 @@ endif()
 
 """ % cmake_form
 
-    filename = "CMakeLists.txt"
+    # Keep the timestamp of an unchanged file, as a newer one makes the
+    # configured build tree run cmake again
+    if os.path.exists(filename):
+        with io.open(filename, encoding="utf8") as f:
+            if f.read() == cmake_template:
+                return
     write_file(filename, cmake_template)
 
-def write_itk_cmakefile(name):
+def write_itk_cmakefile(name, path="."):
     file_template = """
 cmake_minimum_required(VERSION 2.6.0)
 
@@ -604,11 +735,11 @@ swig_link_libraries(${SWIG_MODULE_NAME} ${PYTHON_LIBRARIES} ${VTK_LIBS})
 
     """ % { "name" : name }
 
-    with io.open("CMakeLists.txt", 'w', encoding="utf8") as f:
+    with io.open(os.path.join(path, "CMakeLists.txt"), 'w', encoding="utf8") as f:
         f.write(file_template)
 
 
-def write_vmtk_cmakefile(name):
+def write_vmtk_cmakefile(name, path="."):
     file_template = """
 cmake_minimum_required(VERSION 2.6.0)
 
@@ -680,13 +811,13 @@ swig_link_libraries(${SWIG_MODULE_NAME} ${PYTHON_LIBRARIES} ${VTK_LIBS} ${VMTK_L
 
     """ % { "name" : name }
 
-    with io.open("CMakeLists.txt", 'w', encoding="utf8") as f:
+    with io.open(os.path.join(path, "CMakeLists.txt"), 'w', encoding="utf8") as f:
         f.write(file_template)
 
 
-def write_vtk_interface_file(signature, code):
+def write_vtk_interface_file(signature, code, path="."):
     filename = signature
-    ifile = filename + ".i"
+    ifile = os.path.join(path, filename + ".i")
     ifile_code = generate_interface_file_vtk(signature, code)
     with io.open(ifile, 'w', encoding="utf8") as iff:
         iff.write(ifile_code)
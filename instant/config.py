@@ -25,7 +25,12 @@
 
 from six import string_types
 import os
-from .output import get_status_output
+import hashlib
+import multiprocessing
+import shlex
+import sys
+import sysconfig
+from .output import get_status_output, instant_error
 import re
 
 # Global cache variables
@@ -33,6 +38,9 @@ _swig_binary_cache = None
 _swig_version_cache = None
 _pkg_config_installed = None
 _header_and_library_cache = {}
+_compiler_config_cache = None
+_compiler_version_cache = {}
+_toolchain_fingerprint_cache = None
 
 
 def check_and_set_swig_binary(binary="swig", path=""):
@@ -196,3 +204,307 @@ def header_and_libs_from_pkgconfig(*packages, **kwargs):
         return (includes, flags, libs, libdirs, linkflags)
 
     return (includes, flags, libs, libdirs)
+
+
+def get_build_system():
+    """Return the build system used for modules not configured with CMake,
+    which is either "native" or "distutils".
+
+    The native build system runs SWIG, the compiler and the linker
+    directly with the flags Python was built with. It is the default, set
+    the environment variable INSTANT_BUILD_SYSTEM=distutils to build
+    through a generated setup.py instead."""
+    build_system = os.environ.get("INSTANT_BUILD_SYSTEM") or "native"
+    if build_system not in ("native", "distutils"):
+        instant_error("Unknown build system INSTANT_BUILD_SYSTEM=%s, expecting"
+                      " 'native' or 'distutils'." % build_system)
+    return build_system
+
+
+def use_precompiled_headers():
+    """Return True if the native build system should precompile Python.h
+    and the system headers of a module, and compile its wrapper code
+    with the precompiled header. This works with GCC and Clang only, and
+    is enabled by setting the environment variable
+    INSTANT_PRECOMPILED_HEADERS=1."""
+    return os.environ.get("INSTANT_PRECOMPILED_HEADERS", "0") \
+        not in ("", "0", "no", "false")
+
+
+def get_lock_timeout():
+    """Return the time in seconds to wait for a lock in the cache before
+    failing, set by the environment variable INSTANT_LOCK_TIMEOUT, or
+    None to wait forever, the default."""
+    timeout = os.environ.get("INSTANT_LOCK_TIMEOUT")
+    if not timeout:
+        return None
+    try:
+        return float(timeout)
+    except ValueError:
+        instant_error("Invalid INSTANT_LOCK_TIMEOUT=%s, expecting a number"\
+                      " of seconds." % timeout)
+
+
+def get_build_jobs():
+    """Return the maximal number of compiler processes running at once
+    when building one module, set by the environment variable
+    INSTANT_BUILD_JOBS and defaulting to the number of CPUs."""
+    jobs = os.environ.get("INSTANT_BUILD_JOBS")
+    if not jobs:
+        return multiprocessing.cpu_count()
+    try:
+        jobs = int(jobs)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        instant_error("Invalid INSTANT_BUILD_JOBS=%s, expecting a positive"
+                      " integer." % os.environ["INSTANT_BUILD_JOBS"])
+    return jobs
+
+
+def get_cmake_generator():
+    """Return the CMake generator used for modules configured with CMake,
+    set by the environment variable INSTANT_CMAKE_GENERATOR to either
+    "Unix Makefiles" (the default) or "Ninja"."""
+    generator = os.environ.get("INSTANT_CMAKE_GENERATOR") or "Unix Makefiles"
+    generators = {"unix makefiles": "Unix Makefiles", "make": "Unix Makefiles",
+                  "ninja": "Ninja"}
+    if generator.lower() not in generators:
+        instant_error("Unknown CMake generator INSTANT_CMAKE_GENERATOR=%s,"
+                      " expecting 'Unix Makefiles' or 'Ninja'." % generator)
+    return generators[generator.lower()]
+
+
+def get_cmake_build_type():
+    """Return the CMAKE_BUILD_TYPE of modules configured with CMake, set
+    by the environment variable INSTANT_CMAKE_BUILD_TYPE and defaulting
+    to "Release"."""
+    return os.environ.get("INSTANT_CMAKE_BUILD_TYPE") or "Release"
+
+
+def get_compiler_config():
+    """Return a dict with the compilers and flags used to build Python
+    extension modules, as found by sysconfig.
+
+    As with distutils, the environment variables CC, CXX and LDSHARED
+    replace the compilers and the linker, while CFLAGS, CPPFLAGS and
+    LDFLAGS are added to the flags.
+
+    The dict has the keys:
+      - cc: The C compiler. List of strings.
+      - cxx: The C++ compiler. List of strings.
+      - cflags: Flags for both compilers. List of strings.
+      - include_dirs: The Python include directories. List of strings.
+      - ldshared: The linker command for C++ extension modules. List of strings.
+      - ext_suffix: The file name suffix of extension modules. String.
+    """
+    global _compiler_config_cache
+    if _compiler_config_cache is None:
+        def config_var(name, default=""):
+            value = os.environ.get(name) or sysconfig.get_config_var(name)
+            return shlex.split(value or default)
+
+        def env_var(name):
+            return shlex.split(os.environ.get(name, ""))
+
+        cc = config_var("CC", "cc")
+        cxx = config_var("CXX", "c++")
+        cflags = shlex.split(sysconfig.get_config_var("CFLAGS") or "") \
+                 + config_var("CCSHARED") + env_var("CFLAGS") \
+                 + env_var("CPPFLAGS")
+
+        # Link C++ code with the C++ compiler, like distutils does, unless
+        # the linker is set in the environment
+        if os.environ.get("LDSHARED"):
+            ldshared = env_var("LDSHARED")
+        else:
+            ldshared = _cxx_linker(
+                shlex.split(sysconfig.get_config_var("LDSHARED") or "cc -shared"),
+                shlex.split(sysconfig.get_config_var("CC") or "cc"), cxx)
+        ldshared += env_var("LDFLAGS")
+
+        paths = sysconfig.get_paths()
+        include_dirs = [paths["include"]]
+        if paths["platinclude"] != paths["include"]:
+            include_dirs.append(paths["platinclude"])
+
+        ext_suffix = sysconfig.get_config_var("EXT_SUFFIX") \
+                     or sysconfig.get_config_var("SO") or ".so"
+
+        _compiler_config_cache = dict(cc=cc, cxx=cxx, cflags=cflags,
+                                      include_dirs=include_dirs,
+                                      ldshared=ldshared,
+                                      ext_suffix=ext_suffix)
+    return dict(_compiler_config_cache)
+
+
+def _cxx_linker(ldshared, cc, cxx):
+    """Return the linker command ldshared with the C compiler cc replaced
+    by the C++ compiler cxx, all lists of strings. Only the compiler is
+    replaced, keeping wrappers such as ccache, and env with its variable
+    assignments, in front of it."""
+    if ldshared[:len(cc)] == cc:
+        return cxx + ldshared[len(cc):]
+    i = 0
+    if os.path.basename(ldshared[0]) == "env":
+        i = 1
+        while i < len(ldshared) and "=" in ldshared[i]:
+            i += 1
+    return ldshared[:i] + cxx + ldshared[i+1:]
+
+
+def get_compiler_version(compiler):
+    """Return the version string of the compiler command, given as a
+    list of strings, as printed by --version. Empty if that fails."""
+    key = tuple(compiler)
+    if key not in _compiler_version_cache:
+        result, output = get_status_output(list(compiler) + ["--version"])
+        _compiler_version_cache[key] = output.strip() if result == 0 else ""
+    return _compiler_version_cache[key]
+
+
+def get_memory_cache_size():
+    """Return the maximal number of entries in the memory cache of loaded
+    modules, set by the environment variable INSTANT_MEMORY_CACHE_SIZE,
+    or None for no limit, the default. Each module has an entry for each
+    of its ids, such as its name and its signature."""
+    size = os.environ.get("INSTANT_MEMORY_CACHE_SIZE")
+    if not size:
+        return None
+    try:
+        size = int(size)
+    except ValueError:
+        size = 0
+    if size < 1:
+        instant_error("Invalid INSTANT_MEMORY_CACHE_SIZE=%s, expecting a"
+                      " positive integer." % os.environ["INSTANT_MEMORY_CACHE_SIZE"])
+    return size
+
+
+def use_weak_memory_cache():
+    """Return True if the memory cache should only keep weak references
+    to loaded modules, letting modules no longer used elsewhere be freed.
+    This is enabled by setting the environment variable
+    INSTANT_MEMORY_CACHE_WEAK=1."""
+    return os.environ.get("INSTANT_MEMORY_CACHE_WEAK", "0") \
+        not in ("", "0", "no", "false")
+
+
+def _namespace_variable(name, namespace):
+    """Return the name of the environment variable name for the cache
+    namespace, name_NAMESPACE, if it is set, otherwise name."""
+    if namespace is not None:
+        specific = name + "_" + re.sub(r"\W", "_", namespace).upper()
+        if os.environ.get(specific):
+            return specific
+    return name
+
+
+def get_cache_max_size(namespace=None):
+    """Return the maximal total size in bytes of the modules in a cache
+    directory, set by the environment variable INSTANT_CACHE_MAX_SIZE
+    with an optional suffix K, M or G, or None for no limit, the default.
+    The least recently used modules are removed when it is exceeded.
+
+    Each cache namespace has its own quota, set by the variable
+    INSTANT_CACHE_MAX_SIZE_<NAMESPACE> if present."""
+    name = _namespace_variable("INSTANT_CACHE_MAX_SIZE", namespace)
+    size = os.environ.get(name)
+    if not size:
+        return None
+    return _parse_size(name, size)
+
+
+def get_build_cache_max_size():
+    """Return the maximal total size in bytes of the build cache, see
+    get_default_build_cache_dir, set by the environment variable
+    INSTANT_BUILD_CACHE_MAX_SIZE with an optional suffix K, M or G,
+    defaulting to 1G, or None for no limit if it is set to 0. The least
+    recently used entries are removed when it is exceeded."""
+    size = os.environ.get("INSTANT_BUILD_CACHE_MAX_SIZE") or "1G"
+    size = _parse_size("INSTANT_BUILD_CACHE_MAX_SIZE", size)
+    return size or None
+
+
+def _parse_size(name, size):
+    "Parse the value size of the environment variable name as bytes."
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    try:
+        if size[-1].upper() in units:
+            return int(float(size[:-1])*units[size[-1].upper()])
+        return int(size)
+    except ValueError:
+        instant_error("Invalid %s=%s, expecting a number of bytes with an"
+                      " optional suffix K, M or G." % (name, size))
+
+
+def get_cache_max_modules(namespace=None):
+    """Return the maximal number of modules in a cache directory, set by
+    the environment variable INSTANT_CACHE_MAX_MODULES, or None for no
+    limit, the default. The least recently used modules are removed when
+    it is exceeded.
+
+    Each cache namespace has its own quota, set by the variable
+    INSTANT_CACHE_MAX_MODULES_<NAMESPACE> if present."""
+    name = _namespace_variable("INSTANT_CACHE_MAX_MODULES", namespace)
+    count = os.environ.get(name)
+    if not count:
+        return None
+    try:
+        count = int(count)
+    except ValueError:
+        count = -1
+    if count < 0:
+        instant_error("Invalid %s=%s, expecting a nonnegative integer."
+                      % (name, os.environ[name]))
+    return count
+
+
+def get_toolchain_fingerprint():
+    """Return a checksum of the Python version, the C++ compiler and its
+    version and the SWIG version, identifying the toolchain which built
+    a module."""
+    global _toolchain_fingerprint_cache
+    if _toolchain_fingerprint_cache is None:
+        cxx = get_compiler_config()["cxx"]
+        try:
+            swig_version = get_swig_version()
+        except OSError:
+            swig_version = ""
+        text = "\n".join([sys.version, " ".join(cxx),
+                          get_compiler_version(cxx), swig_version])
+        _toolchain_fingerprint_cache = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    return _toolchain_fingerprint_cache
+
+
+def get_cache_layout():
+    """Return the layout of new modules in cache directories, set by the
+    environment variable INSTANT_CACHE_LAYOUT to either "sharded" (the
+    default), placing each module two directory levels down by the hash
+    of its name, or "flat", placing all modules in the cache directory.
+    Modules are found in either layout."""
+    layout = os.environ.get("INSTANT_CACHE_LAYOUT") or "sharded"
+    if layout not in ("sharded", "flat"):
+        instant_error("Unknown cache layout INSTANT_CACHE_LAYOUT=%s, expecting"
+                      " 'sharded' or 'flat'." % layout)
+    return layout
+
+
+def use_cache_access_tracking():
+    """Return True if cache hits should record the last access and the
+    number of hits of cached modules, so that the cache quota removes
+    the least recently used modules instead of the oldest ones. This
+    writes to the cache on some hits, at most every ten minutes for each
+    module, and is enabled by setting the environment variable
+    INSTANT_CACHE_TRACK_ACCESS=1."""
+    return os.environ.get("INSTANT_CACHE_TRACK_ACCESS", "0") \
+        not in ("", "0", "no", "false")
+
+
+def use_cache_promotion():
+    """Return True if modules found in a cache tier after the default
+    cache directory, see get_cache_tiers, should be copied to it, so
+    later lookups find them there. This is enabled by setting the
+    environment variable INSTANT_CACHE_PROMOTE=1."""
+    return os.environ.get("INSTANT_CACHE_PROMOTE", "0") \
+        not in ("", "0", "no", "false")
@@ -0,0 +1,209 @@
+"""This module contains the index of the modules in a cache directory.
+
+The index is an SQLite database in the hidden file .index.db in the
+cache directory, with a row for each module holding its path, size,
+build time, last access, number of hits and toolchain fingerprint. It is
+updated when modules are published to and evicted from the cache, so
+listing the cache and enforcing its quota need not walk the cache
+directory.
+
+If the database can not be used, for example on file systems without
+working locks, the functions here return None and the cache falls back
+to the file system.
+"""
+
+# Copyright (C) 2017 Instant developers
+#
+# This file is part of Instant.
+#
+# Instant is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Instant is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Instant. If not, see <http://www.gnu.org/licenses/>.
+#
+# Alternatively, Instant may be distributed under the terms of the BSD license.
+
+import os
+import sqlite3
+import threading
+from .output import instant_debug, instant_warning
+
+_index_filename = ".index.db"
+
+# Version of the index schema, stored as the user_version of the database
+# once the modules in the cache directory have been added to it, so that
+# an index created but not filled is filled by the next process using it
+_index_version = 1
+
+# Connections to the index of each cache directory, with the process
+# that opened them, as connections can not be used by forked processes
+_index_lock = threading.RLock()
+_index_connections = {} # cache_dir -> (pid, inode, connection)
+_filled_indexes = set() # cache_dirs with connected indexes known filled
+
+def index_path(cache_dir):
+    "Return the path of the index database of cache_dir."
+    return os.path.join(cache_dir, _index_filename)
+
+
+def _inode(path):
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
+
+
+def _connect(cache_dir, create=True):
+    """Return the connection to the index of cache_dir, or None if the
+    index is unavailable, or does not exist and create is False. A new
+    connection is opened if the index was removed, for example by
+    instant-clean."""
+    pid, inode, db = _index_connections.get(cache_dir, (None, None, None))
+    if pid == os.getpid() and (db is None or inode == _inode(index_path(cache_dir))):
+        return db
+    if not create and not os.path.exists(index_path(cache_dir)):
+        return None
+    _filled_indexes.discard(cache_dir)
+    try:
+        db = sqlite3.connect(index_path(cache_dir), timeout=30.0,
+                             check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS modules "
+                   "(name TEXT PRIMARY KEY, path TEXT, size INTEGER, "
+                   "build_time REAL, last_access REAL, hits INTEGER, "
+                   "toolchain TEXT)")
+        db.execute("CREATE INDEX IF NOT EXISTS modules_by_access "
+                   "ON modules (last_access)")
+        db.commit()
+    except sqlite3.Error as e:
+        instant_warning("Not indexing the cache %r: %s" % (cache_dir, e))
+        db = None
+    _index_connections[cache_dir] = (os.getpid(),
+                                      _inode(index_path(cache_dir)), db)
+    return db
+
+
+def _execute(cache_dir, statements, fetch=False, create=True):
+    """Execute the SQL statements, a list of (sql, parameters) tuples, in
+    one transaction on the index of cache_dir. Returns the rows of the
+    last statement if fetch is True, otherwise True. Returns None if the
+    index is unavailable, or does not exist and create is False."""
+    with _index_lock:
+        db = _connect(cache_dir, create)
+        if db is None:
+            return None
+        try:
+            for sql, parameters in statements:
+                cursor = db.execute(sql, parameters)
+            rows = cursor.fetchall() if fetch else True
+            db.commit()
+        except sqlite3.Error as e:
+            db.rollback()
+            instant_debug("In instant.index: Failed to use the index of %r: %s"\
+                          % (cache_dir, e))
+            return None
+    return rows
+
+
+def index_is_new(cache_dir):
+    """Return True if the modules already in cache_dir have not been added
+    to its index yet, see index_set_filled. The index is created if it
+    does not exist."""
+    with _index_lock:
+        if _connect(cache_dir) is None or cache_dir in _filled_indexes:
+            return False
+        rows = _execute(cache_dir, [("PRAGMA user_version", ())], fetch=True)
+        if rows is None:
+            return False
+        if rows[0][0] < _index_version:
+            return True
+        _filled_indexes.add(cache_dir)
+        return False
+
+
+def index_set_filled(cache_dir):
+    """Record in the index of cache_dir that the modules in cache_dir have
+    been added to it, see index_is_new."""
+    with _index_lock:
+        if _execute(cache_dir, [("PRAGMA user_version = %d" % _index_version,
+                                 ())]):
+            _filled_indexes.add(cache_dir)
+
+
+def index_publish(cache_dir, name, path, size, build_time, toolchain,
+                  replace=True):
+    """Add the module name, published at path, to the index. An existing
+    row of the module is kept unless replace is True."""
+    return _execute(cache_dir, [("INSERT OR %s INTO modules"
+                                 " VALUES (?, ?, ?, ?, ?, 0, ?)"
+                                 % ("REPLACE" if replace else "IGNORE"),
+                                 (name, path, size, build_time, build_time,
+                                  toolchain))])
+
+
+def index_remove(cache_dir, name):
+    "Remove the module name from the index."
+    return _execute(cache_dir, [("DELETE FROM modules WHERE name = ?", (name,))])
+
+
+def index_move(cache_dir, name, path):
+    "Set the path of the module name in the index."
+    return _execute(cache_dir, [("UPDATE modules SET path = ? WHERE name = ?",
+                                 (path, name))])
+
+
+def index_record_hits(cache_dir, hits, last_access):
+    """Add the number of hits of each module in the dict hits to the index,
+    and set their last access unless it is None. Hits are not worth
+    creating the index for, so nothing is done if it does not exist."""
+    if not hits:
+        return True
+    return _execute(cache_dir, [("UPDATE modules SET hits = hits + ?,"
+                                 " last_access = COALESCE(?, last_access) WHERE name = ?",
+                                 (n, last_access, name))
+                                for name, n in hits.items()], create=False)
+
+
+def index_lookup(cache_dir, name):
+    """Return the path of the module name in the index of cache_dir, or ""
+    if it is not in the index. Returns None if the index does not exist,
+    is unavailable or has not been filled yet, see index_is_new, as then
+    the module may be in the cache directory anyway. The index is not
+    created."""
+    with _index_lock:
+        if cache_dir not in _filled_indexes:
+            rows = _execute(cache_dir, [("PRAGMA user_version", ())],
+                            fetch=True, create=False)
+            if not rows or rows[0][0] < _index_version:
+                return None
+            _filled_indexes.add(cache_dir)
+        rows = _execute(cache_dir, [("SELECT path FROM modules WHERE name = ?",
+                                     (name,))], fetch=True, create=False)
+    if rows is None:
+        return None
+    return rows[0][0] if rows else ""
+
+
+def index_entries(cache_dir):
+    """Return a list of dicts describing the modules in the index, in order
+    of last access, or None if the index is unavailable."""
+    rows = _execute(cache_dir, [("SELECT name, path, size, build_time,"
+                                 " last_access, hits, toolchain FROM modules"
+                                 " ORDER BY last_access", ())], fetch=True)
+    if rows is None:
+        return None
+    keys = ("name", "path", "size", "build_time", "last_access", "hits",
+            "toolchain")
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def index_clear(cache_dir):
+    "Remove all modules from the index."
+    return _execute(cache_dir, [("DELETE FROM modules", ())])
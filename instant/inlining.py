@@ -34,6 +34,33 @@ def get_func_name(c_code):
     return func_name
 
 
+def _function_from_module(module, func_name):
+    "Return the function func_name from module, or the module if not found."
+    if hasattr(module, func_name):
+        return getattr(module, func_name)
+    else:
+        instant_warning("Didn't find function '%s', returning module." % func_name)
+    return module
+
+
+def _inline_kwargs(c_code, kwargs):
+    "Return the build_module arguments for inlining c_code."
+    instant_assert("code" not in kwargs, "Cannot specify code twice.")
+    kwargs = dict(kwargs)
+    kwargs["code"] = c_code
+    return kwargs
+
+
+def _inline_with_numpy_kwargs(c_code, kwargs):
+    "Return the build_module arguments for inlining c_code using NumPy arrays."
+    import numpy
+    kwargs = _inline_kwargs(c_code, kwargs)
+    kwargs["init_code"]      = kwargs.get("init_code", "")      + "\nimport_array();\n"
+    kwargs["system_headers"] = kwargs.get("system_headers", []) + ["numpy/arrayobject.h"]
+    kwargs["include_dirs"]   = kwargs.get("include_dirs", [])   + ["%s" % numpy.get_include()]
+    return kwargs
+
+
 def inline(c_code, **kwargs):
     """This is a short wrapper around the build_module function in instant.
 
@@ -47,15 +74,10 @@ def inline(c_code, **kwargs):
     >>> add_func = inline("double add(double a, double b){ return a+b; }")
     >>> print "The sum of 3 and 4.5 is ", add_func(3, 4.5)
     """
-    instant_assert("code" not in kwargs, "Cannot specify code twice.")
-    kwargs["code"] = c_code
+    kwargs = _inline_kwargs(c_code, kwargs)
     func_name = get_func_name(c_code)
     module = build_module(**kwargs)
-    if hasattr(module, func_name):
-        return getattr(module, func_name)
-    else:
-        instant_warning("Didn't find function '%s', returning module." % func_name)
-    return module
+    return _function_from_module(module, func_name)
 
 
 def inline_module(c_code, **kwargs):
@@ -106,19 +128,10 @@ def inline_with_numpy(c_code, **kwargs):
     >>> sum_func(a)
     '''
 
-    import numpy
-    instant_assert("code" not in kwargs, "Cannot specify code twice.")
-    kwargs["code"] = c_code
-    kwargs["init_code"]      = kwargs.get("init_code", "")      + "\nimport_array();\n"
-    kwargs["system_headers"] = kwargs.get("system_headers", []) + ["numpy/arrayobject.h"]
-    kwargs["include_dirs"]   = kwargs.get("include_dirs", [])   + ["%s" %numpy.get_include()]
+    kwargs = _inline_with_numpy_kwargs(c_code, kwargs)
     func_name = get_func_name(c_code)
     module = build_module(**kwargs)
-    if hasattr(module, func_name):
-        return getattr(module, func_name)
-    else:
-        instant_warning("Didn't find function '%s', returning module." % func_name)
-    return module
+    return _function_from_module(module, func_name)
 
 def inline_module_with_numpy(c_code, **kwargs):
     '''This is a short wrapper around the build_module function in instant.
@@ -33,11 +33,20 @@ Two Python libraries can be used:
 #
 # Alternatively, Instant may be distributed under the terms of the BSD license.
 
-__all__ = ["get_lock", "release_lock", "release_all_lock", "file_lock"]
+__all__ = ["get_lock", "release_lock", "release_all_locks", "file_lock",
+           "lock_statistics"]
 
 import os.path
-from .output import instant_error, instant_assert, instant_debug
+import contextlib
+import errno
+import logging
+import socket
+import threading
+import time
+from .output import instant_error, instant_assert, instant_debug, \
+     instant_warning, get_logger
 from .paths import validate_cache_dir
+from .config import get_lock_timeout
 
 try:
     import flufl.lock
@@ -50,14 +59,69 @@ except:
         fcntl = None
 
 # Keeping an overview of locks currently held, to avoid deadlocks
-# within a single process
-_lock_names = {} # lock.fileno() -> lockname
-_lock_files = {} # lockname -> lock
-_lock_count = {} # lockname -> number of times this lock has been aquired and not yet released
+# within a single thread. A key is a tuple (thread id, lock filename).
+_registry_lock = threading.Lock()
+_lock_names = {} # lock.fileno() -> key
+_lock_files = {} # key -> lock
+_lock_count = {} # key -> number of times this lock has been aquired and not yet released
+_lock_modes = {} # key -> list of shared flags of the acquisitions not yet released
+
+
+def _debugging():
+    return get_logger().isEnabledFor(logging.DEBUG)
+
+
+def _caller():
+    "Describe the caller of get_lock or release_lock, for debug messages."
+    import inspect
+    frame = inspect.currentframe().f_back.f_back
+    return "Called from: %s line: %d" % (inspect.getfile(frame), frame.f_lineno)
+
+# Upper bounds in seconds of the wait time histogram buckets
+_wait_buckets = (0.001, 0.01, 0.1, 1.0, 10.0, 100.0, float("inf"))
+
+# Waiting longer than this is reported, with the process holding the lock
+_wait_warning_time = 10.0
+
+# Statistics of the time spent waiting for each lock
+_statistics_lock = threading.Lock()
+_lock_statistics = {} # lockname -> dict, see lock_statistics
+
+def _record_wait(lockname, wait_time, outcome="acquired"):
+    "Record the outcome of waiting for a lock: acquired, timeout or stale."
+    with _statistics_lock:
+        statistics = _lock_statistics.setdefault(lockname,
+            dict(acquired=0, timeouts=0, stale=0, wait_time=0.0,
+                 histogram=[0]*len(_wait_buckets)))
+        if outcome == "stale":
+            statistics["stale"] += 1
+            return
+        statistics["acquired" if outcome == "acquired" else "timeouts"] += 1
+        statistics["wait_time"] += wait_time
+        for i, bound in enumerate(_wait_buckets):
+            if wait_time <= bound:
+                statistics["histogram"][i] += 1
+                break
+
+
+def lock_statistics():
+    """Return a dict with statistics of the locks taken by this process,
+    mapping each lock name to a dict with
+      - acquired: The number of times the lock was acquired.
+      - timeouts: The number of times waiting for it timed out.
+      - stale: The number of stale locks broken.
+      - wait_time: The total time in seconds spent waiting for it.
+      - histogram: A list of (upper bound in seconds, count) pairs with
+        the distribution of the wait times, including timeouts.
+    Reentrant acquisitions of a lock already held are not counted."""
+    with _statistics_lock:
+        return dict((lockname, dict(s, histogram=list(zip(_wait_buckets, s["histogram"]))))
+                    for lockname, s in _lock_statistics.items())
 
 if flufl:
-    def get_lock(cache_dir, module_name):
-        "Get a new file lock."
+    def get_lock(cache_dir, module_name, shared=False):
+        """Get a new file lock. flufl.lock only has exclusive locks, so
+        shared locks are exclusive too."""
 
         from flufl.lock import Lock
         from datetime import timedelta
@@ -68,9 +132,19 @@ if flufl:
         instant_debug("Acquiring lock %s, count is %d." % (lockname, count))
 
         cache_dir = validate_cache_dir(cache_dir)
-        lockname = os.path.join(cache_dir, lockname)
-        lock = Lock(lockname)
-        lock.lock()
+        timeout = get_lock_timeout()
+        lock = Lock(os.path.join(cache_dir, lockname))
+        t0 = time.time()
+        try:
+            if timeout is None:
+                lock.lock()
+            else:
+                lock.lock(timeout=timedelta(seconds=timeout))
+        except flufl.lock.TimeOutError:
+            _record_wait(lockname, time.time() - t0, "timeout")
+            instant_error("Timed out after %g s waiting for lock %s." \
+                          % (timeout, lock.lockfile))
+        _record_wait(lockname, time.time() - t0)
 
         return lock
 
@@ -85,63 +159,257 @@ if flufl:
         pass
 
 elif fcntl:
-    def get_lock(cache_dir, module_name):
-        "Get a new file lock."
-        global _lock_names, _lock_files, _lock_count
-
+    def get_lock(cache_dir, module_name, shared=False):
+        """Get a new file lock, which is shared with other processes
+        holding shared locks if shared is True, exclusive otherwise.
+
+        Locks are reentrant within a thread, and owned by the thread
+        getting them: other threads of the process wait for them as
+        other processes do.
+
+        Getting an exclusive lock while holding a shared one upgrades
+        the lock until the exclusive lock is released. As with flock,
+        the upgrade is not atomic, other processes may get the lock
+        while it is upgraded."""
         lockname = module_name + ".lock"
-        count = _lock_count.get(lockname, 0)
-        import inspect
-        frame = inspect.currentframe().f_back
-        instant_debug("Acquiring lock %s, count is %d. Called from: %s line: %d" % \
-                      (lockname, count, inspect.getfile(frame), frame.f_lineno))
+        cache_dir = validate_cache_dir(cache_dir)
+        filename = os.path.join(cache_dir, lockname)
+        key = (threading.current_thread().ident, filename)
+        with _registry_lock:
+            count = _lock_count.get(key, 0)
+            lock = _lock_files.get(key)
+        if _debugging():
+            instant_debug("Acquiring %s lock %s, count is %d. %s" % \
+                          ("shared" if shared else "exclusive", lockname,
+                           count, _caller()))
 
         if count == 0:
-            cache_dir = validate_cache_dir(cache_dir)
-            lock = open(os.path.join(cache_dir, lockname), "w")
-            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
-            _lock_names[lock.fileno()] = lockname
-            _lock_files[lockname] = lock
-        else:
-            lock = _lock_files[lockname]
-
-        _lock_count[lockname] = count + 1
+            # Only this thread changes the entries of key, the registry
+            # lock is not held while waiting for the file lock
+            lock = _acquire_flock(filename, lockname, shared)
+            with _registry_lock:
+                _lock_names[lock.fileno()] = key
+                _lock_files[key] = lock
+                _lock_modes[key] = []
+        elif all(_lock_modes[key]) and not shared:
+            _upgrade_flock(lock, filename, lockname)
+
+        with _registry_lock:
+            _lock_modes[key].append(shared)
+            _lock_count[key] = count + 1
         return lock
 
     def release_lock(lock):
         "Release a lock currently held by Instant."
-        global _lock_names, _lock_files, _lock_count
-
-        lockname = _lock_names[lock.fileno()]
-        count = _lock_count[lockname]
-
-        import inspect
-        frame = inspect.currentframe().f_back
-
-        instant_debug("Releasing lock %s, count is %d. Called from: %s line: %d" % \
-                      (lockname, count, inspect.getfile(frame), frame.f_lineno))
-
-        instant_assert(count > 0, "Releasing lock that Instant is supposedly not holding.")
-        instant_assert(lock is _lock_files[lockname], "Lock mismatch, might be something wrong in locking logic.")
-
-        del _lock_files[lockname]
-        del _lock_names[lock.fileno()]
-        _lock_count[lockname] = count - 1
-
+        with _registry_lock:
+            key = _lock_names[lock.fileno()]
+            count = _lock_count[key]
+            if _debugging():
+                instant_debug("Releasing lock %s, count is %d. %s" % \
+                              (os.path.basename(key[1]), count, _caller()))
+
+            instant_assert(count > 0, "Releasing lock that Instant is supposedly not holding.")
+            instant_assert(lock is _lock_files[key], "Lock mismatch, might be something wrong in locking logic.")
+
+            _lock_count[key] = count - 1
+            shared = _lock_modes[key].pop()
+            if count == 1:
+                del _lock_files[key]
+                del _lock_names[lock.fileno()]
+                del _lock_modes[key]
+                del _lock_count[key]
+
+        if count > 1:
+            # Still held, downgrade when the last exclusive lock is released
+            if not shared and all(_lock_modes[key]):
+                lock.truncate(0)
+                fcntl.flock(lock.fileno(), fcntl.LOCK_SH)
+            return
+
+        if not shared:
+            lock.truncate(0)
         fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
         lock.close()
 
+    def _acquire_flock(filename, lockname, shared):
+        """Open and lock the lock file, polling with exponential backoff
+        until the lock is acquired or get_lock_timeout() has passed.
+
+        The process holding an exclusive lock writes its host name and
+        process id to the lock file. If that process is dead, the lock is
+        held by a process which inherited the file, such as a compiler,
+        and is stale. Stale lock files are removed, locks on files no
+        longer in the cache directory are not used. Both are checked
+        holding the guard lock of the directory, see _stale_lock_guard."""
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        t0 = time.time()
+        delay = 0.001
+        warned = False
+        while True:
+            # Open without truncating, which would remove the holder
+            lock = open(filename, "a+")
+            try:
+                locked = _try_flock(lock, mode)
+            except:
+                lock.close()
+                raise
+            if locked:
+                if _claim_flock(lock, filename, shared):
+                    _record_wait(lockname, time.time() - t0)
+                    return lock
+                lock.close()
+                continue
+
+            holder = _read_holder(lock)
+            stat = os.fstat(lock.fileno())
+            lock.close()
+            if _is_stale(holder) and \
+                    _break_stale_lock(filename, lockname, holder, stat):
+                continue
+            delay, warned = _wait(filename, lockname, holder, t0, delay,
+                                  warned)
+
+    def _upgrade_flock(lock, filename, lockname):
+        """Upgrade the shared lock on the open lock file to an exclusive
+        one, polling with exponential backoff as _acquire_flock. A failed
+        attempt may release the shared lock, so it is taken again before
+        failing when get_lock_timeout() has passed."""
+        t0 = time.time()
+        delay = 0.001
+        warned = False
+        while not _try_flock(lock, fcntl.LOCK_EX):
+            try:
+                delay, warned = _wait(filename, lockname, _read_holder(lock),
+                                      t0, delay, warned)
+            except Exception:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_SH)
+                raise
+        _write_holder(lock)
+        _record_wait(lockname, time.time() - t0)
+
+    def _try_flock(lock, mode):
+        "Try to flock the open lock file without blocking."
+        try:
+            fcntl.flock(lock.fileno(), mode | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                raise
+            return False
+        return True
+
+    def _wait(filename, lockname, holder, t0, delay, warned):
+        """Sleep for delay seconds before trying to get a lock again, or
+        fail if get_lock_timeout() has passed since t0. Returns the next
+        delay and whether the wait has been reported."""
+        timeout = get_lock_timeout()
+        waited = time.time() - t0
+        holder = "process %s on %s" % (holder[1], holder[0]) if holder \
+                 else "other processes"
+        if timeout is not None and waited >= timeout:
+            _record_wait(lockname, waited, "timeout")
+            instant_error("Timed out after %g s waiting for lock %s held"\
+                          " by %s." % (waited, filename, holder))
+        if not warned and waited >= _wait_warning_time:
+            instant_warning("Waited %g s for lock %s held by %s." \
+                            % (waited, filename, holder))
+            warned = True
+        if timeout is not None:
+            delay = min(delay, timeout - waited)
+        time.sleep(delay)
+        return min(2*delay, 1.0), warned
+
+    @contextlib.contextmanager
+    def _stale_lock_guard(filename, mode):
+        """Hold the guard lock of the directory of the lock file with the
+        flock mode. Stale lock files are removed holding it exclusively,
+        and locks are checked and claimed holding it shared, so that no
+        lock file is removed once taken by a live process. It is only
+        held for a few system calls, without timeout."""
+        guard = open(os.path.join(os.path.dirname(filename), ".stale.lock"),
+                     "a")
+        try:
+            fcntl.flock(guard.fileno(), mode)
+            yield
+        finally:
+            guard.close()
+
+    def _claim_flock(lock, filename, shared):
+        """Check that the open lock file just locked was not removed as
+        stale meanwhile, and write the holder of an exclusive lock to it."""
+        with _stale_lock_guard(filename, fcntl.LOCK_SH):
+            try:
+                current = os.path.samestat(os.fstat(lock.fileno()),
+                                           os.stat(filename))
+            except OSError:
+                current = False
+            if current and not shared:
+                _write_holder(lock)
+        return current
+
+    def _break_stale_lock(filename, lockname, holder, stat):
+        """Remove the lock file, found locked with the os.stat result stat
+        and the dead process holder written to it, if it still is.
+
+        Return whether the file was removed. A lock file naming a dead
+        process may also be shared by live readers, which are waited for."""
+        with _stale_lock_guard(filename, fcntl.LOCK_EX):
+            try:
+                lock = open(filename, "r")
+            except (IOError, OSError):
+                # Removed by another process
+                return False
+            try:
+                if not os.path.samestat(os.fstat(lock.fileno()), stat) \
+                        or _read_holder(lock) != holder:
+                    # Broken and taken by another process
+                    return False
+                if _try_flock(lock, fcntl.LOCK_SH):
+                    # Released meanwhile, or only held by readers
+                    return False
+                instant_warning("Breaking stale lock %s held by dead process"\
+                                " %s on %s." % (filename, holder[1], holder[0]))
+                _record_wait(lockname, 0.0, "stale")
+                os.remove(filename)
+                return True
+            finally:
+                lock.close()
+
+    def _write_holder(lock):
+        lock.truncate(0)
+        lock.write("%s %d\n" % (socket.gethostname(), os.getpid()))
+        lock.flush()
+
+    def _read_holder(lock):
+        "Return the (hostname, pid) holding an exclusive lock, if known."
+        lock.seek(0)
+        holder = lock.read().split()
+        if len(holder) != 2 or not holder[1].isdigit():
+            return None
+        return holder[0], int(holder[1])
+
+    def _is_stale(holder):
+        "Check if the holder of a lock is a dead process on this host."
+        if holder is None or holder[0] != socket.gethostname():
+            return False
+        try:
+            os.kill(holder[1], 0)
+        except OSError as e:
+            return e.errno == errno.ESRCH
+        return False
+
     def release_all_locks():
-        "Release all locks currently held by Instant."
-        locks = list(_lock_files.values())
-        for lock in locks:
-            release_lock(lock)
-        instant_assert(all(_lock_count[lockname] == 0 for lockname in _lock_count), "Lock counts not zero after releasing all locks.")
+        "Release all locks currently held by Instant, in all threads."
+        with _registry_lock:
+            locks = [(lock, _lock_count[key]) for key, lock in _lock_files.items()]
+        for lock, count in locks:
+            for i in range(count):
+                release_lock(lock)
+        instant_assert(not _lock_count, "Lock counts not zero after releasing all locks.")
 
 else:
     # Windows systems have no fcntl, implement these otherwise if
     # locking is needed on windows
-    def get_lock(cache_dir, module_name):
+    def get_lock(cache_dir, module_name, shared=False):
         return None
 
     def release_lock(lock):
@@ -153,14 +421,16 @@ else:
 
 class file_lock(object):
     """
-    File lock using with statement
+    File lock using with statement, shared with other processes reading
+    the module if shared is True, see get_lock.
     """
-    def __init__(self, cache_dir, module_name):
+    def __init__(self, cache_dir, module_name, shared=False):
         self.cache_dir = cache_dir
         self.module_name = module_name
+        self.shared = shared
 
     def __enter__(self):
-        self.lock = get_lock(self.cache_dir, self.module_name)
+        self.lock = get_lock(self.cache_dir, self.module_name, self.shared)
         return self.lock
 
     def __exit__(self, type, value, tb):
@@ -160,22 +160,39 @@ if _call_method == 'SUBPROCESS':
         return (status, output)
 
 elif _call_method == 'OS_SYSTEM':
+    import subprocess
     import tempfile
     from .paths import get_default_error_dir
+    try:
+        from shlex import quote
+    except ImportError:
+        # Python 2
+        from pipes import quote
 
     def get_status_output(cmd, input=None, cwd=None, env=None):
         # We don't need function with such a generality.
         # We only need output and return code.
-        if not isinstance(cmd, string_types) or input is not None or \
-            cwd is not None or env is not None:
+        if input is not None or env is not None:
             raise NotImplementedError(
                 'This implementation (%s) of get_status_output does'
-                ' not accept \'input\', \'cwd\' and \'env\' kwargs.'
+                ' not accept \'input\' and \'env\' kwargs.'
                 %_call_method)
+        if not isinstance(cmd, string_types):
+            # Quote the arguments for the shell running the command
+            if os.name == 'nt':
+                cmd = subprocess.list2cmdline(cmd)
+            else:
+                cmd = " ".join(quote(arg) for arg in cmd)
 
         f = tempfile.NamedTemporaryFile(dir=get_default_error_dir(),
                                         delete=True)
 
+        # Run cmd in cwd by changing directory in the shell, leaving
+        # the current directory of this process untouched
+        if cwd is not None:
+            cd = 'cd /d' if os.name == 'nt' else 'cd'
+            cmd = '%s "%s" && %s' % (cd, cwd, cmd)
+
         # Execute cmd with redirection
         cmd += ' > ' + f.name + ' 2>&1'
         instant_debug("Running: " + str(cmd))
@@ -28,33 +28,41 @@ import sys
 import errno
 import shutil
 import tempfile
+import threading
 import time
+import atexit
 from .signatures import compute_checksum
-from .output import instant_debug, instant_assert
+from .output import instant_debug, instant_assert, instant_error
 
 _tmp_dir = None
+_tmp_dir_lock = threading.Lock()
 
 
 def get_temp_dir():
     """Return a temporary directory for the duration of this process.
 
-    Multiple calls in the same process returns the same directory.
-    Remember to call delete_temp_dir() before exiting."""
+    Multiple calls in the same process, from any thread, returns the
+    same directory. It is deleted by delete_temp_dir(), which is called
+    when the process exits."""
     global _tmp_dir
-    if _tmp_dir is None:
-        datestring = "%d-%d-%d-%02d-%02d" % time.localtime()[:5]
-        suffix = datestring + "_instant_" + compute_checksum(get_default_cache_dir())
-        _tmp_dir = tempfile.mkdtemp(suffix)
-        instant_debug("Created temp directory '%s'." % _tmp_dir)
-    return _tmp_dir
+    with _tmp_dir_lock:
+        if _tmp_dir is None:
+            datestring = "%d-%d-%d-%02d-%02d" % time.localtime()[:5]
+            suffix = datestring + "_instant_" + compute_checksum(get_default_cache_dir())
+            _tmp_dir = tempfile.mkdtemp(suffix)
+            instant_debug("Created temp directory '%s'." % _tmp_dir)
+        return _tmp_dir
 
 
 def delete_temp_dir():
     """Delete the temporary directory created by get_temp_dir()."""
     global _tmp_dir
-    if _tmp_dir and os.path.isdir(_tmp_dir):
-        shutil.rmtree(_tmp_dir, ignore_errors=True)
-    _tmp_dir = None
+    with _tmp_dir_lock:
+        if _tmp_dir and os.path.isdir(_tmp_dir):
+            shutil.rmtree(_tmp_dir, ignore_errors=True)
+        _tmp_dir = None
+
+atexit.register(delete_temp_dir)
 
 
 def get_instant_dir():
@@ -85,14 +93,64 @@ def get_instant_dir():
     return instant_dir
 
 
-def get_default_cache_dir():
-    "Return the default cache directory."
+# Cache tiers set by set_cache_tiers, None to use INSTANT_CACHE_TIERS
+_cache_tiers = None
+
+# Whether each cache tier can be written to, checked once per process
+_writable_tiers = {}
+
+def set_cache_tiers(tiers):
+    """Set the list of cache tiers, see get_cache_tiers, overriding the
+    environment variable INSTANT_CACHE_TIERS, or None to use it again."""
+    global _cache_tiers
+    _cache_tiers = None if tiers is None else \
+        [os.path.abspath(os.path.expanduser(t)) for t in tiers]
+
+
+def get_cache_tiers():
+    """Return the list of cache directories searched for modules, in order.
+
+    The tiers are set by set_cache_tiers or by the environment variable
+    INSTANT_CACHE_TIERS, a list of directories separated by os.pathsep,
+    for example a node local directory, the user cache and a read-only
+    cache shared by a site. New modules are placed in the first writable
+    tier, which is the default cache directory. Without tiers, the only
+    tier is INSTANT_CACHE_DIR or the cache in the instant directory."""
+    if _cache_tiers is not None:
+        return list(_cache_tiers)
+    tiers = os.environ.get("INSTANT_CACHE_TIERS")
+    if tiers:
+        return [os.path.abspath(os.path.expanduser(t))
+                for t in tiers.split(os.pathsep) if t]
     cache_dir = os.environ.get("INSTANT_CACHE_DIR")
     # Catches the cases where INSTANT_CACHE_DIR is not set or ''
     if not cache_dir:
         cache_dir = os.path.join(get_instant_dir(), "cache")
-    makedirs(cache_dir)
-    return cache_dir
+    return [cache_dir]
+
+
+def is_writable_tier(tier):
+    """Return True if modules can be placed in the cache tier, creating
+    its directory if necessary."""
+    writable = _writable_tiers.get(tier)
+    if writable is None:
+        try:
+            makedirs(tier)
+            writable = os.access(tier, os.W_OK)
+        except OSError:
+            writable = False
+        _writable_tiers[tier] = writable
+    return writable
+
+
+def get_default_cache_dir():
+    "Return the default cache directory, the first writable cache tier."
+    tiers = get_cache_tiers()
+    for cache_dir in tiers:
+        if is_writable_tier(cache_dir):
+            makedirs(cache_dir)
+            return cache_dir
+    instant_error("None of the cache tiers %s is writable." % ", ".join(tiers))
 
 
 def get_default_error_dir():
@@ -105,6 +163,17 @@ def get_default_error_dir():
     return error_dir
 
 
+def get_default_build_cache_dir():
+    """Return the default directory for caching intermediate build
+    results, such as object files, shared between all module caches."""
+    build_cache_dir = os.environ.get("INSTANT_BUILD_CACHE_DIR")
+    # Catches the cases where INSTANT_BUILD_CACHE_DIR is not set or ''
+    if not build_cache_dir:
+        build_cache_dir = os.path.join(get_instant_dir(), "build_cache")
+    makedirs(build_cache_dir)
+    return build_cache_dir
+
+
 def validate_cache_dir(cache_dir):
     if cache_dir is None:
         return get_default_cache_dir()
@@ -118,6 +187,10 @@ def makedirs(path):
     """
     Creates a directory (tree). If directory already excists it does nothing.
     """
+    # Only read the file system when the directory exists, which keeps
+    # cache lookups free of write system calls
+    if os.path.isdir(path):
+        return
     try:
         os.makedirs(path)
         instant_debug("In instant.makedirs: Creating directory %r" % path)
@@ -131,8 +204,10 @@ def _test():
     set_logging_level("DEBUG")
     print("Temp dir:", get_temp_dir())
     print("Instant dir:", get_instant_dir())
+    print("Cache tiers:", get_cache_tiers())
     print("Default cache dir:", get_default_cache_dir())
     print("Default error dir:", get_default_error_dir())
+    print("Default build cache dir:", get_default_build_cache_dir())
     delete_temp_dir()
 
 
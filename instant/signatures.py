@@ -21,42 +21,216 @@
 
 from six import string_types
 import io
+import os
+import time
 import hashlib
-from .output import instant_assert, instant_debug, instant_error
+import collections
+import sqlite3
+import threading
+from .output import instant_assert, instant_debug, instant_error, \
+     instant_warning
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Hash algorithms for checksums, with the prefix of their checksums.
+# Checksums computed with sha1 have no prefix, so that the checksums of
+# text alone, such as the signatures naming most cached modules, are
+# unchanged. Checksums of files are not, as they hash the file digests
+# rather than the file contents. The version in the prefixes of the
+# other algorithms allows changing how checksums are computed later.
+_checksum_version = 1
+_hash_algorithms = {
+    "sha1": lambda: hashlib.sha1(),
+    "sha256": lambda: hashlib.sha256(),
+    "blake2b": lambda: hashlib.blake2b(digest_size=32),
+    "xxhash": lambda: xxhash.xxh3_128(),
+    }
+
+# Files are hashed in chunks of this size, to bound the memory used
+_chunk_size = 1 << 20
+
+def get_hash_algorithm():
+    """Return the name of the hash algorithm for checksums, set by the
+    environment variable INSTANT_HASH_ALGORITHM to one of sha1 (the
+    default), sha256, blake2b or xxhash (if the xxhash module is
+    installed)."""
+    algorithm = os.environ.get("INSTANT_HASH_ALGORITHM") or "sha1"
+    if algorithm not in _hash_algorithms:
+        instant_error("Unknown hash algorithm INSTANT_HASH_ALGORITHM=%s,"\
+                      " expecting one of %s." % (algorithm,
+                      ", ".join(sorted(_hash_algorithms))))
+    if algorithm == "blake2b" and not hasattr(hashlib, "blake2b"):
+        instant_error("The hash algorithm blake2b needs Python 3.6.")
+    if algorithm == "xxhash" and xxhash is None:
+        instant_error("The hash algorithm xxhash needs the xxhash module.")
+    return algorithm
+
+
+def _checksum_prefix(algorithm):
+    if algorithm == "sha1":
+        return ""
+    return "%s_v%d_" % (algorithm, _checksum_version)
+
 
 def compute_checksum(text="", filenames=[]):
     """
-    Get the checksum value of filename
-    modified based on Python24\Tools\Scripts\md5.py
+    Get the checksum value of text and the contents of the files,
+    using the digests of the files from file_digest.
+
+    The hash algorithm is given by get_hash_algorithm(), the checksums
+    of algorithms other than sha1 are prefixed by its name and a version.
     """
     instant_assert(isinstance(text, string_types), "Expecting string.")
     instant_assert(isinstance(filenames, (list, tuple)), "Expecting sequence.")
     
-    m = hashlib.new('sha1')
+    algorithm = get_hash_algorithm()
+    m = _hash_algorithms[algorithm]()
     if text:
         m.update(text.encode('utf-8'))
     
     for filename in sorted(filenames): 
-        instant_debug("Adding file '%s' to checksum." % filename)
-        try:
-            fp = io.open(filename, 'rb')
-        except IOError as e:
-            instant_error("Can't open file '%s': %s" % (filename, e))
-        
-        try:
-            while True:
-                data = fp.read()
-                if not data:
-                    break
-                m.update(data)
-        except IOError as e:
-            instant_error("I/O error reading '%s': %s" % (filename, e))
-        
-        fp.close() 
+        m.update(file_digest(filename, algorithm).encode('ascii'))
     
+    return _checksum_prefix(algorithm) + m.hexdigest().lower()
+
+
+# Digests of files, keyed by (path, size, mtime in ns, inode, algorithm),
+# in this process and in a database shared by all processes. In memory,
+# at most _digests_size digests of the files used last are kept by
+# (path, algorithm).
+_digests = collections.OrderedDict()
+_digests_size = 4096
+_digests_lock = threading.Lock()
+_digest_db = None
+_digest_db_pid = None
+_digest_db_lock = threading.Lock()
+
+# Files modified this recently may still change within the resolution
+# of their modification time, their digests are not cached
+_digest_min_age = 2.0
+
+def file_digest(filename, algorithm="sha1"):
+    """Return the hex digest of the contents of a file.
+
+    The digests are cached by the path, size, modification time and
+    inode of the file, in memory and in the database digests.db in the
+    instant directory, so unchanged files are only read once."""
+    try:
+        st = os.stat(filename)
+    except OSError as e:
+        instant_error("Can't open file '%s': %s" % (filename, e))
+    mtime_ns = getattr(st, "st_mtime_ns", int(st.st_mtime*1e9))
+    key = (os.path.abspath(filename), st.st_size, mtime_ns, st.st_ino,
+           algorithm)
+
+    digest = _remembered_digest(key)
+    if digest is None:
+        digest = _lookup_digest(key)
+    if digest is None:
+        digest = _read_digest(filename, algorithm)
+        if time.time() - st.st_mtime < _digest_min_age:
+            return digest
+        _store_digest(key, digest)
+    _remember_digest(key, digest)
+    return digest
+
+
+def _remembered_digest(key):
+    "Return the digest of key from memory if it is still valid."
+    with _digests_lock:
+        entry = _digests.get((key[0], key[4]))
+        if entry is None or entry[0] != key:
+            return None
+        # Python 2 has no move_to_end
+        _digests[(key[0], key[4])] = _digests.pop((key[0], key[4]))
+        return entry[1]
+
+
+def _remember_digest(key, digest):
+    "Keep the digest of key in memory, forgetting the least recently used."
+    with _digests_lock:
+        _digests.pop((key[0], key[4]), None)
+        _digests[(key[0], key[4])] = (key, digest)
+        while len(_digests) > _digests_size:
+            _digests.popitem(last=False)
+
+
+def _read_digest(filename, algorithm):
+    "Compute the digest of a file by reading it in chunks."
+    instant_debug("Adding file '%s' to checksum." % filename)
+    m = _hash_algorithms[algorithm]()
+    try:
+        fp = io.open(filename, 'rb')
+    except IOError as e:
+        instant_error("Can't open file '%s': %s" % (filename, e))
+
+    try:
+        while True:
+            data = fp.read(_chunk_size)
+            if not data:
+                break
+            m.update(data)
+    except IOError as e:
+        instant_error("I/O error reading '%s': %s" % (filename, e))
+
+    fp.close()
     return m.hexdigest().lower()
 
 
+def _get_digest_db():
+    "Return the connection to the digest database, None if unavailable."
+    global _digest_db, _digest_db_pid
+    # Connections can not be used by forked processes
+    if _digest_db_pid != os.getpid():
+        from .paths import get_instant_dir
+        _digest_db_pid = os.getpid()
+        try:
+            _digest_db = sqlite3.connect(
+                os.path.join(get_instant_dir(), "digests.db"),
+                timeout=10.0, check_same_thread=False)
+            _digest_db.execute("CREATE TABLE IF NOT EXISTS file_digests "
+                               "(path TEXT, size INTEGER, mtime_ns INTEGER, "
+                               "inode INTEGER, algorithm TEXT, digest TEXT, "
+                               "PRIMARY KEY (path, algorithm))")
+            _digest_db.commit()
+        except sqlite3.Error as e:
+            instant_warning("Not caching file digests: %s" % e)
+            _digest_db = None
+    return _digest_db
+
+
+def _lookup_digest(key):
+    with _digest_db_lock:
+        db = _get_digest_db()
+        if db is None:
+            return None
+        try:
+            row = db.execute("SELECT size, mtime_ns, inode, digest"
+                             " FROM file_digests WHERE path = ? AND algorithm = ?",
+                             (key[0], key[4])).fetchone()
+        except sqlite3.Error:
+            return None
+    if row is None or tuple(row[:3]) != key[1:4]:
+        return None
+    return row[3]
+
+
+def _store_digest(key, digest):
+    with _digest_db_lock:
+        db = _get_digest_db()
+        if db is None:
+            return
+        try:
+            db.execute("INSERT OR REPLACE INTO file_digests"
+                       " VALUES (?, ?, ?, ?, ?, ?)", key + (digest,))
+            db.commit()
+        except sqlite3.Error as e:
+            instant_debug("Failed to cache the digest of %s: %s" % (key[0], e))
+
+
 def _test():
     signature = "(Test signature)"
     files = ["signatures.py", "__init__.py"]
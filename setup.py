@@ -5,15 +5,18 @@ from os.path import join, split, pardir
 
 try:
     from setuptools import setup
+    from setuptools.command.build_py import build_py
 except ImportError:
     from distutils.core import setup
+    from distutils.command.build_py import build_py
 
 if sys.version_info < (2, 7):
     print("Python 2.7 or higher required, please upgrade.")
     sys.exit(1)
 
 scripts = [join("scripts", "instant-clean"),
-           join("scripts", "instant-showcache")]
+           join("scripts", "instant-showcache"),
+           join("scripts", "instant-migrate-cache")]
 
 if platform.system() == "Windows" or "bdist_wininst" in sys.argv:
     # In the Windows command prompt we can't execute Python scripts
@@ -55,6 +58,16 @@ Topic :: Scientific/Engineering :: Mathematics
 Topic :: Software Development :: Libraries :: Python Modules
 """
 
+class build_py_no_coroutines(build_py):
+    "Leave out instant.asynchronous, which needs Python 3.5 or later."
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        return [m for m in modules if m[:2] != ("instant", "asynchronous")]
+
+cmdclass = {}
+if sys.version_info < (3, 5):
+    cmdclass["build_py"] = build_py_no_coroutines
+
 requires = ["numpy", "six"]
 if sys.version_info[0] == 2:
     requires.append("subprocess32")
@@ -71,6 +84,7 @@ setup(name="instant",
       package_dir={'instant': 'instant'},
       package_data={'': [join('swig', 'numpy.i')]},
       scripts=scripts,
+      cmdclass=cmdclass,
       install_requires=requires,
       data_files=[(join("share", "man", "man1"),
                    [join("doc", "man", "man1", "instant-clean.1.gz"),
@@ -0,0 +1,40 @@
+"""Benchmark of cache hits by many processes at once.
+
+Builds a module, then starts increasing numbers of processes importing
+it from the cache at the same time, printing the median and maximal
+hit latency for each number of processes. As cache hits take no locks
+and do not write to the cache, the latency should stay flat."""
+
+from __future__ import print_function
+import sys
+import subprocess
+import shutil
+import instant
+
+cache_dir = "bench_cache_hits_cache"
+hit = """
+import time, instant
+t0 = time.time()
+module = instant.import_module(%r, cache_dir=%r)
+assert module is not None
+print(time.time() - t0)
+"""
+
+def main(max_processes=64):
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    module = instant.build_module(code="double f(double a) { return 2*a; }",
+                                  cache_dir=cache_dir)
+    print("processes  median [ms]  max [ms]")
+    n = 1
+    while n <= max_processes:
+        code = hit % (module.__name__, cache_dir)
+        processes = [subprocess.Popen([sys.executable, "-c", code],
+                                      stdout=subprocess.PIPE)
+                     for i in range(n)]
+        times = sorted(float(p.communicate()[0]) for p in processes)
+        print("%9d  %11.2f  %8.2f" % (n, 1000*times[n//2], 1000*times[-1]))
+        n *= 2
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
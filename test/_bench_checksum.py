@@ -0,0 +1,34 @@
+"""Benchmark of the hash algorithms for checksums of large files.
+
+Writes a file of the given size in MB (default 256), and prints the
+throughput and the growth of the peak memory use when hashing it with
+each available algorithm, see instant.get_hash_algorithm."""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import resource
+from instant import signatures
+
+def main(size=256):
+    filename = "bench_checksum.bin"
+    with open(filename, "wb") as f:
+        for i in range(size):
+            f.write(os.urandom(1 << 20))
+    print("algorithm  MB/s     peak memory growth [MB]")
+    for algorithm in sorted(signatures._hash_algorithms):
+        if algorithm == "xxhash" and signatures.xxhash is None:
+            print("%-9s  not installed" % algorithm)
+            continue
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t0 = time.time()
+        # Read the file, bypassing the digest cache
+        signatures._read_digest(filename, algorithm)
+        t = time.time() - t0
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        print("%-9s  %7.1f  %.1f" % (algorithm, size/t, growth/1024.0))
+    os.remove(filename)
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,19 @@
+import os
+import shutil
+import tempfile
+import pytest
+
+@pytest.fixture
+def build_dir(monkeypatch):
+    """Run a test in a temporary working directory with its own build
+    cache, so that modules and caches built by it are always removed."""
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    try:
+        os.chdir(tmp)
+        monkeypatch.setenv("INSTANT_BUILD_CACHE_DIR",
+                           os.path.join(tmp, "build_cache"))
+        yield tmp
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
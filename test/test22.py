@@ -0,0 +1,71 @@
+from __future__ import print_function
+import pytest
+from instant import build_modules, build, place_module_in_memory_cache
+
+def test_build_modules(build_dir):
+    cache_dir = "test22_cache"
+
+    c_code = """
+double %s(double a, double b)
+{
+  return a %s b;
+}
+"""
+    specs = [dict(code=c_code % ("add", "+"), cache_dir=cache_dir),
+             dict(code=c_code % ("sub", "-"), cache_dir=cache_dir),
+             dict(code=c_code % ("add", "+"), cache_dir=cache_dir)]
+
+    modules, report = build_modules(specs, processes=2)
+    assert report == ["compiled", "compiled", "duplicate"]
+    assert modules[0] is modules[2]
+    assert modules[0].add(3, 4.5) == 7.5
+    assert modules[1].sub(3, 4.5) == -1.5
+
+    # All modules are now found in memory
+    modules2, report = build_modules(specs)
+    assert report == ["memory", "memory", "memory"]
+    assert all(m is m2 for m, m2 in zip(modules, modules2))
+
+def test_build_modules_serially(monkeypatch):
+    # Without a pool, the misses are built before importing, as with one
+    class FakeModule(object):
+        pass
+    built = []
+    def find_or_build_module(args, modulename, moduleids):
+        built.append(modulename)
+        module = FakeModule()
+        for moduleid in moduleids:
+            place_module_in_memory_cache(moduleid, module)
+        return module
+    monkeypatch.setattr(build, "_find_or_build_module", find_or_build_module)
+    specs = [dict(code="double f(double a);", signature="test22_f"),
+             dict(code="double g(double a);", signature="test22_g"),
+             dict(code="double f(double a);", signature="test22_f")]
+    modules, report = build_modules(specs, processes=1)
+    assert report == ["compiled", "compiled", "duplicate"]
+    assert len(built) == 2
+    assert modules[0] is modules[2] and modules[0] is not modules[1]
+
+def test_build_named_modules(build_dir, monkeypatch):
+    # Explicitly named modules left up to date are reported as found
+    import os
+    class FakeModule(object):
+        pass
+    def find_or_build_module(args, modulename, moduleids):
+        if modulename == "test22_stale":
+            with open(os.path.join(modulename, modulename + ".checksum"),
+                      "w") as f:
+                f.write("new")
+        return FakeModule()
+    monkeypatch.setattr(build, "_find_or_build_module", find_or_build_module)
+    for name in ("test22_current", "test22_stale"):
+        os.mkdir(name)
+        with open(os.path.join(name, name + ".checksum"), "w") as f:
+            f.write("old")
+        os.utime(os.path.join(name, name + ".checksum"), (1000.0, 1000.0))
+    specs = [dict(code="double f(double a);", modulename="test22_current"),
+             dict(code="double f(double a);", modulename="test22_stale"),
+             dict(code="double g(double a);", modulename="test22_new")]
+    os.mkdir("test22_new")
+    modules, report = build_modules(specs, processes=1)
+    assert report == ["disk", "compiled", "compiled"]
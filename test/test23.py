@@ -0,0 +1,32 @@
+from __future__ import print_function
+import pytest
+import os
+import threading
+from instant import build_module
+
+def test_threaded_build(build_dir):
+    cache_dir = "test23_cache"
+    cwd = os.getcwd()
+
+    c_code = """
+double scale%d(double a)
+{
+  return %d*a;
+}
+"""
+    results = {}
+    def build(i):
+        try:
+            module = build_module(code=c_code % (i, i), cache_dir=cache_dir)
+            results[i] = getattr(module, "scale%d" % i)(2.0)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=build, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert os.getcwd() == cwd
+    assert results == dict((i, 2.0*i) for i in range(4))
@@ -0,0 +1,36 @@
+from __future__ import print_function
+import pytest
+import threading
+from instant import build_module, inflight_build_statistics
+
+def test_concurrent_build_same_module(build_dir):
+    cache_dir = "test24_cache"
+
+    c_code = """
+double mul(double a, double b)
+{
+  return a*b;
+}
+"""
+    before = inflight_build_statistics()
+
+    start = threading.Event()
+    modules = []
+    def build():
+        start.wait()
+        modules.append(build_module(code=c_code, cache_dir=cache_dir))
+
+    threads = [threading.Thread(target=build) for i in range(8)]
+    for t in threads:
+        t.start()
+    start.set()
+    for t in threads:
+        t.join()
+
+    after = inflight_build_statistics()
+
+    # Only a single build, all threads got the same module
+    assert after["builds"] - before["builds"] == 1
+    assert len(modules) == 8
+    assert all(m is modules[0] for m in modules)
+    assert modules[0].mul(3, 4.5) == 13.5
@@ -0,0 +1,101 @@
+from __future__ import print_function
+import pytest
+import sys
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 5),
+                                reason="requires asyncio coroutines")
+
+def test_build_module_async(build_dir):
+    import asyncio
+    from instant import inline_async, build_module_async, import_module_async
+
+    cache_dir = "test25_cache"
+
+    c_code = """
+double %s(double a, double b)
+{
+  return a %s b;
+}
+"""
+    async def main():
+        add, sub, add2 = await asyncio.gather(
+            inline_async(c_code % ("add", "+"), cache_dir=cache_dir),
+            inline_async(c_code % ("sub", "-"), cache_dir=cache_dir),
+            inline_async(c_code % ("add", "+"), cache_dir=cache_dir))
+        assert add(3, 4.5) == 7.5
+        assert sub(3, 4.5) == -1.5
+        assert add2 is add
+
+        module = await build_module_async(code=c_code % ("div", "/"),
+                                          signature="test25_signature",
+                                          cache_dir=cache_dir)
+        module2 = await import_module_async("test25_signature", cache_dir)
+        assert module2 is module
+        assert module.div(3, 4) == 0.75
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+def test_cache_lookup_off_loop(build_dir, monkeypatch):
+    import asyncio
+    import threading
+    from instant import asynchronous
+
+    class FakeModule(object):
+        pass
+
+    threads = []
+    def check_disk_cache(modulename, cache_dir, moduleids):
+        threads.append(threading.current_thread())
+        return FakeModule()
+    monkeypatch.setattr(asynchronous, "check_disk_cache", check_disk_cache)
+
+    loop = asyncio.new_event_loop()
+    try:
+        module = loop.run_until_complete(asynchronous.build_module_async(
+            code="double f(double a);", signature="test25_off_loop",
+            cache_dir="test25_cache"))
+    finally:
+        loop.close()
+    assert isinstance(module, FakeModule)
+    assert threads and threads[0] is not threading.current_thread()
+
+def test_build_jobs_shared(build_dir, monkeypatch):
+    # The build commands of concurrent builds share INSTANT_BUILD_JOBS
+    import asyncio
+    import os
+    from instant import asynchronous
+    monkeypatch.setenv("INSTANT_BUILD_JOBS", "2")
+    running = [0, 0]
+    class Process(object):
+        returncode = 0
+        async def communicate(self):
+            running[0] += 1
+            running[1] = max(running)
+            await asyncio.sleep(0.05)
+            running[0] -= 1
+            return b"", None
+    async def create_subprocess_exec(*cmd, **kwargs):
+        return Process()
+    def compile_steps(modulename, module_path, build_system):
+        yield [["cc", "-c", "%d.c" % i] for i in range(3)]
+    monkeypatch.setattr(asyncio, "create_subprocess_exec",
+                        create_subprocess_exec)
+    monkeypatch.setattr(asynchronous, "_compile_steps", compile_steps)
+    for name in ("test25_a", "test25_b"):
+        os.mkdir(name)
+
+    async def main():
+        await asyncio.gather(
+            *[asynchronous.recompile_async(name, name, "checksum", "native")
+              for name in ("test25_a", "test25_b")])
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+    assert running[1] == 2
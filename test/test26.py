@@ -0,0 +1,42 @@
+from __future__ import print_function
+import pytest
+import os
+from instant import build_module
+
+c_code = """
+double sum(double a, double b){
+  return a+b;
+}
+"""
+
+@pytest.mark.parametrize("build_system", ["native", "distutils"])
+def test_build_system(build_system, build_dir, monkeypatch):
+    if build_system == "distutils":
+        pytest.importorskip("distutils")
+    monkeypatch.setenv("INSTANT_BUILD_SYSTEM", build_system)
+    modulename = "test26_%s_ext" % build_system
+
+    module = build_module(code=c_code, modulename=modulename)
+    assert module.sum(3.7, 4.8) == 8.5
+
+    files = os.listdir(modulename)
+    assert ("build.json" in files) == (build_system == "native")
+    assert ("setup.py" in files) == (build_system == "distutils")
+
+def test_cxx_linker(monkeypatch):
+    from instant import config
+    # Only the C compiler is replaced in the linker command of Python
+    assert config._cxx_linker(["gcc", "-pthread", "-shared"],
+                              ["gcc", "-pthread"], ["g++", "-pthread"]) \
+        == ["g++", "-pthread", "-shared"]
+    assert config._cxx_linker(["ccache", "gcc", "-shared"], ["ccache", "gcc"],
+                              ["ccache", "g++"]) == ["ccache", "g++", "-shared"]
+    assert config._cxx_linker(["env", "A=1", "gcc", "-shared"], ["cc"],
+                              ["c++"]) == ["env", "A=1", "c++", "-shared"]
+
+    # A linker set in the environment is used as it is
+    monkeypatch.setattr(config, "_compiler_config_cache", None)
+    monkeypatch.setenv("LDSHARED", "ccache gcc -shared")
+    monkeypatch.setenv("LDFLAGS", "-L/opt/lib")
+    assert config.get_compiler_config()["ldshared"] \
+        == ["ccache", "gcc", "-shared", "-L/opt/lib"]
@@ -0,0 +1,65 @@
+from __future__ import print_function
+from instant import build_module, build_cache_statistics
+
+kernel_code = """
+double kernel(double a, double b)
+{
+  return a*b;
+}
+"""
+
+def test_object_cache(build_dir, monkeypatch):
+    monkeypatch.setenv("INSTANT_BUILD_SYSTEM", "native")
+    cache_dir = "test27_cache"
+    with open("test27_kernel.cpp", "w") as f:
+        f.write(kernel_code)
+
+    def objects():
+        return build_cache_statistics().get("objects", {"hits": 0, "misses": 0})
+
+    # The wrappers differ, the kernel is compiled once
+    before = objects()
+    for i in range(2):
+        code = "double kernel(double a, double b);\n" \
+               "double f%d(double a) { return kernel(a, %d.0); }\n" % (i, i + 2)
+        module = build_module(code=code, sources=["test27_kernel.cpp"],
+                              cache_dir=cache_dir)
+        assert getattr(module, "f%d" % i)(1.5) == 1.5*(i + 2)
+    after = objects()
+    assert after["misses"] - before["misses"] == 1
+    assert after["hits"] - before["hits"] == 1
+
+def test_concurrent_statistics(tmpdir, monkeypatch):
+    # Compile threads count build cache lookups without losing any
+    import threading
+    from instant import fetch_build_cache
+    monkeypatch.setenv("INSTANT_BUILD_CACHE_DIR", str(tmpdir.join("build_cache")))
+    before = build_cache_statistics().get("test27", {"misses": 0})["misses"]
+    def lookup():
+        for i in range(200):
+            fetch_build_cache("test27", "%040d" % i, {})
+    threads = [threading.Thread(target=lookup) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert build_cache_statistics()["test27"]["misses"] == before + 1600
+
+def test_build_cache_quota(tmpdir, monkeypatch):
+    # The least recently used entries are removed above the quota
+    import os
+    from instant import store_build_cache, fetch_build_cache, \
+         build_cache_entries, enforce_build_cache_quota
+    monkeypatch.setenv("INSTANT_BUILD_CACHE_DIR", str(tmpdir.join("build_cache")))
+    source = str(tmpdir.join("object.o"))
+    with open(source, "w") as f:
+        f.write("x"*1000)
+    for i, key in enumerate(["%040d" % i for i in range(3)]):
+        store_build_cache("test27", key, {"object.o": source})
+        os.utime(build_cache_entries()[-1]["path"], (1000.0*i, 1000.0*i))
+    assert fetch_build_cache("test27", "%040d" % 0, {"object.o": source})
+    monkeypatch.setenv("INSTANT_BUILD_CACHE_MAX_SIZE", "2K")
+    assert enforce_build_cache_quota() == 1
+    assert sorted(e["key"] for e in build_cache_entries()) \
+        == ["%040d" % 0, "%040d" % 2]
+    assert not fetch_build_cache("test27", "%040d" % 1, {"object.o": source})
@@ -0,0 +1,55 @@
+from __future__ import print_function
+import os
+import threading
+import time
+import pytest
+from instant import build, build_module, get_build_jobs
+
+def test_parallel_compilation(build_dir, monkeypatch):
+    monkeypatch.setenv("INSTANT_BUILD_SYSTEM", "native")
+    monkeypatch.setenv("INSTANT_BUILD_JOBS", "4")
+    assert get_build_jobs() == 4
+    modulename = "test28_ext"
+
+    n = 6
+    sources = []
+    for i in range(n):
+        sources.append("test28_source%d.cpp" % i)
+        with open(sources[-1], "w") as f:
+            f.write("double term%d(double x) { return %d.0*x; }\n" % (i, i))
+    code = "".join("double term%d(double x);\n" % i for i in range(n))
+    code += "double poly(double x) { return %s; }\n" % \
+            " + ".join("term%d(x)" % i for i in range(n))
+
+    module = build_module(code=code, sources=sources, modulename=modulename)
+    assert module.poly(2.0) == 2.0*sum(range(n))
+
+def test_compiles_overlap(build_dir, monkeypatch):
+    # Record how many commands of a step run at the same time
+    monkeypatch.setenv("INSTANT_BUILD_JOBS", "4")
+    lock = threading.Lock()
+    running = [0]
+    overlap = [0]
+    def get_status_output(cmd, cwd=None):
+        with lock:
+            running[0] += 1
+            overlap[0] = max(overlap[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return 0, ""
+    def compile_steps(modulename, module_path, build_system):
+        commands = [["cc", "-c", "test28_source%d.cpp" % i] for i in range(6)]
+        results = yield commands
+        assert len(results) == 6
+    monkeypatch.setattr(build, "get_status_output", get_status_output)
+    monkeypatch.setattr(build, "_compile_steps", compile_steps)
+
+    os.mkdir("test28_ext")
+    build.recompile("test28_ext", "test28_ext", "checksum", "native")
+    assert 1 < overlap[0] <= 4
+
+def test_invalid_build_jobs(monkeypatch):
+    monkeypatch.setenv("INSTANT_BUILD_JOBS", "zero")
+    with pytest.raises(Exception):
+        get_build_jobs()
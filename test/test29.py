@@ -0,0 +1,25 @@
+from __future__ import print_function
+from instant import build_module, build_cache_statistics, \
+     build_step_statistics
+
+c_code = """
+double sum(double a, double b){
+  return a+b;
+}
+"""
+
+def test_swig_cache(build_dir, monkeypatch):
+    monkeypatch.setenv("INSTANT_BUILD_SYSTEM", "native")
+    cache_dir = "test29_cache"
+
+    def swig():
+        return (build_cache_statistics().get("swig", {}).get("hits", 0),
+                build_step_statistics().get("swig", {}).get("runs", 0))
+
+    # Only the compiler flags and the module names differ
+    hits, runs = swig()
+    for flags in (["-O0"], ["-O1"]):
+        module = build_module(code=c_code, cppargs=flags, cache_dir=cache_dir)
+        assert module.sum(3.7, 4.8) == 8.5
+    assert swig() == (hits + 1, runs + 1)
+    assert build_step_statistics()["swig"]["time"] > 0.0
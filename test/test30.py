@@ -0,0 +1,26 @@
+from __future__ import print_function
+import os
+import json
+from instant import build_module, build_cache_statistics
+
+def test_precompiled_headers(build_dir, monkeypatch):
+    monkeypatch.setenv("INSTANT_BUILD_SYSTEM", "native")
+    monkeypatch.setenv("INSTANT_PRECOMPILED_HEADERS", "1")
+
+    def pch():
+        return build_cache_statistics().get("pch", {"hits": 0, "misses": 0})
+
+    before = pch()
+    for i in range(2):
+        modulename = "test30_%d_ext" % i
+        code = "double f(double a) { std::vector<double> v(%d, a);" \
+               " return v.size()*a; }" % (i + 1)
+        module = build_module(code=code, system_headers=["vector"],
+                              modulename=modulename)
+        assert module.f(1.5) == 1.5*(i + 1)
+        with open(os.path.join(modulename, "build.json")) as f:
+            assert "pch" in json.load(f)
+        assert os.path.exists(os.path.join(modulename, "instant_pch.h"))
+    after = pch()
+    assert after["misses"] - before["misses"] == 1
+    assert after["hits"] - before["hits"] == 1
@@ -0,0 +1,76 @@
+from __future__ import print_function
+import os
+import pytest
+from instant.build import _compile_steps
+try:
+    from shutil import which
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable as which
+
+def run_steps(module_path):
+    "Return the commands of the cmake build, as if they all succeeded."
+    steps = _compile_steps("test31_ext", module_path, "cmake")
+    commands = []
+    results = None
+    while True:
+        try:
+            step = steps.send(results)
+        except StopIteration:
+            return commands
+        commands += step
+        results = [(0, "")]*len(step)
+
+def test_cmake_steps(build_dir, monkeypatch):
+    monkeypatch.setenv("INSTANT_CMAKE_GENERATOR", "Ninja")
+    monkeypatch.setenv("INSTANT_BUILD_JOBS", "3")
+    module_path = "test31_ext"
+    os.mkdir(module_path)
+    with open(os.path.join(module_path, "CMakeLists.txt"), "w") as f:
+        f.write("project(test31)\n")
+
+    configure, build = run_steps(module_path)
+    assert configure == ["cmake", "-G", "Ninja",
+                         "-DCMAKE_BUILD_TYPE=Release", "."]
+    assert build == ["ninja", "-j3", "-v"]
+
+    # A configured build tree is reused until CMakeLists.txt changes
+    open(os.path.join(module_path, "CMakeCache.txt"), "w").close()
+    assert run_steps(module_path) == [build]
+    with open(os.path.join(module_path, "CMakeLists.txt"), "a") as f:
+        f.write("# changed\n")
+    assert run_steps(module_path) == [configure, build]
+
+    # So is a change of generator or build type
+    monkeypatch.setenv("INSTANT_CMAKE_BUILD_TYPE", "Debug")
+    monkeypatch.setenv("INSTANT_CMAKE_GENERATOR", "Unix Makefiles")
+    configure, build = run_steps(module_path)
+    assert configure[2:4] == ["Unix Makefiles", "-DCMAKE_BUILD_TYPE=Debug"]
+    assert build == ["make", "-j3", "VERBOSE=1"]
+
+def test_cmake_package_cache(build_dir):
+    # Configure two modules finding the same package for real
+    if which("cmake") is None:
+        pytest.skip("cmake not found")
+
+    from instant import get_status_output
+    for i in range(2):
+        module_path = "test31_%d_ext" % i
+        os.mkdir(module_path)
+        with open(os.path.join(module_path, "CMakeLists.txt"), "w") as f:
+            f.write("cmake_minimum_required(VERSION 3.5)\n"
+                    "project(test31_%d)\n"
+                    "FIND_PACKAGE(SWIG REQUIRED)\n" % i)
+
+        steps = _compile_steps("test31_%d_ext" % i, module_path, "cmake")
+        configure = steps.send(None)[0]
+        result = get_status_output(configure, cwd=module_path)
+        assert result[0] == 0, result[1]
+        steps.send([result])
+        # The second module starts from the entries found for the first
+        assert ("-C" in configure) == (i == 1)
+
+    with open(os.path.join("test31_0_ext", "instant_initial_cache.cmake")) as f:
+        initial_cache = f.read()
+    assert "SWIG_EXECUTABLE" in initial_cache
+    assert "test31_0" not in initial_cache
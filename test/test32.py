@@ -0,0 +1,53 @@
+from __future__ import print_function
+import os
+from instant import build_module, copy_to_cache, cached_modules, \
+     cached_module_path, enforce_cache_quota
+
+def test_publish_by_rename(tmpdir):
+    cache_dir = str(tmpdir.join("cache"))
+    os.mkdir(cache_dir)
+    module_path = str(tmpdir.join("build"))
+    os.mkdir(module_path)
+    with open(os.path.join(module_path, "a.txt"), "w") as f:
+        f.write("first")
+
+    path = copy_to_cache(module_path, cache_dir, "test32_module")
+    assert path == cached_module_path(cache_dir, "test32_module")
+    assert os.path.exists(os.path.join(path, "finished_copying"))
+    assert os.path.exists(module_path)
+
+    # A published module is not overwritten, unless asked to
+    with open(os.path.join(module_path, "a.txt"), "w") as f:
+        f.write("second")
+    copy_to_cache(module_path, cache_dir, "test32_module")
+    assert open(os.path.join(path, "a.txt")).read() == "first"
+    copy_to_cache(module_path, cache_dir, "test32_module",
+                  check_for_existing_path=False)
+    assert open(os.path.join(path, "a.txt")).read() == "second"
+
+    # No staging directories are left behind
+    assert [f for f in os.listdir(cache_dir) if f.startswith(".")] \
+        == [".index.db"]
+    assert sorted(os.listdir(os.path.dirname(path))) == [".stale.lock",
+                                                         "test32_module",
+                                                         "test32_module.lock"]
+
+def test_build_in_staging_directory(build_dir):
+    cache_dir = "test32_cache"
+    module = build_module(code="double f(double a) { return 2*a; }",
+                          cache_dir=cache_dir)
+    assert module.f(1.5) == 3.0
+    assert cached_modules(cache_dir) == [module.__name__]
+    assert [f for f in os.listdir(cache_dir) if f.startswith(".")] \
+        == [".index.db"]
+
+def test_abandoned_staging_directories(tmpdir):
+    # Staging directories of killed builds are removed after a day
+    cache_dir = str(tmpdir.join("cache"))
+    for name in (".test32_old.abc", ".test32_new.abc"):
+        os.makedirs(os.path.join(cache_dir, name, "test32_module"))
+    old = os.path.join(cache_dir, ".test32_old.abc")
+    os.utime(old, (0.0, 0.0))
+    assert enforce_cache_quota(cache_dir) == []
+    assert sorted(f for f in os.listdir(cache_dir) if f.endswith(".abc")) \
+        == [".test32_new.abc"]
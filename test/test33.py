@@ -0,0 +1,28 @@
+from __future__ import print_function
+import os
+import sys
+import instant
+from instant import build_module, check_disk_cache
+
+def listing(path):
+    return sorted(os.path.join(root, f) for root, dirs, files in os.walk(path)
+                  for f in dirs + files)
+
+def test_lock_free_cache_hit(build_dir, monkeypatch):
+    cache_dir = "test33_cache"
+    module = build_module(code="double f(double a) { return 2*a + 33; }",
+                          cache_dir=cache_dir)
+    modulename = module.__name__
+    before = listing(cache_dir)
+
+    # Look the module up as a fresh process would, without locking,
+    # creating directories or writing bytecode
+    def fail(*args, **kwargs):
+        raise AssertionError("Cache hit must not lock or write.")
+    monkeypatch.setattr(os, "mkdir", fail)
+    monkeypatch.setattr(os, "makedirs", fail)
+    monkeypatch.setattr(instant.locking, "get_lock", fail)
+    monkeypatch.delitem(sys.modules, modulename)
+    module = check_disk_cache(modulename, cache_dir, [])
+    assert module.f(1.5) == 36.0
+    assert listing(cache_dir) == before
@@ -0,0 +1,43 @@
+from __future__ import print_function
+import os
+import shutil
+import pytest
+from instant import file_lock, locking
+
+def can_lock(filename, mode):
+    "Check if another open file could get the flock mode right now."
+    fcntl = locking.fcntl
+    with open(filename, "w") as f:
+        try:
+            fcntl.flock(f.fileno(), mode | fcntl.LOCK_NB)
+        except IOError:
+            return False
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return True
+
+def test_shared_locks():
+    if locking.fcntl is None:
+        pytest.skip("Shared locks need fcntl")
+    LOCK_SH, LOCK_EX = locking.fcntl.LOCK_SH, locking.fcntl.LOCK_EX
+    cache_dir = "test34_cache"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.mkdir(cache_dir)
+    lockfile = os.path.join(cache_dir, "test34.lock")
+
+    with file_lock(cache_dir, "test34", shared=True):
+        # Other readers proceed, writers wait
+        assert can_lock(lockfile, LOCK_SH)
+        assert not can_lock(lockfile, LOCK_EX)
+
+        # Upgrade to an exclusive lock, and downgrade again
+        with file_lock(cache_dir, "test34"):
+            assert not can_lock(lockfile, LOCK_SH)
+            with file_lock(cache_dir, "test34", shared=True):
+                assert not can_lock(lockfile, LOCK_SH)
+            assert not can_lock(lockfile, LOCK_SH)
+        assert can_lock(lockfile, LOCK_SH)
+        assert not can_lock(lockfile, LOCK_EX)
+
+    assert can_lock(lockfile, LOCK_EX)
+    assert not locking._lock_files
+    shutil.rmtree(cache_dir)
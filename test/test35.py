@@ -0,0 +1,115 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import socket
+import subprocess
+import pytest
+from instant import get_lock, release_lock, file_lock, lock_statistics, \
+     locking
+
+@pytest.fixture
+def cache_dir():
+    if locking.fcntl is None:
+        pytest.skip("Lock timeouts need fcntl")
+    cache_dir = "test35_cache"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.mkdir(cache_dir)
+    yield cache_dir
+    shutil.rmtree(cache_dir)
+
+def hold_lock(filename, pid):
+    "Hold an exclusive lock on filename, as if taken by process pid."
+    f = open(filename, "w")
+    locking.fcntl.flock(f.fileno(), locking.fcntl.LOCK_EX)
+    f.write("%s %d\n" % (socket.gethostname(), pid))
+    f.flush()
+    return f
+
+def test_lock_timeout(cache_dir, monkeypatch):
+    monkeypatch.setenv("INSTANT_LOCK_TIMEOUT", "0.2")
+    held = hold_lock(os.path.join(cache_dir, "test35_a.lock"), os.getpid())
+    t0 = time.time()
+    with pytest.raises(RuntimeError) as e:
+        get_lock(cache_dir, "test35_a")
+    assert time.time() - t0 >= 0.2
+    assert "process %d" % os.getpid() in str(e.value)
+    assert lock_statistics()["test35_a.lock"]["timeouts"] == 1
+
+    # Waiting succeeds when the lock is released in time
+    held.close()
+    with file_lock(cache_dir, "test35_a"):
+        pass
+    statistics = lock_statistics()["test35_a.lock"]
+    assert statistics["acquired"] == 1
+    assert sum(count for bound, count in statistics["histogram"]) == 2
+
+def test_stale_lock(cache_dir):
+    # A lock file still locked by a child of a dead process
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    held = hold_lock(os.path.join(cache_dir, "test35_b.lock"), dead.pid)
+    with file_lock(cache_dir, "test35_b"):
+        pass
+    assert lock_statistics()["test35_b.lock"]["stale"] == 1
+    held.close()
+
+def test_broken_lock_taken_again(cache_dir):
+    # A stale lock broken and taken by another process meanwhile is kept
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    filename = os.path.join(cache_dir, "test35_c.lock")
+    broken = hold_lock(filename, dead.pid)
+    stat = os.stat(filename)
+    os.remove(filename)
+    held = hold_lock(filename, dead.pid)
+    locking._break_stale_lock(filename, "test35_c.lock", (socket.gethostname(),
+                                                          dead.pid), stat)
+    assert os.path.samestat(os.stat(filename), os.fstat(held.fileno()))
+    held.close()
+    broken.close()
+
+def test_dead_holder_live_reader(cache_dir, monkeypatch):
+    # A file naming a dead process, but shared by a live reader, is waited
+    # for until the timeout instead of being broken over and over
+    monkeypatch.setenv("INSTANT_LOCK_TIMEOUT", "0.2")
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    filename = os.path.join(cache_dir, "test35_e.lock")
+    with open(filename, "w") as f:
+        f.write("%s %d\n" % (socket.gethostname(), dead.pid))
+    reader = open(filename)
+    locking.fcntl.flock(reader.fileno(), locking.fcntl.LOCK_SH)
+    t0 = time.time()
+    with pytest.raises(RuntimeError):
+        get_lock(cache_dir, "test35_e")
+    assert 0.2 <= time.time() - t0 < 5.0
+    statistics = lock_statistics()["test35_e.lock"]
+    assert statistics["timeouts"] == 1
+    assert statistics["stale"] == 0
+    assert os.path.samestat(os.stat(filename), os.fstat(reader.fileno()))
+    reader.close()
+
+def test_upgrade_timeout(cache_dir, monkeypatch):
+    monkeypatch.setenv("INSTANT_LOCK_TIMEOUT", "0.2")
+    filename = os.path.join(cache_dir, "test35_d.lock")
+    with file_lock(cache_dir, "test35_d", shared=True):
+        reader = open(filename)
+        locking.fcntl.flock(reader.fileno(), locking.fcntl.LOCK_SH)
+        t0 = time.time()
+        with pytest.raises(RuntimeError):
+            get_lock(cache_dir, "test35_d")
+        assert time.time() - t0 >= 0.2
+        assert lock_statistics()["test35_d.lock"]["timeouts"] == 1
+        reader.close()
+
+        # The shared lock is still held
+        writer = open(filename)
+        with pytest.raises(IOError):
+            locking.fcntl.flock(writer.fileno(),
+                                locking.fcntl.LOCK_EX | locking.fcntl.LOCK_NB)
+        writer.close()
+
+        with file_lock(cache_dir, "test35_d"):
+            pass
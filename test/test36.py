@@ -0,0 +1,49 @@
+from __future__ import print_function
+import os
+import time
+import shutil
+import inspect
+import threading
+import pytest
+from instant import file_lock, locking
+
+def test_threads_exclude_each_other():
+    if locking.fcntl is None:
+        pytest.skip("Per-thread locks need fcntl")
+    cache_dir = "test36_cache"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.mkdir(cache_dir)
+
+    holders = []
+    overlaps = []
+    def work():
+        for i in range(5):
+            with file_lock(cache_dir, "test36"):
+                # Reentrant within the thread
+                with file_lock(cache_dir, "test36"):
+                    holders.append(threading.current_thread())
+                    if len(holders) > 1:
+                        overlaps.append(list(holders))
+                    time.sleep(0.002)
+                    holders.remove(threading.current_thread())
+
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert overlaps == []
+    assert not locking._lock_files
+    shutil.rmtree(cache_dir)
+
+def test_no_stack_inspection(monkeypatch):
+    # Stack inspection is only for debug messages
+    cache_dir = "test36_cache"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.mkdir(cache_dir)
+    def fail():
+        raise AssertionError("Stack inspected while not debugging.")
+    monkeypatch.setattr(inspect, "currentframe", fail)
+    with file_lock(cache_dir, "test36"):
+        pass
+    shutil.rmtree(cache_dir)
@@ -0,0 +1,60 @@
+from __future__ import print_function
+import io
+import os
+import collections
+import time
+import pytest
+from instant import compute_checksum
+from instant import signatures
+
+def write(filename, text, age=60.0):
+    with open(filename, "w") as f:
+        f.write(text)
+    t = time.time() - age
+    os.utime(filename, (t, t))
+
+def test_digest_cache(monkeypatch):
+    filename = "test37_header.h"
+    write(filename, "double f(double);\n")
+    checksum = compute_checksum("text", [filename])
+
+    # Unchanged files are not read again, in this process or another one
+    def fail(*args, **kwargs):
+        raise AssertionError("Unchanged file read again.")
+    monkeypatch.setattr(signatures, "_read_digest", fail)
+    assert compute_checksum("text", [filename]) == checksum
+    monkeypatch.setattr(signatures, "_digests", collections.OrderedDict())
+    assert compute_checksum("text", [filename]) == checksum
+    monkeypatch.undo()
+
+    # Changed files are
+    write(filename, "double g(double);\n")
+    assert compute_checksum("text", [filename]) != checksum
+    write(filename, "double f(double);\n", age=120.0)
+    assert compute_checksum("text", [filename]) == checksum
+
+    # Recently modified files are read every time
+    write(filename, "double f(double);\n", age=0.0)
+    monkeypatch.setattr(signatures, "_digests", collections.OrderedDict())
+    assert compute_checksum("text", [filename]) == checksum
+    monkeypatch.setattr(signatures, "_read_digest", fail)
+    with pytest.raises(AssertionError):
+        compute_checksum("text", [filename])
+    os.remove(filename)
+
+def test_digest_memory_bound(tmpdir, monkeypatch):
+    # Only the digests of the files used last are kept in memory
+    monkeypatch.setattr(signatures, "_digests", collections.OrderedDict())
+    monkeypatch.setattr(signatures, "_digests_size", 2)
+    filenames = [str(tmpdir.join("test37_%d.h" % i)) for i in range(3)]
+    for filename in filenames:
+        write(filename, filename)
+        signatures.file_digest(filename)
+    signatures.file_digest(filenames[0])
+    assert [path for path, algorithm in signatures._digests] \
+        == filenames[2:] + filenames[:1]
+
+    # A changed file replaces its old digest
+    write(filenames[0], "changed", age=120.0)
+    signatures.file_digest(filenames[0])
+    assert len(signatures._digests) == 2
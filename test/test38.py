@@ -0,0 +1,42 @@
+from __future__ import print_function
+import os
+import hashlib
+import pytest
+from instant import compute_checksum, file_digest, get_hash_algorithm
+from instant import signatures
+
+algorithms = ["sha1", "sha256", "blake2b", "xxhash"]
+
+def test_sha1_compatible():
+    text = "double f(double a) { return a; }"
+    assert get_hash_algorithm() == "sha1"
+    assert compute_checksum(text) == hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+@pytest.mark.parametrize("algorithm", algorithms)
+def test_hash_algorithms(algorithm, monkeypatch):
+    if algorithm == "xxhash":
+        pytest.importorskip("xxhash")
+    if algorithm == "blake2b" and not hasattr(hashlib, "blake2b"):
+        pytest.skip("blake2b needs Python 3.6")
+    monkeypatch.setenv("INSTANT_HASH_ALGORITHM", algorithm)
+    checksum = compute_checksum("text")
+    if algorithm == "sha1":
+        assert "_" not in checksum
+    else:
+        assert checksum.startswith(algorithm + "_v1_")
+    assert checksum != compute_checksum("other text")
+
+def test_chunked_file_digest(monkeypatch):
+    filename = "test38_data.bin"
+    data = os.urandom(10000)
+    with open(filename, "wb") as f:
+        f.write(data)
+    monkeypatch.setattr(signatures, "_chunk_size", 1024)
+    assert file_digest(filename) == hashlib.sha1(data).hexdigest()
+    assert file_digest(filename, "sha256") == hashlib.sha256(data).hexdigest()
+    os.remove(filename)
+
+def test_unknown_algorithm(monkeypatch):
+    monkeypatch.setenv("INSTANT_HASH_ALGORITHM", "md4")
+    with pytest.raises(RuntimeError):
+        compute_checksum("text")
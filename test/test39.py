@@ -0,0 +1,72 @@
+from __future__ import print_function
+import os
+import time
+from instant import build, fast_path_statistics, place_module_in_memory_cache
+
+class FakeModule(object):
+    pass
+
+def test_fast_path(monkeypatch):
+    filename = "test39_source.c"
+    with open(filename, "w") as f:
+        f.write("double f(double a) { return a; }\n")
+
+    def find_or_build_module(args, modulename, moduleids):
+        module = FakeModule()
+        for moduleid in moduleids:
+            place_module_in_memory_cache(moduleid, module)
+        return module
+    monkeypatch.setattr(build, "_find_or_build_module", find_or_build_module)
+    kwargs = dict(code="double f(double a);", sources=[filename],
+                  cppargs=["-O2"])
+    module = build.build_module(**kwargs)
+
+    # Identical calls return the module without validating the arguments
+    def fail(**kwargs):
+        raise AssertionError("Arguments validated again.")
+    monkeypatch.setattr(build, "_validate_build_args", fail)
+    before = fast_path_statistics()
+    assert build.build_module(**kwargs) is module
+    after = fast_path_statistics()
+    assert after["hits"] == before["hits"] + 1
+    assert after["misses"] == before["misses"]
+    monkeypatch.undo()
+    monkeypatch.setattr(build, "_find_or_build_module", find_or_build_module)
+
+    # Changed arguments and files are not
+    assert build.build_module(code="double g(double a);",
+                              sources=[filename]) is not module
+    t = time.time() - 60.0
+    os.utime(filename, (t, t))
+    before = fast_path_statistics()
+    build.build_module(**kwargs)
+    assert fast_path_statistics()["misses"] == before["misses"] + 1
+    os.remove(filename)
+
+def test_fast_path_signature_string(monkeypatch):
+    class Sig(object):
+        hashes = 0
+        def signature(self):
+            return "test39 signature"
+        def __hash__(self):
+            Sig.hashes += 1
+            return 39
+
+    def find_or_build_module(args, modulename, moduleids):
+        module = FakeModule()
+        for moduleid in moduleids:
+            place_module_in_memory_cache(moduleid, module)
+        return module
+    monkeypatch.setattr(build, "_find_or_build_module", find_or_build_module)
+    sig = Sig()
+    module = build.build_module(code="double f(double a);", signature=sig)
+    Sig.hashes = 0
+    assert build.build_module(code="double f(double a);",
+                              signature=sig) is module
+    assert Sig.hashes == 0
+
+    # The fast path is keyed by the signature string, not the object
+    before = fast_path_statistics()
+    assert build.build_module(code="double f(double a);",
+                              signature=Sig()) is module
+    assert fast_path_statistics()["hits"] == before["hits"] + 1
@@ -0,0 +1,71 @@
+from __future__ import print_function
+import gc
+import sys
+import types
+from instant import memory_cached_module, place_module_in_memory_cache, \
+     evict_memory_cached_module, clear_memory_cache, memory_cache_statistics
+
+def make_module(name):
+    module = types.ModuleType(name)
+    sys.modules[name] = module
+    return module
+
+def test_lru_eviction(monkeypatch):
+    clear_memory_cache()
+    monkeypatch.setenv("INSTANT_MEMORY_CACHE_SIZE", "2")
+    a, b, c = [make_module("test40_%s" % n) for n in "abc"]
+    place_module_in_memory_cache("test40_a", a)
+    place_module_in_memory_cache("test40_b", b)
+    assert memory_cached_module("test40_a") is a
+    before = memory_cache_statistics()
+    place_module_in_memory_cache("test40_c", c)
+
+    # b was used least recently
+    after = memory_cache_statistics()
+    assert after["evictions"] == before["evictions"] + 1
+    assert after["size"] == 2
+    assert memory_cached_module("test40_b") is None
+    assert "test40_b" not in sys.modules
+    assert memory_cached_module("test40_a") is a
+    assert memory_cached_module("test40_c") is c
+    assert memory_cache_statistics()["hits"] == after["hits"] + 2
+    assert memory_cache_statistics()["misses"] == after["misses"] + 1
+    clear_memory_cache()
+    assert memory_cache_statistics()["size"] == 0
+    assert "test40_a" not in sys.modules
+
+def test_evict_aliases():
+    clear_memory_cache()
+    module = make_module("test40_d")
+    place_module_in_memory_cache("test40_d", module)
+    place_module_in_memory_cache("signature of test40_d", module)
+    assert evict_memory_cached_module("signature of test40_d")
+    assert memory_cached_module("test40_d") is None
+    assert "test40_d" not in sys.modules
+    assert not evict_memory_cached_module("test40_d")
+
+def test_weak_memory_cache(monkeypatch):
+    clear_memory_cache()
+    monkeypatch.setenv("INSTANT_MEMORY_CACHE_WEAK", "1")
+    module = make_module("test40_e")
+    place_module_in_memory_cache("test40_e", module)
+    assert "test40_e" not in sys.modules
+    assert memory_cached_module("test40_e") is module
+    del module
+    gc.collect()
+    assert memory_cached_module("test40_e") is None
+
+def test_hit_hashes_once():
+    clear_memory_cache()
+    class Sig(object):
+        hashes = 0
+        def __hash__(self):
+            Sig.hashes += 1
+            return 40
+    sig = Sig()
+    module = make_module("test40_f")
+    place_module_in_memory_cache(sig, module)
+    Sig.hashes = 0
+    assert memory_cached_module(sig) is module
+    assert Sig.hashes == 1
+    clear_memory_cache()
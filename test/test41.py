@@ -0,0 +1,74 @@
+from __future__ import print_function
+import os
+import time
+import shutil
+from instant import enforce_cache_quota, evict_cached_module, \
+     cached_modules, disk_cache_statistics
+from instant import cache
+
+cache_dir = os.path.abspath("test41_cache")
+
+def make_module(name, size, age):
+    path = os.path.join(cache_dir, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "data"), "wb") as f:
+        f.write(b"x"*size)
+    finished = os.path.join(path, "finished_copying")
+    open(finished, "w").close()
+    t = time.time() - age
+    os.utime(finished, (t, t))
+
+def modules():
+    return sorted(m for m in cached_modules(cache_dir) if not m.endswith(".lock"))
+
+def test_module_quota(monkeypatch):
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    for i, name in enumerate(["a", "b", "c", "d"]):
+        make_module(name, 100, 4000 - 1000*i)
+
+    # Without a quota nothing is removed
+    assert enforce_cache_quota(cache_dir) == []
+
+    # Tracked hits update the last access, at most every
+    # _access_resolution seconds
+    monkeypatch.setenv("INSTANT_CACHE_TRACK_ACCESS", "1")
+    cache._record_access(cache_dir, "a",
+                         os.path.join(cache_dir, "a", "finished_copying"))
+    monkeypatch.setenv("INSTANT_CACHE_MAX_MODULES", "2")
+    before = disk_cache_statistics()
+    assert enforce_cache_quota(cache_dir, exclude=["b"]) == ["c", "d"]
+    assert modules() == ["a", "b"]
+    after = disk_cache_statistics()
+    assert after["evictions"] == before["evictions"] + 2
+    assert after["evicted_bytes"] == before["evicted_bytes"] + 200
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+def test_size_quota(monkeypatch):
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    make_module("a", 2000, 300)
+    make_module("b", 1000, 200)
+    make_module("c", 1000, 100)
+    monkeypatch.setenv("INSTANT_CACHE_MAX_SIZE", "2K")
+    assert enforce_cache_quota(cache_dir) == ["a"]
+    assert modules() == ["b", "c"]
+
+    # Modules used after being chosen for eviction are kept
+    assert evict_cached_module("b", cache_dir, accessed_before=0.0) is None
+    assert evict_cached_module("b", cache_dir) == 1000
+    assert evict_cached_module("b", cache_dir) is None
+    assert modules() == ["c"]
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+def test_error_dir_unmanaged(tmpdir, monkeypatch):
+    # Modules published without indexing do not count against the quota
+    from instant import copy_to_cache
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    make_module("a", 100, 100)
+    monkeypatch.setenv("INSTANT_CACHE_MAX_MODULES", "1")
+    module_path = str(tmpdir.join("b"))
+    os.mkdir(module_path)
+    copy_to_cache(module_path, cache_dir, "b", check_for_existing_path=False,
+                  indexed=False)
+    assert not os.path.exists(os.path.join(cache_dir, ".index.db"))
+    assert os.path.isdir(os.path.join(cache_dir, "a"))
+    shutil.rmtree(cache_dir, ignore_errors=True)
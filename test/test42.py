@@ -0,0 +1,115 @@
+from __future__ import print_function
+import os
+import shutil
+from instant import copy_to_cache, cached_modules, cached_module_entries, \
+     evict_cached_module, rebuild_cache_index, cached_module_path
+from instant import cache, index
+
+def publish(tmpdir, cache_dir, name):
+    module_path = str(tmpdir.join(name))
+    os.mkdir(module_path)
+    with open(os.path.join(module_path, "a.txt"), "w") as f:
+        f.write("x"*100)
+    copy_to_cache(module_path, cache_dir, name)
+
+def test_cache_index(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir.join("cache"))
+    os.mkdir(cache_dir)
+    publish(tmpdir, cache_dir, "test42_a")
+    publish(tmpdir, cache_dir, "test42_b")
+
+    # Listing the cache does not walk the cache directory
+    def fail(*args, **kwargs):
+        raise AssertionError("Cache directory listed.")
+    monkeypatch.setattr(os, "listdir", fail)
+    entries = cached_module_entries(cache_dir)
+    assert sorted(e["name"] for e in entries) == ["test42_a", "test42_b"]
+    assert all(e["size"] >= 100 and e["hits"] == 0 and e["toolchain"]
+               for e in entries)
+    monkeypatch.undo()
+
+    # By default hits write nothing
+    monkeypatch.setattr(cache, "_access_resolution", -1.0)
+    finished = os.path.join(cached_module_path(cache_dir, "test42_a"),
+                            "finished_copying")
+    os.utime(finished, (1000.0, 1000.0))
+    cache._record_access(cache_dir, "test42_a", finished)
+    assert os.path.getmtime(finished) == 1000.0
+    assert cache._pending_hits == {}
+
+    # With access tracking, hits are added to the index when the last
+    # access is updated
+    monkeypatch.setenv("INSTANT_CACHE_TRACK_ACCESS", "1")
+    cache._record_access(cache_dir, "test42_a", finished)
+    cache._record_access(cache_dir, "test42_a", finished)
+    entries = cached_module_entries(cache_dir)
+    assert entries[-1]["name"] == "test42_a"
+    assert entries[-1]["hits"] == 2
+
+    # Evicted modules are removed from the index
+    evict_cached_module("test42_a", cache_dir)
+    assert cached_modules(cache_dir) == ["test42_b"]
+
+    # The index is rebuilt from the cache directory on request
+    shutil.rmtree(cached_module_path(cache_dir, "test42_b"))
+    rebuild_cache_index(cache_dir)
+    assert cached_modules(cache_dir) == []
+
+def test_new_index(tmpdir):
+    # Modules published before the index was created are added to it
+    cache_dir = str(tmpdir.join("cache"))
+    os.makedirs(os.path.join(cache_dir, "test42_c"))
+    open(os.path.join(cache_dir, "test42_c", "finished_copying"), "w").close()
+    os.makedirs(os.path.join(cache_dir, "test42_unfinished"))
+    assert cached_modules(cache_dir) == ["test42_c"]
+
+def test_hits_do_not_create_index(tmpdir, monkeypatch):
+    # A process which only found a module in a cache without an index
+    # leaves it to the next process to create and fill the index
+    cache_dir = str(tmpdir.join("cache"))
+    os.makedirs(os.path.join(cache_dir, "test42_d"))
+    finished = os.path.join(cache_dir, "test42_d", "finished_copying")
+    open(finished, "w").close()
+    monkeypatch.setenv("INSTANT_CACHE_TRACK_ACCESS", "1")
+    monkeypatch.setattr(cache, "_access_resolution", -1.0)
+    cache._record_access(cache_dir, "test42_d", finished)
+    cache._flush_all_pending_hits()
+    assert not os.path.exists(os.path.join(cache_dir, ".index.db"))
+
+    # An index created but not filled is filled by the next user
+    index.index_entries(cache_dir)
+    index._filled_indexes.clear()
+    assert cached_modules(cache_dir) == ["test42_d"]
+
+def test_lookup_through_index(tmpdir, monkeypatch):
+    # Modules are looked up in the index, the cache directory is only
+    # searched if there is no index
+    import sys
+    from instant import check_disk_cache
+    cache_dir = str(tmpdir.join("cache"))
+    os.mkdir(cache_dir)
+    module_path = str(tmpdir.join("test42_e"))
+    os.mkdir(module_path)
+    with open(os.path.join(module_path, "__init__.py"), "w") as f:
+        f.write("def f(a):\n    return 2*a + 42\n")
+    copy_to_cache(module_path, cache_dir, "test42_e")
+    path = cached_module_path(cache_dir, "test42_e")
+    probed = []
+    exists = os.path.exists
+    def record(path):
+        probed.append(path)
+        return exists(path)
+    monkeypatch.setattr(os.path, "exists", record)
+    assert check_disk_cache("test42_e", cache_dir, []).f(1) == 44
+    assert not [p for p in probed if "test42_e" in p and not p.startswith(path)
+                and not p.startswith(os.getcwd())]
+    monkeypatch.delitem(sys.modules, "test42_e")
+
+    # A module not in the index is not found, until the index is rebuilt
+    os.rename(path, os.path.join(cache_dir, "test42_f"))
+    rebuild_cache_index(cache_dir)
+    os.rename(os.path.join(cache_dir, "test42_f"), path)
+    assert check_disk_cache("test42_e", cache_dir, []) is None
+    os.remove(os.path.join(cache_dir, ".index.db"))
+    assert check_disk_cache("test42_e", cache_dir, []).f(1) == 44
+    monkeypatch.delitem(sys.modules, "test42_e")
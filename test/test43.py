@@ -0,0 +1,49 @@
+from __future__ import print_function
+import os
+from instant import copy_to_cache, cached_modules, cached_module_path, \
+     find_cached_module, migrate_cache_layout, evict_cached_module
+
+def make_flat_module(cache_dir, name):
+    os.makedirs(os.path.join(cache_dir, name))
+    open(os.path.join(cache_dir, name, "finished_copying"), "w").close()
+
+def test_sharded_layout(tmpdir):
+    cache_dir = str(tmpdir.join("cache"))
+    module_path = str(tmpdir.join("build"))
+    os.makedirs(module_path)
+    os.makedirs(cache_dir)
+    path = copy_to_cache(module_path, cache_dir, "test43_a")
+    shard, name = os.path.split(os.path.relpath(path, cache_dir))
+    assert name == "test43_a"
+    assert len(shard.split(os.sep)) == 2
+    assert os.path.exists(os.path.join(os.path.dirname(path), "test43_a.lock"))
+    assert find_cached_module(cache_dir, "test43_a") == path
+
+def test_flat_layout_and_migration(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir.join("cache"))
+    make_flat_module(cache_dir, "test43_b")
+    make_flat_module(cache_dir, "test43_c")
+
+    # Modules in the flat layout are found
+    assert find_cached_module(cache_dir, "test43_b") \
+        == os.path.join(cache_dir, "test43_b")
+    assert sorted(cached_modules(cache_dir)) == ["test43_b", "test43_c"]
+
+    # and moved to the sharded layout
+    assert migrate_cache_layout(cache_dir) == 2
+    assert migrate_cache_layout(cache_dir) == 0
+    for name in ["test43_b", "test43_c"]:
+        assert not os.path.exists(os.path.join(cache_dir, name))
+        assert find_cached_module(cache_dir, name) \
+            == cached_module_path(cache_dir, name)
+    assert sorted(cached_modules(cache_dir)) == ["test43_b", "test43_c"]
+    assert evict_cached_module("test43_b", cache_dir) is not None
+    assert cached_modules(cache_dir) == ["test43_c"]
+
+    # and back
+    monkeypatch.setenv("INSTANT_CACHE_LAYOUT", "flat")
+    assert cached_module_path(cache_dir, "test43_c") \
+        == os.path.join(cache_dir, "test43_c")
+    assert migrate_cache_layout(cache_dir) == 1
+    assert find_cached_module(cache_dir, "test43_c") \
+        == os.path.join(cache_dir, "test43_c")
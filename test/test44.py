@@ -0,0 +1,43 @@
+from __future__ import print_function
+import os
+import pytest
+from instant import copy_to_cache, cached_modules, namespace_cache_dir, \
+     cache_namespaces, enforce_cache_quota, import_module, \
+     disk_cache_statistics
+
+def publish(tmpdir, cache_dir, name):
+    module_path = str(tmpdir.join(name))
+    os.mkdir(module_path)
+    copy_to_cache(module_path, cache_dir, name)
+
+def test_namespaces(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir.join("cache"))
+    ffc = namespace_cache_dir(cache_dir, "ffc")
+    other = namespace_cache_dir(cache_dir, "other")
+    assert cache_namespaces(cache_dir) == ["ffc", "other"]
+    publish(tmpdir, cache_dir, "test44_a")
+    publish(tmpdir, ffc, "test44_b")
+    publish(tmpdir, ffc, "test44_c")
+    publish(tmpdir, other, "test44_d")
+    assert cached_modules(cache_dir) == ["test44_a"]
+    assert sorted(cached_modules(cache_dir, "ffc")) == ["test44_b", "test44_c"]
+    assert cached_modules(cache_dir, "other") == ["test44_d"]
+
+    # Each namespace has its own quota
+    monkeypatch.setenv("INSTANT_CACHE_MAX_MODULES", "1")
+    monkeypatch.setenv("INSTANT_CACHE_MAX_MODULES_FFC", "2")
+    assert enforce_cache_quota(ffc) == []
+    assert enforce_cache_quota(cache_dir) == []
+    publish(tmpdir, other, "test44_e")
+    assert cached_modules(cache_dir, "other") == ["test44_e"]
+    assert disk_cache_statistics(cache_dir, "other")["evictions"] == 1
+    assert disk_cache_statistics(cache_dir, "ffc")["evictions"] == 0
+
+    # and its own lookups
+    assert import_module("test44_b", cache_dir, namespace="other") is None
+    assert disk_cache_statistics(cache_dir, "other")["misses"] == 1
+    assert disk_cache_statistics(cache_dir, "ffc")["misses"] == 0
+
+def test_invalid_namespace(tmpdir):
+    with pytest.raises(AssertionError):
+        namespace_cache_dir(str(tmpdir), "../ffc")
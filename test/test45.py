@@ -0,0 +1,52 @@
+from __future__ import print_function
+import os
+import sys
+from instant import check_disk_cache, set_cache_tiers, get_cache_tiers, \
+     get_default_cache_dir, find_cached_module, disk_cache_statistics, \
+     namespace_cache_dir
+from instant import paths
+
+def make_module(cache_dir, name):
+    path = os.path.join(cache_dir, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "__init__.py"), "w") as f:
+        f.write("def f(a):\n    return 2*a + 45\n")
+    open(os.path.join(path, "finished_copying"), "w").close()
+
+def test_cache_tiers(tmpdir, monkeypatch):
+    fast = str(tmpdir.join("fast"))
+    site = str(tmpdir.join("site"))
+    make_module(site, "test45_a")
+    make_module(os.path.join(site, "namespaces", "ffc"), "test45_b")
+    monkeypatch.setitem(paths._writable_tiers, site, False)
+    monkeypatch.setenv("INSTANT_CACHE_TIERS", os.pathsep.join([site, fast]))
+    assert get_cache_tiers() == [site, fast]
+    set_cache_tiers([fast, site])
+    try:
+        # Writes go to the first writable tier
+        assert get_cache_tiers() == [fast, site]
+        assert get_default_cache_dir() == fast
+
+        # Modules are found in later tiers, without writing to read-only ones
+        before = os.listdir(site)
+        module = check_disk_cache("test45_a", None, [])
+        assert module.f(1) == 47
+        assert os.listdir(site) == before
+        assert disk_cache_statistics(site)["hits"] == 1
+        assert find_cached_module(fast, "test45_a") is None
+
+        # Hits can be copied to the first writable tier
+        monkeypatch.setenv("INSTANT_CACHE_PROMOTE", "1")
+        monkeypatch.delitem(sys.modules, "test45_a")
+        module = check_disk_cache("test45_a", None, [])
+        assert find_cached_module(fast, "test45_a") is not None
+        assert disk_cache_statistics(fast)["promotions"] == 1
+        monkeypatch.delitem(sys.modules, "test45_a")
+        module = check_disk_cache("test45_a", None, [])
+        assert disk_cache_statistics(fast)["hits"] == 1
+
+        # Namespaces are searched in each tier
+        module = check_disk_cache("test45_b", namespace_cache_dir(None, "ffc"), [])
+        assert module.f(2) == 49
+    finally:
+        set_cache_tiers(None)